@@ -11,4 +11,4 @@ python3 ${path}/src/main_preprocessing.py \
 --bam path/to/bam/file1 path/to/bam/file2 \
 --job_index ${SLURM_ARRAY_TASK_ID} \
 --reference path/to/reference/genes.gtf \
---total_jobs 30
+--total_jobs 30 --schedule balanced
@@ -13,6 +13,7 @@ import pysam
 import reference as ref
 from joblib import Parallel, delayed
 from preprocessing import load_pickle, merge_exons
+from read_index import build_read_index, read_index_exists
 from scipy.ndimage import gaussian_filter1d
 
 ######################################################################
@@ -68,25 +69,25 @@ def extract_bam_info(bam, barcode_cell="CB", barcode_umi="UB"):
     ReadTagsDF = pd.DataFrame(ReadTags)
     if ReadTagsDF.shape[0] > 0:
         ReadTagsDF.columns = ["QNAME", "CB", "UMI", "LENGTH"]
-        ReadTagsDF = ReadTagsDF.sort_values(
-            by=["CB", "UMI", "LENGTH"], ascending=[True, True, False]
-        ).reset_index(drop=True)
-        ReadTagsDF["CBUMI"] = (
-            ReadTagsDF.CB.astype(str) + "_" + ReadTagsDF.UMI.astype(str)
-        )
+        ReadTagsDF = sort_bam_info(ReadTagsDF)
     else:
         ReadTagsDF = None
     return ReadTagsDF
 
 
-def extract_bam_info_parse(bam):
-    print("BAM INFO STEP - PARSE")
-    bamFilePysam = pysam.Samfile(bam, "rb")
+def get_parse_sublibrary(bam):
     match = re.search(r"sublibrary(\d+)", bam)
     if match:
         sublib = match.group(1)
     else:
         sublib = "1"
+    return sublib
+
+
+def extract_bam_info_parse(bam):
+    print("BAM INFO STEP - PARSE")
+    bamFilePysam = pysam.Samfile(bam, "rb")
+    sublib = get_parse_sublibrary(bam)
     # qname cb umi cbumi length
     try:
         ReadTags = [
@@ -124,16 +125,7 @@ def extract_bam_info_parse(bam):
     ReadTagsDF = pd.DataFrame(ReadTags)
     if ReadTagsDF.shape[0] > 0:
         ReadTagsDF.columns = ["QNAME", "CB", "UMI", "LENGTH", "SAMPLE", "SUBLIB"]
-        ReadTagsDF = ReadTagsDF.sort_values(
-            by=["SAMPLE", "CB", "UMI", "LENGTH"], ascending=[True, True, True, False]
-        ).reset_index(drop=True)
-        ReadTagsDF["CBUMI"] = (
-            ReadTagsDF.CB.astype(str)
-            + "_"
-            + ReadTagsDF.UMI.astype(str)
-            + "_"
-            + ReadTagsDF.SUBLIB.astype(str)
-        )
+        ReadTagsDF = sort_bam_info(ReadTagsDF, parse=True)
     else:
         ReadTagsDF = None
     return ReadTagsDF
@@ -155,41 +147,431 @@ def extract_bam_info_pacbio(bam, barcode_cell="XC", barcode_umi="XM"):
     ReadTagsDF = pd.DataFrame(ReadTags)
     if ReadTagsDF.shape[0] > 0:
         ReadTagsDF.columns = ["QNAME", "CB", "UMI", "LENGTH"]
-        ReadTagsDF.dropna(inplace=True)
+        ReadTagsDF = sort_bam_info(ReadTagsDF, pacbio=True)
+    else:
+        ReadTagsDF = None
+    return ReadTagsDF
+
+
+def sort_bam_info(ReadTagsDF, parse=False, pacbio=False):
+    # sort reads so that the longest read of each molecule comes first and add CBUMI
+    if parse:
+        ReadTagsDF = ReadTagsDF.sort_values(
+            by=["SAMPLE", "CB", "UMI", "LENGTH"], ascending=[True, True, True, False]
+        ).reset_index(drop=True)
+        ReadTagsDF["CBUMI"] = (
+            ReadTagsDF.CB.astype(str)
+            + "_"
+            + ReadTagsDF.UMI.astype(str)
+            + "_"
+            + ReadTagsDF.SUBLIB.astype(str)
+        )
+    else:
+        if pacbio:
+            ReadTagsDF = ReadTagsDF.dropna()
         ReadTagsDF = ReadTagsDF.sort_values(
             by=["CB", "UMI", "LENGTH"], ascending=[True, True, False]
         ).reset_index(drop=True)
         ReadTagsDF["CBUMI"] = (
             ReadTagsDF.CB.astype(str) + "_" + ReadTagsDF.UMI.astype(str)
         )
-        ReadTagsDF["QNAME"] = (
-            ReadTagsDF.QNAME.astype(str)
-            + "_"
-            + ReadTagsDF.LENGTH.astype(int).astype(str)
+        if pacbio:
+            ReadTagsDF["QNAME"] = (
+                ReadTagsDF.QNAME.astype(str)
+                + "_"
+                + ReadTagsDF.LENGTH.astype(int).astype(str)
+            )
+    return ReadTagsDF
+
+
+######################################################################
+#########################streaming bam info###########################
+######################################################################
+
+BAM_INFO_COLUMNS = ["QNAME", "CB", "UMI", "LENGTH", "SAMPLE", "SUBLIB"]
+
+
+def bam_info_schema():
+    import pyarrow as pa
+
+    return pa.schema(
+        [
+            ("QNAME", pa.string()),
+            ("CB", pa.string()),
+            ("UMI", pa.string()),
+            ("LENGTH", pa.int32()),
+            ("SAMPLE", pa.string()),
+            ("SUBLIB", pa.string()),
+        ]
+    )
+
+
+def read_bam_tags(read, barcode_cell, barcode_umi, parse=False, pacbio=False, sublib="1"):
+    # one row of BAM_INFO_COLUMNS for a single read, same fields as extract_bam_info*
+    if parse:
+        fields = read.qname.split("_")
+        sample = read.get_tag("pS") if read.has_tag("pS") else "sample"
+        return (
+            read.qname,
+            fields[-5] + "_" + fields[-4] + "_" + fields[-3],
+            fields[-1],
+            read.query_alignment_length,
+            sample,
+            sublib,
+        )
+    if pacbio:
+        # reads without barcodes or alignment are dropped later, as with dropna()
+        return (
+            read.qname,
+            read.get_tag(barcode_cell) if read.has_tag(barcode_cell) else None,
+            read.get_tag(barcode_umi) if read.has_tag(barcode_umi) else None,
+            read.reference_length,
+            None,
+            None,
+        )
+    return (
+        read.qname,
+        read.get_tag(barcode_cell),
+        read.get_tag(barcode_umi),
+        read.qend - read.qstart,
+        None,
+        None,
+    )
+
+
+def iter_bam_info_chunks(
+    reads,
+    barcode_cell="CB",
+    barcode_umi="UB",
+    parse=False,
+    pacbio=False,
+    sublib="1",
+    chunk_size=1000000,
+):
+    """
+    stream tags of an iterable of reads as columnar chunks
+    :param reads: iterable of pysam reads, e.g. an opened bam file or a fetch() iterator
+    :param chunk_size: maximal number of reads held in memory at once
+    :return: generator of dicts {column: list} with keys BAM_INFO_COLUMNS
+    """
+    chunk = []
+    for read in reads:
+        chunk.append(
+            read_bam_tags(read, barcode_cell, barcode_umi, parse, pacbio, sublib)
+        )
+        if len(chunk) >= chunk_size:
+            yield dict(zip(BAM_INFO_COLUMNS, map(list, zip(*chunk))))
+            chunk = []
+    if len(chunk) > 0:
+        yield dict(zip(BAM_INFO_COLUMNS, map(list, zip(*chunk))))
+
+
+def write_bam_info_chunks(chunks, output):
+    # append columnar chunks to a single parquet file, return the number of reads written
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    schema = bam_info_schema()
+    n_reads = 0
+    with pq.ParquetWriter(output + ".tmp", schema) as writer:
+        for chunk in chunks:
+            writer.write_table(pa.Table.from_pydict(chunk, schema=schema))
+            n_reads += len(chunk["QNAME"])
+    os.replace(output + ".tmp", output)
+    return n_reads
+
+
+def extract_bam_info_parquet(
+    bam,
+    output,
+    barcode_cell="CB",
+    barcode_umi="UB",
+    parse=False,
+    pacbio=False,
+    chunk_size=1000000,
+):
+    """
+    streaming version of extract_bam_info/extract_bam_info_parse/extract_bam_info_pacbio
+    :param bam: path to bam file
+    :param output: path to the parquet file to write, peak memory is bounded by chunk_size
+    :return: number of reads written
+    """
+    print("BAM INFO STEP - STREAMING")
+    bamFilePysam = pysam.AlignmentFile(bam, "rb")
+    sublib = get_parse_sublibrary(bam) if parse else None
+    chunks = iter_bam_info_chunks(
+        bamFilePysam.fetch(until_eof=True),
+        barcode_cell,
+        barcode_umi,
+        parse,
+        pacbio,
+        sublib,
+        chunk_size,
+    )
+    n_reads = write_bam_info_chunks(chunks, output)
+    bamFilePysam.close()
+    return n_reads
+
+
+def extract_bam_info_folder_parquet(
+    bam_folder,
+    output,
+    num_cores,
+    parse=False,
+    pacbio=False,
+    barcode_cell=None,
+    barcode_umi=None,
+    chunk_size=1000000,
+    logger=None,
+):
+    # write one parquet part per bam file into the output dataset folder
+    files = os.listdir(bam_folder)
+    logger.info("STARTING STREAMING EXTRACTION OF BAM INFO FOLDER")
+    bamfiles = [os.path.join(bam_folder, f) for f in files if f.endswith(".bam")]
+    if parse:
+        bamfiles = [bam for bam in bamfiles if bam + ".bai" in files]
+    output_tmp = make_parquet_folder_tmp(output)
+    Parallel(n_jobs=num_cores)(
+        delayed(extract_bam_info_parquet)(
+            bam,
+            os.path.join(output_tmp, "part-" + str(i) + ".parquet"),
+            barcode_cell,
+            barcode_umi,
+            parse,
+            pacbio,
+            chunk_size,
         )
+        for i, bam in enumerate(bamfiles)
+    )
+    os.replace(output_tmp, output)
+
+
+def make_parquet_folder_tmp(output):
+    # parts are written to output.tmp, renamed to output once all are complete,
+    # so that a crashed run never leaves a partial dataset at output
+    output_tmp = output + ".tmp"
+    if os.path.exists(output_tmp):
+        shutil.rmtree(output_tmp)
+    os.makedirs(output_tmp)
+    return output_tmp
+
+
+def bam_regions(bam, region_size=10000000):
+    """
+    split an indexed bam file into regions using its index
+    :param bam: path to an indexed bam file
+    :param region_size: maximal region length in bp; None to keep whole contigs
+    :return: list of (contig, start, end), with ("*", None, None) for unplaced unmapped reads
+    """
+    bamFilePysam = pysam.AlignmentFile(bam, "rb")
+    contig_length = dict(zip(bamFilePysam.references, bamFilePysam.lengths))
+    regions = []
+    for stat in bamFilePysam.get_index_statistics():
+        if stat.total == 0:
+            continue
+        length = contig_length[stat.contig]
+        step = length if region_size is None else region_size
+        for start in range(0, length, step):
+            regions.append((stat.contig, start, min(start + step, length)))
+    if bamFilePysam.unmapped > 0 or bamFilePysam.nocoordinate > 0:
+        regions.append(("*", None, None))
+    bamFilePysam.close()
+    return regions
+
+
+def extract_bam_info_region(
+    bam,
+    region,
+    barcode_cell="CB",
+    barcode_umi="UB",
+    parse=False,
+    pacbio=False,
+    output=None,
+):
+    # bam tags of reads starting within one region, so every read is extracted exactly once
+    contig, start, end = region
+    bamFilePysam = pysam.AlignmentFile(bam, "rb")
+    if contig == "*":
+        reads = bamFilePysam.fetch("*")
     else:
+        reads = (
+            read
+            for read in bamFilePysam.fetch(contig, start, end)
+            if read.reference_start >= start
+        )
+    sublib = get_parse_sublibrary(bam) if parse else None
+    if output is not None:
+        chunks = iter_bam_info_chunks(
+            reads, barcode_cell, barcode_umi, parse, pacbio, sublib
+        )
+        write_bam_info_chunks(chunks, output)
         ReadTagsDF = None
+    else:
+        ReadTagsDF = pd.DataFrame.from_records(
+            [
+                read_bam_tags(read, barcode_cell, barcode_umi, parse, pacbio, sublib)
+                for read in reads
+            ],
+            columns=BAM_INFO_COLUMNS,
+        )
+    bamFilePysam.close()
     return ReadTagsDF
 
 
+def extract_bam_info_by_region(
+    bam,
+    num_cores,
+    parse=False,
+    pacbio=False,
+    barcode_cell=None,
+    barcode_umi=None,
+    region_size=10000000,
+    output=None,
+    logger=None,
+):
+    """
+    extract bam information of a single indexed bam file in parallel over contig regions
+    :param output: parquet folder to write one part per region; if None the merged dataframe is returned
+    :return: the same sorted dataframe as extract_bam_info*, or None when writing to output
+    """
+    regions = bam_regions(bam, region_size)
+    logger.info(
+        f"STARTING EXTRACTION OF BAM INFO OVER {len(regions)} REGIONS WITH {num_cores} WORKERS"
+    )
+    output_tmp = None if output is None else make_parquet_folder_tmp(output)
+    df = Parallel(n_jobs=num_cores)(
+        delayed(extract_bam_info_region)(
+            bam,
+            region,
+            barcode_cell,
+            barcode_umi,
+            parse,
+            pacbio,
+            None
+            if output is None
+            else os.path.join(output_tmp, "part-" + str(i) + ".parquet"),
+        )
+        for i, region in enumerate(regions)
+    )
+    if output is not None:
+        os.replace(output_tmp, output)
+        return None
+    ReadTagsDF = pd.concat(df).reset_index(drop=True)
+    if not parse:
+        ReadTagsDF = ReadTagsDF.drop(columns=["SAMPLE", "SUBLIB"])
+    if ReadTagsDF.shape[0] == 0:
+        return None
+    return sort_bam_info(ReadTagsDF, parse=parse, pacbio=pacbio)
+
+
+def has_bam_index(bam):
+    try:
+        with pysam.AlignmentFile(bam, "rb") as bamFilePysam:
+            return bamFilePysam.has_index()
+    except (OSError, ValueError):
+        return False
+
+
+def bam_info_to_arrays(bam_info, parse=False):
+    """
+    integer-coded read identity of bam information
+    :param bam_info: dataframe from extract_bam_info*, sorted so that the read to keep comes first in each CBUMI
+    :return: dict of arrays aligned with the rows of bam_info:
+        QNAME: read names
+        REPRESENTATIVE: row of the read to keep for the molecule (CBUMI) of each read
+        CBUMI_CODE, CBUMI: molecule code of each read and the molecule names
+        SAMPLE_CODE, SAMPLE: sample code of each read and the sample names (parse only)
+    """
+    cbumi_code, cbumi = pd.factorize(bam_info["CBUMI"], sort=False)
+    # codes follow the order of first appearance, so unique() gives the first row of every molecule
+    _, first_row = np.unique(cbumi_code, return_index=True)
+    arrays = {
+        "QNAME": bam_info["QNAME"].to_numpy(),
+        "REPRESENTATIVE": first_row[cbumi_code],
+        "CBUMI_CODE": cbumi_code,
+        "CBUMI": np.asarray(cbumi),
+    }
+    if parse:
+        sample_code, sample = pd.factorize(bam_info["SAMPLE"], sort=False)
+        arrays["SAMPLE_CODE"] = sample_code
+        arrays["SAMPLE"] = np.asarray(sample)
+    return arrays
+
+
+def load_bam_info_arrays(path, parse=False, pacbio=False, batch_size=1000000):
+    """
+    bam_info_to_arrays of the bam information written by extract_bam_info_parquet, read by row groups
+    so that the whole dataframe is never loaded
+    :param path: parquet file or folder of parquet parts
+    :return: the arrays of bam_info_to_arrays in file order; the representative of a molecule is its longest read, as after sort_bam_info
+    """
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    import pyarrow.dataset as ds
+
+    def factorize(chunks):
+        # codes in order of first appearance and the unique values, computed by arrow on all chunks
+        values = pa.chunked_array(chunks, type=pa.string())
+        unique = pc.unique(values)
+        code = pc.index_in(values, value_set=unique).to_numpy().astype(np.int64)
+        return code, unique.to_numpy(zero_copy_only=False)
+
+    columns = BAM_INFO_COLUMNS if parse else BAM_INFO_COLUMNS[:4]
+    dataset = ds.dataset(path, format="parquet")
+    qnames, cbumis, lengths, samples = [], [], [], []
+    for batch in dataset.to_batches(columns=columns, batch_size=batch_size):
+        if pacbio:
+            batch = pc.drop_null(batch)
+            qname = pc.binary_join_element_wise(
+                batch["QNAME"], pc.cast(batch["LENGTH"], pa.string()), "_"
+            )
+        else:
+            qname = batch["QNAME"]
+        # missing tags are named "None", as with astype(str) on the dataframe
+        tags = ["CB", "UMI", "SUBLIB"] if parse else ["CB", "UMI"]
+        cbumis.append(
+            pc.binary_join_element_wise(
+                *[pc.fill_null(batch[tag], "None") for tag in tags], "_"
+            )
+        )
+        if parse:
+            samples.append(batch["SAMPLE"])
+        qnames.append(qname)
+        lengths.append(pc.fill_null(batch["LENGTH"], 0).to_numpy().astype(np.int64))
+    cbumi_code, cbumi = factorize(cbumis)
+    length = np.concatenate(lengths + [np.zeros(0, dtype=np.int64)])
+    # longest read of every molecule
+    order = np.lexsort((-length, cbumi_code))
+    first = np.diff(cbumi_code[order], prepend=-1) != 0
+    longest_row = np.empty(len(cbumi), dtype=np.int64)
+    longest_row[cbumi_code[order][first]] = order[first]
+    arrays = {
+        "QNAME": pa.chunked_array(qnames, type=pa.string()).to_numpy(),
+        "REPRESENTATIVE": longest_row[cbumi_code],
+        "CBUMI_CODE": cbumi_code,
+        "CBUMI": cbumi,
+    }
+    if parse:
+        arrays["SAMPLE_CODE"], arrays["SAMPLE"] = factorize(samples)
+    return arrays
+
+
 def bam_info_to_dict(bam_info, parse=False):
     # input bam_info is a dataframe(bam_info is sorted already when generating)
     # the output dict qname_dict: key: qname, value: the right qname to keep; qname_CBUMI_dict: qname_cbumi
-    # generate qname_dict
-    max_length_df = bam_info.drop_duplicates(subset="CBUMI", keep="first")
-    cbumi_to_max_qname = pd.Series(
-        max_length_df.QNAME.values, index=max_length_df.CBUMI
-    ).to_dict()
-    qname_dict = {
-        row["QNAME"]: cbumi_to_max_qname[row["CBUMI"]]
-        for index, row in bam_info.iterrows()
-    }
-    # generate qname_cbumi_dict
-    # Assuming 'bam_info' is your pandas DataFrame
-    qname_cbumi_dict = dict(zip(bam_info["QNAME"], bam_info["CBUMI"]))
+    return bam_arrays_to_dict(bam_info_to_arrays(bam_info, parse), parse)
+
+
+def bam_arrays_to_dict(arrays, parse=False):
+    # read-identity dictionaries of the arrays of bam_info_to_arrays
+    qnames = arrays["QNAME"]
+    qname_dict = dict(zip(qnames, qnames[arrays["REPRESENTATIVE"]]))
+    qname_cbumi_dict = dict(zip(qnames, arrays["CBUMI"][arrays["CBUMI_CODE"]]))
     qname_sample_dict = None
     if parse:
-        qname_sample_dict = dict(zip(bam_info["QNAME"], bam_info["SAMPLE"]))
+        qname_sample_dict = dict(
+            zip(qnames, arrays["SAMPLE"][arrays["SAMPLE_CODE"]])
+        )
     return qname_dict, qname_cbumi_dict, qname_sample_dict
 
 
@@ -1057,6 +1439,9 @@ class Annotator:
         min_gene_size,
         build=None,
         platform="10x-ont",
+        bam_info_format="csv",
+        chunk_size=1000000,
+        read_index=False,
         logger=None,
     ):
         """
@@ -1065,6 +1450,8 @@ class Annotator:
         bam_path: path to bam file, or path to the bam file folder; can be a str for a single sample, or a list for multiple samples
         update_gtf: whether to update gtf annotation using bam file
         build: parse parameter
+        bam_info_format: csv or parquet; parquet streams bam tags to disk in chunks of chunk_size reads
+        read_index: save read identities as a memory-mapped index (bam/bam.Index) instead of bam.Info*.pkl
         """
         self.logger = logger
         self.multiple_bam = True if len(bam_path) > 1 else False
@@ -1096,6 +1483,13 @@ class Annotator:
             os.path.join(t, "bam/bam.Info3.pkl") for t in target
         ]  # only available for parse
         self.bamInfo_csv_path = [os.path.join(t, "bam/bam.Info.csv") for t in target]
+        self.bamInfo_parquet_path = [
+            os.path.join(t, "bam/bam.Info.parquet") for t in target
+        ]
+        self.bamInfo_index_path = [os.path.join(t, "bam/bam.Index") for t in target]
+        self.bam_info_format = bam_info_format
+        self.chunk_size = chunk_size
+        self.read_index = read_index
         # some parameters
         self.coverage_threshold_gene = coverage_threshold_gene
         self.coverage_threshold_exon = coverage_threshold_exon
@@ -1190,64 +1584,128 @@ class Annotator:
         for i in range(len(self.target)):
             if not os.path.exists(self.bamInfo_folder_path[i]):
                 os.makedirs(self.bamInfo_folder_path[i])
-            if (
-                os.path.isfile(self.bamInfo_pkl_path[i]) == True
-                and os.path.isfile(self.bamInfo_csv_path[i]) == True
-            ):
+            if self.bam_info_format == "parquet":
+                bamInfo_path = self.bamInfo_parquet_path[i]
+            else:
+                bamInfo_path = self.bamInfo_csv_path[i]
+            if self.read_index:
+                bamInfo_dict_path = self.bamInfo_index_path[i]
+                bamInfo_dict_exists = read_index_exists(bamInfo_dict_path)
+            else:
+                bamInfo_dict_path = self.bamInfo_pkl_path[i]
+                bamInfo_dict_exists = os.path.isfile(bamInfo_dict_path)
+            if bamInfo_dict_exists == True and os.path.exists(bamInfo_path) == True:
                 self.logger.info(
-                    f"bam file information exist at {self.bamInfo_pkl_path[i]} and {self.bamInfo_csv_path[i]}"
+                    f"bam file information exist at {bamInfo_dict_path} and {bamInfo_path}"
                 )
-            if (
-                os.path.isfile(self.bamInfo_pkl_path[i]) == False
-                and os.path.isfile(self.bamInfo_csv_path[i]) == True
-            ):
+            if bamInfo_dict_exists == False and os.path.exists(bamInfo_path) == True:
                 self.logger.info("Extracting bam file pickle information")
-                bam_info = pd.read_csv(self.bamInfo_csv_path[i])
-                qname_dict, qname_cbumi_dict, qname_sample_dict = bam_info_to_dict(
-                    bam_info, self.parse
-                )
-                with open(self.bamInfo_pkl_path[i], "wb") as file:
-                    pickle.dump(qname_dict, file)
-                with open(self.bamInfo2_pkl_path[i], "wb") as file:
-                    pickle.dump(qname_cbumi_dict, file)
-                if qname_sample_dict is not None:
-                    with open(self.bamInfo3_pkl_path[i], "wb") as file:
-                        pickle.dump(qname_sample_dict, file)
-            if (
-                os.path.isfile(self.bamInfo_pkl_path[i]) == False
-                and os.path.isfile(self.bamInfo_csv_path[i]) == False
-            ):
+                if self.bam_info_format == "parquet":
+                    bam_arrays = load_bam_info_arrays(
+                        bamInfo_path, self.parse, self.pacbio, self.chunk_size
+                    )
+                else:
+                    bam_arrays = bam_info_to_arrays(
+                        pd.read_csv(bamInfo_path), self.parse
+                    )
+                self.save_bam_info_dict(i, bam_arrays)
+            if bamInfo_dict_exists == False and os.path.exists(bamInfo_path) == False:
                 self.logger.info("Extracting bam file information")
-                if os.path.isfile(self.bam_path[i]) == False:
-                    bam_info = extract_bam_info_folder(
-                        self.bam_path[i],
-                        self.workers,
-                        self.parse,
-                        self.pacbio,
-                        barcode_cell,
-                        barcode_umi,
-                        self.logger,
+                if self.bam_info_format == "parquet":
+                    bam_arrays = self.extract_bam_info_parquet(
+                        i, barcode_cell, barcode_umi
                     )
                 else:
-                    if self.parse:
-                        bam_info = extract_bam_info_parse(self.bam_path[i])
-                    elif self.pacbio:
-                        bam_info = extract_bam_info_pacbio(
-                            self.bam_path[i], barcode_cell, barcode_umi
-                        )
-                    else:
-                        bam_info = extract_bam_info(
-                            self.bam_path[i], barcode_cell, barcode_umi
-                        )
-                bam_info.to_csv(self.bamInfo_csv_path[i])
+                    bam_info = self.extract_bam_info(i, barcode_cell, barcode_umi)
+                    bam_info.to_csv(bamInfo_path)
+                    bam_arrays = bam_info_to_arrays(bam_info, self.parse)
                 self.logger.info("Generating bam file pickle information")
-                qname_dict, qname_cbumi_dict, qname_sample_dict = bam_info_to_dict(
-                    bam_info, self.parse
+                self.save_bam_info_dict(i, bam_arrays)
+
+    def extract_bam_info(self, i, barcode_cell, barcode_umi):
+        if os.path.isfile(self.bam_path[i]) == False:
+            bam_info = extract_bam_info_folder(
+                self.bam_path[i],
+                self.workers,
+                self.parse,
+                self.pacbio,
+                barcode_cell,
+                barcode_umi,
+                self.logger,
+            )
+        elif self.workers > 1 and has_bam_index(self.bam_path[i]):
+            bam_info = extract_bam_info_by_region(
+                self.bam_path[i],
+                self.workers,
+                self.parse,
+                self.pacbio,
+                barcode_cell,
+                barcode_umi,
+                logger=self.logger,
+            )
+        else:
+            if self.parse:
+                bam_info = extract_bam_info_parse(self.bam_path[i])
+            elif self.pacbio:
+                bam_info = extract_bam_info_pacbio(
+                    self.bam_path[i], barcode_cell, barcode_umi
                 )
-                with open(self.bamInfo_pkl_path[i], "wb") as file:
-                    pickle.dump(qname_dict, file)
-                with open(self.bamInfo2_pkl_path[i], "wb") as file:
-                    pickle.dump(qname_cbumi_dict, file)
-                if qname_sample_dict is not None:
-                    with open(self.bamInfo3_pkl_path[i], "wb") as file:
-                        pickle.dump(qname_sample_dict, file)
+            else:
+                bam_info = extract_bam_info(self.bam_path[i], barcode_cell, barcode_umi)
+        return bam_info
+
+    def extract_bam_info_parquet(self, i, barcode_cell, barcode_umi):
+        if os.path.isfile(self.bam_path[i]) == False:
+            extract_bam_info_folder_parquet(
+                self.bam_path[i],
+                self.bamInfo_parquet_path[i],
+                self.workers,
+                self.parse,
+                self.pacbio,
+                barcode_cell,
+                barcode_umi,
+                self.chunk_size,
+                self.logger,
+            )
+        elif self.workers > 1 and has_bam_index(self.bam_path[i]):
+            extract_bam_info_by_region(
+                self.bam_path[i],
+                self.workers,
+                self.parse,
+                self.pacbio,
+                barcode_cell,
+                barcode_umi,
+                output=self.bamInfo_parquet_path[i],
+                logger=self.logger,
+            )
+        else:
+            n_reads = extract_bam_info_parquet(
+                self.bam_path[i],
+                self.bamInfo_parquet_path[i],
+                barcode_cell,
+                barcode_umi,
+                self.parse,
+                self.pacbio,
+                self.chunk_size,
+            )
+            self.logger.info(f"{n_reads} reads written to {self.bamInfo_parquet_path[i]}")
+        return load_bam_info_arrays(
+            self.bamInfo_parquet_path[i], self.parse, self.pacbio, self.chunk_size
+        )
+
+    def save_bam_info_dict(self, i, bam_arrays):
+        # bam_arrays: read identities from bam_info_to_arrays or load_bam_info_arrays
+        if self.read_index:
+            self.logger.info(f"Writing read index at {self.bamInfo_index_path[i]}")
+            build_read_index(bam_arrays, self.bamInfo_index_path[i])
+            return
+        qname_dict, qname_cbumi_dict, qname_sample_dict = bam_arrays_to_dict(
+            bam_arrays, self.parse
+        )
+        with open(self.bamInfo_pkl_path[i], "wb") as file:
+            pickle.dump(qname_dict, file)
+        with open(self.bamInfo2_pkl_path[i], "wb") as file:
+            pickle.dump(qname_cbumi_dict, file)
+        if qname_sample_dict is not None:
+            with open(self.bamInfo3_pkl_path[i], "wb") as file:
+                pickle.dump(qname_sample_dict, file)
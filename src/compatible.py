@@ -1,12 +1,35 @@
 import copy
 import csv
+import hashlib
+import heapq
+import json
 import math
 import pickle
 import re
+import socket
+import time
+from collections import OrderedDict
 
 import pysam
+from annotation import load_bam_info_arrays
 from joblib import Parallel, delayed
 from preprocessing import *
+from compatible_store import (
+    CompatibleStore,
+    CompatibleStoreWriter,
+    compatible_store_paths,
+    compatible_store_readable,
+    newest_compatible_sources,
+)
+from read_index import (
+    READ_SELECTION_NPY,
+    ReadIndex,
+    ReadIndexColumn,
+    build_read_index,
+    build_read_selection,
+    read_index_arrays,
+    read_index_exists,
+)
 
 
 def convert_to_gtf(
@@ -208,7 +231,7 @@ def summarise_annotation(target, logger):
             logger.info("novel isoform annotations does not exist!")
 
 
-def summarise_auxillary(target, logger):
+def summarise_auxillary(target, logger, seed=None):
     def process_group(group):
         highest_priority = group["priority"].max()
         highest_priority_rows = group[group["priority"] == highest_priority]
@@ -219,7 +242,9 @@ def summarise_auxillary(target, logger):
             group.loc[highest_priority_rows.index, "Keep"] = 1
         else:
             group.loc[highest_priority_rows.index, "GeneMapping"] = "ambiguous"
-            random_index = highest_priority_rows.sample(n=1).index
+            random_index = highest_priority_rows.sample(
+                n=1, random_state=gene_seed(seed, group["Read"].iloc[0])
+            ).index
             group.loc[random_index, "Keep"] = 1
         return group
 
@@ -228,23 +253,44 @@ def summarise_auxillary(target, logger):
         df["gene"] = df["geneName"] + "_" + df["geneID"]
         return df
 
-    # Collect all 'auxillary' directories
+    # Collect all 'auxillary' directories, and those of compatible matrix stores
     auxillary_folders = []
     for root, dirs, files in os.walk(target):
-        if "auxillary" in dirs:
+        if "auxillary" in dirs or (
+            "compatible_matrix" in dirs
+            and compatible_store_paths(os.path.join(root, "compatible_matrix"))
+        ):
             auxillary_folders.append(os.path.join(root, "auxillary"))
     for auxillary_folder in auxillary_folders:
+        os.makedirs(auxillary_folder, exist_ok=True)
         logger.info(
             "summarising read-isoform mapping files at: " + str(auxillary_folder)
         )
         file_paths = [
             os.path.join(auxillary_folder, f)
-            for f in os.listdir(auxillary_folder)
+            for f in sorted(os.listdir(auxillary_folder))
             if "ENSG" in f
         ]
+        store_folder = os.path.join(
+            os.path.dirname(auxillary_folder), "compatible_matrix"
+        )
+        store = (
+            CompatibleStore(store_folder)
+            if compatible_store_paths(store_folder)
+            else None
+        )
+        # a gene saved both as a tsv file and in a store is read from the newest of them
+        file_paths, store_genes = newest_compatible_sources(
+            file_paths, store, suffix="_read_isoform_exon_mapping.tsv"
+        )
         df_list = Parallel(n_jobs=-1)(
             delayed(read_file)(file_path) for file_path in file_paths
         )
+        if store is not None:
+            df = store.mapping(store_genes)
+            store.close()
+            df["gene"] = df["geneName"] + "_" + df["geneID"]
+            df_list.append(df)
         DF = pd.concat(df_list, axis=0, ignore_index=True).reset_index(drop=True)
         DF["MappingScore"] = DF["MappingScore"].fillna(-1)
         conditions = [
@@ -289,6 +335,214 @@ def summarise_auxillary(target, logger):
         logger.info("saving read filtering file: " + str(output_file_pkl))
         with open(output_file_pkl, "wb") as pickle_file:
             pickle.dump(cbumi_keep_dict, pickle_file)
+        build_read_selection(
+            DF_final["CBUMI"],
+            DF_final["Keep"],
+            os.path.join(auxillary_folder, READ_SELECTION_NPY),
+        )
+
+
+def find_bam_files(bam_paths, chrom):
+    # bam files holding reads of chrom: a bam file is used as it is, a folder has one bam file per chromosome
+    bam_files = []
+    for bam_path in bam_paths:
+        if os.path.isfile(bam_path):
+            bam_files.append(bam_path)
+        else:
+            bamFile_name = [
+                f
+                for f in os.listdir(bam_path)
+                if f.endswith(".bam") and "." + chrom + "." in f
+            ]
+            if bamFile_name:
+                bam_files.append(os.path.join(bam_path, bamFile_name[0]))
+    return bam_files
+
+
+def bam_file_stats(bam_paths):
+    # path, size and modification time of every bam file; a folder lists its per-chromosome bam files
+    bam_stat = []
+    for bam_path in bam_paths:
+        if os.path.isfile(bam_path):
+            bam_files = [bam_path]
+        else:
+            bam_files = [
+                os.path.join(bam_path, f)
+                for f in sorted(os.listdir(bam_path))
+                if f.endswith(".bam")
+            ]
+        for bam_file in bam_files:
+            stat = os.stat(bam_file)
+            bam_stat.append([bam_file, stat.st_size, stat.st_mtime_ns])
+    return bam_stat
+
+
+def take_lock(lock_path):
+    # create lock_path holding the host, pid and time of this process; False if it exists
+    try:
+        fd = os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+    except FileExistsError:
+        return False
+    with os.fdopen(fd, "w") as file:
+        json.dump(
+            {"host": socket.gethostname(), "pid": os.getpid(), "time": time.time()},
+            file,
+        )
+    return True
+
+
+def lock_is_stale(lock_path, max_wait):
+    # a lock is stale when its process is gone from this host, or when it is older than max_wait seconds
+    try:
+        with open(lock_path) as file:
+            holder = json.load(file)
+    except FileNotFoundError:
+        return False
+    except ValueError:
+        # written by an older version or not written yet, judged by its age
+        try:
+            holder = {"time": os.path.getmtime(lock_path)}
+        except FileNotFoundError:
+            return False
+    if time.time() - holder.get("time", 0) > max_wait:
+        return True
+    if holder.get("host") == socket.gethostname():
+        try:
+            os.kill(holder["pid"], 0)
+        except ProcessLookupError:
+            return True
+        except PermissionError:
+            pass
+    return False
+
+
+def release_lock(lock_path):
+    try:
+        os.remove(lock_path)
+    except FileNotFoundError:
+        pass
+
+
+def count_region_reads(bam_files, chrom, regions):
+    # number of reads overlapping each (start, end) region of chrom, summed over bam files
+    counts = np.zeros(len(regions), dtype=np.int64)
+    for bam_file in bam_files:
+        with pysam.AlignmentFile(bam_file, "rb") as bamFilePysam:
+            if chrom not in bamFilePysam.references:
+                continue
+            for k, (start, end) in enumerate(regions):
+                counts[k] += bamFilePysam.count(chrom, start, end)
+    return counts
+
+
+def schedule_metagenes(MetaGenes, metagene_cost, total_jobs):
+    """
+    assign metagenes to jobs by longest-processing-time-first
+    MetaGenes: metagene names in genomic order
+    metagene_cost: {metagene: expected cost}
+    return: list of total_jobs lists of metagenes, each in genomic order
+    """
+    position = {meta_gene: k for k, meta_gene in enumerate(MetaGenes)}
+    # ties are broken by genomic position and job index so that every job computes the same split
+    MetaGenes_sorted = sorted(
+        MetaGenes,
+        key=lambda meta_gene: (-metagene_cost[meta_gene], position[meta_gene]),
+    )
+    jobs = [(0, job_index) for job_index in range(total_jobs)]
+    MetaGenes_jobs = [[] for _ in range(total_jobs)]
+    for meta_gene in MetaGenes_sorted:
+        load, job_index = heapq.heappop(jobs)
+        MetaGenes_jobs[job_index].append(meta_gene)
+        heapq.heappush(jobs, (load + metagene_cost[meta_gene], job_index))
+    return [
+        sorted(MetaGenes_job, key=lambda meta_gene: position[meta_gene])
+        for MetaGenes_job in MetaGenes_jobs
+    ]
+
+
+def json_default(o):
+    # numpy scalars in annotations are written as python numbers
+    if isinstance(o, np.generic):
+        return o.item()
+    raise TypeError(f"{type(o).__name__} is not JSON serializable")
+
+
+def read_manifest(manifest_folder):
+    """
+    metagenes recorded as completed by compatible matrix jobs
+    manifest_folder: folder of append-only .jsonl files, one line per completed metagene
+    return: {metagene: {key: record}}
+    """
+    done = {}
+    if not os.path.isdir(manifest_folder):
+        return done
+    for file_name in sorted(os.listdir(manifest_folder)):
+        if not file_name.endswith(".jsonl"):
+            continue
+        with open(os.path.join(manifest_folder, file_name)) as file:
+            for line in file:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue  # a line cut short by a preempted job
+                done.setdefault(record["metagene"], {})[record["key"]] = record
+    return done
+
+
+def sample_read_stream(reads, i):
+    # reads of sample i keyed by position, to be merged over samples with heapq.merge
+    for read in reads:
+        yield read.reference_start, i, read
+
+
+def locate_reads(qname_dict, reads, pacbio):
+    # look all reads of a metagene up in the read index at once, so that their lookups one by one are cache hits
+    if not isinstance(qname_dict, ReadIndexColumn):
+        return
+    if pacbio:
+        qnames = [
+            read.qname + "_" + str(read.reference_end - read.reference_start)
+            for read in reads
+        ]
+    else:
+        qnames = [read.qname for read in reads]
+    qname_dict.index.locate_many(qnames)
+
+
+class BamHandlePool:
+    def __init__(self, max_size=32):
+        """
+        per-process pool of open pysam.AlignmentFile handles with least-recently-used eviction
+        max_size: the maximum number of open bam files
+        """
+        self.max_size = max_size
+        self.handles = OrderedDict()
+
+    def __getstate__(self):
+        # open files cannot be shared with worker processes, each one opens its own
+        return {"max_size": self.max_size}
+
+    def __setstate__(self, state):
+        self.__init__(state["max_size"])
+
+    def __len__(self):
+        return len(self.handles)
+
+    def get(self, key, bam_file):
+        if key in self.handles:
+            self.handles.move_to_end(key)
+            return self.handles[key]
+        while len(self.handles) >= self.max_size:
+            _, bamFilePysam = self.handles.popitem(last=False)
+            bamFilePysam.close()
+        bamFilePysam = pysam.AlignmentFile(bam_file, "rb")
+        self.handles[key] = bamFilePysam
+        return bamFilePysam
+
+    def close(self):
+        while self.handles:
+            _, bamFilePysam = self.handles.popitem(last=False)
+            bamFilePysam.close()
 
 
 class ReadMapper:
@@ -303,11 +557,41 @@ class ReadMapper:
         truncation_match=0.4,
         platform="10x-ont",
         reference_gtf_path=None,
+        workers=1,
+        max_open_bams=32,
+        sweep=False,
+        sweep_gap=100000,
+        novel_backend="louvain",
+        seed=None,
+        resume=False,
+        compatible_format="csv",
         logger=None,
     ):
         self.logger = logger
         self.target = target
         self.bam_path = bam_path
+        self.workers = workers
+        # open bam files keyed by (sample, chromosome), at least one per sample stays open
+        self.bam_handles = BamHandlePool(max(max_open_bams, len(bam_path)))
+        self.bam_file_dict = {}
+        # stream reads of neighbouring metagenes once instead of fetching each metagene
+        self.sweep = sweep
+        self.sweep_gap = sweep_gap
+        self.metagene_region_dict = None
+        self.metagene_rank_dict = None
+        # community detection of novel isoforms: louvain or leiden
+        self.novel_backend = novel_backend
+        # global seed, each gene draws from its own stream derived from its gene ID
+        self.seed = seed
+        # skip metagenes recorded in the completion manifest with the same inputs and parameters
+        self.resume = resume
+        self.metagene_key_dict = {}
+        self.manifest_job_index = 0
+        self.manifest_path = None
+        # csv: one csv and one tsv file per gene; npz: one sparse npz and one tsv file per gene;
+        # h5: genes appended to one store per sample and process
+        self.compatible_format = compatible_format
+        self.compatible_stores = {}
         column_names = [
             "chromosome",
             "source",
@@ -349,6 +633,12 @@ class ReadMapper:
             os.path.join(target_, "reference/gene_annotations_scotch.gtf")
             for target_ in target
         ]
+        self.metagene_cost_path = os.path.join(
+            self.annotation_folder_path_list[0], "metagene_cost.pkl"
+        )
+        self.manifest_folder_path = os.path.join(
+            self.annotation_folder_path_list[0], "compatible_manifest"
+        )
         # bam information path
         self.bamInfo_folder_path_list = [
             os.path.join(target_, "bam") for target_ in target
@@ -365,6 +655,12 @@ class ReadMapper:
         self.bamInfo_csv_path_list = [
             os.path.join(target_, "bam/bam.Info.csv") for target_ in target
         ]
+        self.bamInfo_parquet_path_list = [
+            os.path.join(target_, "bam/bam.Info.parquet") for target_ in target
+        ]
+        self.bamInfo_index_path_list = [
+            os.path.join(target_, "bam/bam.Index") for target_ in target
+        ]
         # parameters
         self.small_exon_threshold = small_exon_threshold
         self.small_exon_threshold1 = small_exon_threshold1
@@ -383,24 +679,16 @@ class ReadMapper:
             self.read_mapping_path_list = [
                 os.path.join(target_, "auxillary") for target_ in target
             ]  # not for parse
-            self.qname_dict_list = [
-                load_pickle(bamInfo_pkl_path)
-                for bamInfo_pkl_path in self.bamInfo_pkl_path_list
-            ]
-            self.qname_cbumi_dict_list = [
-                load_pickle(bamInfo2_pkl_path)
-                for bamInfo2_pkl_path in self.bamInfo2_pkl_path_list
-            ]
+            bam_info_dicts = [self.load_bam_info_dicts(i) for i in range(len(target))]
+            self.qname_dict_list = [d[0] for d in bam_info_dicts]
+            self.qname_cbumi_dict_list = [d[1] for d in bam_info_dicts]
             self.sorted_bam_path_list = None
-            self.qname_sample_dict_list = [
-                load_pickle(bamInfo3_pkl_path)
-                for bamInfo3_pkl_path in self.bamInfo3_pkl_path_list
-            ]
+            self.qname_sample_dict_list = [d[2] for d in bam_info_dicts]
         else:
-            self.qname_dict = load_pickle(self.bamInfo_pkl_path_list[0])
-            self.qname_cbumi_dict = load_pickle(self.bamInfo2_pkl_path_list[0])
+            self.qname_dict, self.qname_cbumi_dict, self.qname_sample_dict = (
+                self.load_bam_info_dicts(0)
+            )
             self.sorted_bam_path = None
-            self.qname_sample_dict = load_pickle(self.bamInfo3_pkl_path_list[0])
         self.metageneStructureInformation = load_pickle(
             self.annotation_path_meta_gene_list[0]
         )
@@ -408,41 +696,373 @@ class ReadMapper:
             self.metageneStructureInformation.copy()
         )
 
+    def __getstate__(self):
+        # worker processes only map reads, leave the gtf annotation in the main process
+        state = self.__dict__.copy()
+        state.pop("gtf_df", None)
+        state.pop("gtf_df_job", None)
+        # every worker process writes its own manifest file and stores
+        state["manifest_path"] = None
+        state["compatible_stores"] = {}
+        return state
+
+    def load_bam_info_dicts(self, i):
+        # read-identity dictionaries of target i: the memory-mapped read index, pickles from the annotation step,
+        # or a read index built from the parquet bam information, which avoids expanding it into dictionaries
+        index_path = self.bamInfo_index_path_list[i]
+        if not read_index_exists(index_path):
+            if os.path.exists(index_path):
+                self.logger.info(
+                    f"read index at {index_path} is incomplete or older than the bam information files, not using it"
+                )
+            if os.path.isfile(self.bamInfo_pkl_path_list[i]) or not os.path.exists(
+                self.bamInfo_parquet_path_list[i]
+            ):
+                return (
+                    load_pickle(self.bamInfo_pkl_path_list[i]),
+                    load_pickle(self.bamInfo2_pkl_path_list[i]),
+                    load_pickle(self.bamInfo3_pkl_path_list[i]),
+                )
+            self.logger.info(
+                f"building read index at {index_path} from {self.bamInfo_parquet_path_list[i]}"
+            )
+            build_read_index(
+                load_bam_info_arrays(
+                    self.bamInfo_parquet_path_list[i], self.parse, self.pacbio
+                ),
+                index_path,
+            )
+        self.logger.info(f"using read index at {index_path}")
+        read_index = ReadIndex(index_path)
+        return (
+            read_index.qname_dict(),
+            read_index.qname_cbumi_dict(),
+            read_index.qname_sample_dict(),
+        )
+
+    def use_read_index(self):
+        # worker processes open the memory-mapped read index instead of receiving copies of the read dictionaries;
+        # an index is built from the dictionaries loaded from the bam.Info pickles or parquet when there is none
+        if self.parse:
+            dicts_list = [(self.qname_dict, self.qname_cbumi_dict, self.qname_sample_dict)]
+        else:
+            dicts_list = list(
+                zip(
+                    self.qname_dict_list,
+                    self.qname_cbumi_dict_list,
+                    self.qname_sample_dict_list,
+                )
+            )
+        index_dicts_list = []
+        for i, dicts in enumerate(dicts_list):
+            if isinstance(dicts[0], ReadIndexColumn):
+                index_dicts_list.append(dicts)
+                continue
+            if not read_index_exists(self.bamInfo_index_path_list[i]):
+                self.logger.info(
+                    f"building read index at {self.bamInfo_index_path_list[i]}"
+                )
+                build_read_index(
+                    read_index_arrays(*dicts), self.bamInfo_index_path_list[i]
+                )
+            read_index = ReadIndex(self.bamInfo_index_path_list[i])
+            index_dicts_list.append(
+                (
+                    read_index.qname_dict(),
+                    read_index.qname_cbumi_dict(),
+                    read_index.qname_sample_dict(),
+                )
+            )
+        if self.parse:
+            self.qname_dict, self.qname_cbumi_dict, self.qname_sample_dict = (
+                index_dicts_list[0]
+            )
+        else:
+            self.qname_dict_list = [d[0] for d in index_dicts_list]
+            self.qname_cbumi_dict_list = [d[1] for d in index_dicts_list]
+            self.qname_sample_dict_list = [d[2] for d in index_dicts_list]
+
+    def metagene_cost_key(self):
+        # the cached costs are valid for the same bam files (path, size, modification time) and annotation
+        annotation = json.dumps(
+            self.metageneStructureInformation, sort_keys=True, default=json_default
+        )
+        return {
+            "bam": bam_file_stats(self.bam_path),
+            "annotation": hashlib.sha256(annotation.encode()).hexdigest(),
+        }
+
+    def load_metagene_cost(self, key):
+        # cached costs with the given key, None if missing or stale
+        if os.path.isfile(self.metagene_cost_path):
+            metagene_cost = load_pickle(self.metagene_cost_path)
+            if metagene_cost.get("key") == key:
+                return metagene_cost["cost"]
+        return None
+
+    def estimate_metagene_cost(self, poll_interval=10, max_wait=3600):
+        # expected cost of each metagene: reads in its region times its number of genes, cached in the reference folder;
+        # the first job to take the lock file counts and the other array jobs wait for its cache. The count is
+        # deterministic, so a job that waited max_wait seconds, or finds the lock of a dead job, counts by itself
+        key = self.metagene_cost_key()
+        lock_path = self.metagene_cost_path + ".lock"
+        wait_start = time.time()
+        locked, waiting = False, False
+        while True:
+            metagene_cost = self.load_metagene_cost(key)
+            if metagene_cost is not None:
+                return metagene_cost
+            locked = take_lock(lock_path)
+            if locked:
+                break
+            if lock_is_stale(lock_path, max_wait):
+                self.logger.info(f"removing stale lock {lock_path}")
+                release_lock(lock_path)
+                continue
+            if time.time() - wait_start > max_wait:
+                self.logger.info(
+                    f"metagene costs not ready after {max_wait} s, counting in this job"
+                )
+                break
+            if not waiting:
+                self.logger.info(
+                    f"waiting up to {max_wait} s for metagene costs at "
+                    f"{self.metagene_cost_path}"
+                )
+                waiting = True
+            time.sleep(poll_interval)
+        try:
+            metagene_cost = self.load_metagene_cost(key)
+            if metagene_cost is None:
+                metagene_cost = self.count_metagene_cost()
+                cost_path_tmp = (
+                    self.metagene_cost_path + "." + str(os.getpid()) + ".tmp"
+                )
+                with open(cost_path_tmp, "wb") as file:
+                    pickle.dump({"key": key, "cost": metagene_cost}, file)
+                os.replace(cost_path_tmp, self.metagene_cost_path)
+        finally:
+            if locked:
+                release_lock(lock_path)
+        return metagene_cost
+
+    def count_metagene_cost(self):
+        self.logger.info("counting reads of metagenes for job scheduling")
+        regions_chrom = {}
+        for meta_gene, genes_info in self.metageneStructureInformation.items():
+            chrom = genes_info[0][0]["geneChr"]
+            start = min(gene_info[0]["geneStart"] for gene_info in genes_info)
+            end = max(gene_info[0]["geneEnd"] for gene_info in genes_info)
+            regions_chrom.setdefault(chrom, []).append((meta_gene, start, end))
+        chroms = sorted(regions_chrom.keys())
+        counts_list = Parallel(n_jobs=self.workers)(
+            delayed(count_region_reads)(
+                find_bam_files(self.bam_path, chrom),
+                chrom,
+                [(start, end) for _, start, end in regions_chrom[chrom]],
+            )
+            for chrom in chroms
+        )
+        metagene_cost = {}
+        for chrom, counts in zip(chroms, counts_list):
+            for (meta_gene, _, _), n_reads in zip(regions_chrom[chrom], counts):
+                metagene_cost[meta_gene] = (int(n_reads) + 1) * len(
+                    self.metageneStructureInformation[meta_gene]
+                )
+        return metagene_cost
+
+    def parameter_hash(self):
+        # hash of the mapping parameters and of the bam files, identified by path, size and modification time;
+        # a bam folder is identified by each of its per-chromosome bam files
+        parameters = {
+            "target": list(self.target),
+            "bam": bam_file_stats(self.bam_path),
+            "lowest_match": self.lowest_match,
+            "lowest_match1": self.lowest_match1,
+            "small_exon_threshold": self.small_exon_threshold,
+            "small_exon_threshold1": self.small_exon_threshold1,
+            "truncation_match": self.truncation_match,
+            "platform": self.platform,
+            "novel_backend": self.novel_backend,
+            "seed": self.seed,
+            "compatible_format": self.compatible_format,
+        }
+        parameters = json.dumps(parameters, sort_keys=True, default=json_default)
+        return hashlib.sha256(parameters.encode()).hexdigest()
+
+    def metagene_keys(self, meta_genes):
+        # completion key of each metagene: the parameter hash and the metagene annotation
+        parameter_hash = self.parameter_hash()
+        metagene_key_dict = {}
+        for meta_gene in meta_genes:
+            annotation = json.dumps(
+                self.metageneStructureInformation[meta_gene],
+                sort_keys=True,
+                default=json_default,
+            )
+            metagene_key_dict[meta_gene] = hashlib.sha256(
+                (parameter_hash + annotation).encode()
+            ).hexdigest()
+        return metagene_key_dict
+
+    def compatible_store(self, sample_target):
+        # store of the sample written by this process, None when saving csv files
+        if self.compatible_format != "h5":
+            return None
+        if sample_target not in self.compatible_stores:
+            self.compatible_stores[sample_target] = CompatibleStoreWriter(
+                os.path.join(sample_target, "compatible_matrix")
+            )
+        return self.compatible_stores[sample_target]
+
+    def close_compatible_stores(self):
+        for store in self.compatible_stores.values():
+            store.close()
+        self.compatible_stores = {}
+
+    def gene_output_files(self, meta_gene):
+        # per-gene compatible matrix and read-isoform mapping files of the genes of a metagene, in all samples
+        if self.parse:
+            samples_folder = os.path.join(self.target[0], "samples")
+            sample_targets = (
+                [
+                    os.path.join(samples_folder, sample)
+                    for sample in sorted(os.listdir(samples_folder))
+                ]
+                if os.path.isdir(samples_folder)
+                else []
+            )
+        else:
+            sample_targets = self.target
+        paths = []
+        for geneInfo, _, _ in self.metageneStructureInformation[meta_gene]:
+            gene = geneInfo["geneName"].replace("/", ".") + "_" + geneInfo["geneID"]
+            for sample_target in sample_targets:
+                paths += [
+                    os.path.join(sample_target, "compatible_matrix", gene + ".csv"),
+                    os.path.join(sample_target, "compatible_matrix", gene + ".npz"),
+                    os.path.join(
+                        sample_target,
+                        "auxillary",
+                        gene + "_read_isoform_exon_mapping.tsv",
+                    ),
+                ]
+        return [path for path in paths if os.path.isfile(path)]
+
+    def record_metagene(self, meta_gene):
+        # append a completed metagene and its annotation with novel isoforms to the manifest of this job and process
+        if self.manifest_path is None:
+            os.makedirs(self.manifest_folder_path, exist_ok=True)
+            self.manifest_path = os.path.join(
+                self.manifest_folder_path,
+                f"job{self.manifest_job_index}_{os.getpid()}_{time.time_ns()}.jsonl",
+            )
+        # genes in stores are on disk once flushed; stores are checked on resume
+        for store in self.compatible_stores.values():
+            store.flush()
+        record = {
+            "metagene": meta_gene,
+            "key": self.metagene_key_dict[meta_gene],
+            "annotation": self.metageneStructureInformationwNovel[meta_gene],
+            "stores": [
+                store.path
+                for store in self.compatible_stores.values()
+                if store.path is not None
+            ],
+            # per-gene csv/npz/tsv files are checked on resume as well
+            "files": self.gene_output_files(meta_gene),
+        }
+        with open(self.manifest_path, "a") as file:
+            file.write(json.dumps(record, default=json_default) + "\n")
+
+    def completed_metagenes(self, meta_genes):
+        """
+        split metagenes into those recorded in the manifest with the same key and outputs, and those to map
+        the annotation with novel isoforms of completed metagenes is restored from the manifest
+        """
+        self.metagene_key_dict = self.metagene_keys(meta_genes)
+        manifest = read_manifest(self.manifest_folder_path)
+        store_readable = {}
+        MetaGenes_done, MetaGenes_todo = [], []
+        for meta_gene in meta_genes:
+            record = manifest.get(meta_gene, {}).get(self.metagene_key_dict[meta_gene])
+            # genes of the metagene must still be readable from the stores they were appended to
+            for path in [] if record is None else record.get("stores", []):
+                if path not in store_readable:
+                    store_readable[path] = compatible_store_readable(path)
+                if not store_readable[path]:
+                    record = None
+                    break
+            # and their per-gene files must still exist
+            if record is not None and not all(
+                os.path.isfile(path) for path in record.get("files", [])
+            ):
+                record = None
+            if record is None:
+                MetaGenes_todo.append(meta_gene)
+                continue
+            # completed with the same inputs: restore the annotation with novel isoforms
+            self.metageneStructureInformationwNovel[meta_gene] = [
+                [geneInfo, [tuple(exon) for exon in exonInfo], isoformInfo]
+                for geneInfo, exonInfo, isoformInfo in record["annotation"]
+            ]
+            MetaGenes_done.append(meta_gene)
+        return MetaGenes_done, MetaGenes_todo
+
+    def find_bam_file(self, i, chrom=None):
+        # bam file of sample i holding reads of chrom, the folder listing is looked up once per chromosome
+        key = (i, chrom)
+        if key not in self.bam_file_dict:
+            bam_path = self.bam_path[i]
+            if os.path.isfile(bam_path):
+                # If it's a BAM file path, read it directly
+                bamFile = bam_path
+            elif chrom is not None:
+                # If it's a folder, find the BAM file based on chrom
+                bamFile_name = [
+                    f
+                    for f in os.listdir(bam_path)
+                    if f.endswith(".bam") and "." + chrom + "." in f
+                ]
+                bamFile = (
+                    os.path.join(bam_path, bamFile_name[0]) if bamFile_name else None
+                )
+            else:
+                # read the merged bam file, has to run merge_bam first
+                bamFile = self.sorted_bam_path
+            self.bam_file_dict[key] = bamFile
+        return self.bam_file_dict[key]
+
     def read_bam(self, chrom=None):
         # if parse: the input length is 1
-        # bam_path is a folder
+        # handles stay open in self.bam_handles and are reused by later metagenes
         bamFilePysam_list = []
-        for bam_path in self.bam_path:
-            if (
-                os.path.isfile(bam_path) == False
-            ):  # If it's a folder, find the BAM file based on chrom
-                if chrom is not None:
-                    bamFile_name = [
-                        f
-                        for f in os.listdir(bam_path)
-                        if f.endswith(".bam") and "." + chrom + "." in f
-                    ]
-                    if bamFile_name:  # Ensure a matching BAM file is found
-                        bamFile = os.path.join(bam_path, bamFile_name[0])  # Not .bai
-                        bamFilePysam = pysam.Samfile(bamFile, "rb")
-                        bamFilePysam_list.append(bamFilePysam)
-                else:
-                    # read the merged bam file, has to run merge_bam first
-                    bamFilePysam = pysam.Samfile(self.sorted_bam_path, "rb")
-                    bamFilePysam_list.append(bamFilePysam)
-            else:
-                # If it's a BAM file path, read it directly
-                bamFilePysam = pysam.Samfile(bam_path, "rb")
-                bamFilePysam_list.append(bamFilePysam)
+        for i in range(len(self.bam_path)):
+            bamFile = self.find_bam_file(i, chrom)
+            if bamFile is not None:  # Ensure a matching BAM file is found
+                bamFilePysam_list.append(self.bam_handles.get((i, chrom), bamFile))
         if self.parse:
             bamFilePysam_list = bamFilePysam_list[0]  # not a list
         return bamFilePysam_list
 
-    def map_reads(self, meta_gene, save=True):
+    def map_reads(self, meta_gene, save=True, reads_by_sample=None):
+        # reads_by_sample: reads of the metagene for each sample, fetched from the bam files if None
         self.logger.info("STARTING mapping reads")
         Info_multigenes = copy.deepcopy(self.metageneStructureInformation[meta_gene])
         Info_multigenes = sort_multigeneInfo(Info_multigenes)
-        bamFilePysams = self.read_bam(chrom=Info_multigenes[0][0]["geneChr"])
+        # isoform matrices of each gene, compiled once for all reads of the metagene
+        models = [
+            GeneModel(
+                Info_singlegene, self.small_exon_threshold, self.small_exon_threshold1
+            )
+            for Info_singlegene in Info_multigenes
+        ]
+        if reads_by_sample is None:
+            geneChr, start, end = summarise_metagene(Info_multigenes)
+            bamFilePysams = self.read_bam(chrom=geneChr)
+            reads_by_sample = [
+                bamFilePysam.fetch(geneChr, start, end) for bamFilePysam in bamFilePysams
+            ]
         if len(Info_multigenes) == 1:
             Info_singlegene = Info_multigenes[0]
             geneInfo, exonInfo, isoformInfo = Info_singlegene
@@ -452,43 +1072,47 @@ class ReadMapper:
             Read_knownIsoform_scores = {}  # [readname: read-isoform mapping scores]
             novel_isoformInfo = {}  # {'novelIsoform_1234':[2,3,4]}
             qname_sample_dict = {}
-            for i, bamFilePysam in enumerate(bamFilePysams):
+            # collect read-exon mappings of all reads first, then assign them to isoforms in one batch
+            profiles = []
+            for i, reads in enumerate(reads_by_sample):
                 sample = "sample" + str(i)
-                reads = bamFilePysam.fetch(
-                    geneInfo["geneChr"], geneInfo["geneStart"], geneInfo["geneEnd"]
-                )
                 self.logger.info(i)
-                if i not in self.qname_dict_list:
+                if i >= len(self.qname_dict_list):
                     # Toniher: We skip if not found
                     continue
+                reads = list(reads)
+                locate_reads(self.qname_dict_list[i], reads, self.pacbio)
                 for read in reads:
                     readName, readStart, readEnd = (
                         read.qname,
                         read.reference_start,
                         read.reference_end,
                     )
-                    result = process_read(
+                    profile = process_read_profile(
                         read,
                         self.qname_dict_list[i],
                         self.lowest_match,
                         self.lowest_match1,
-                        self.small_exon_threshold,
-                        self.small_exon_threshold1,
                         self.truncation_match,
                         Info_singlegene,
+                        models[0],
                         self.parse,
                         self.pacbio,
                     )
-                    if result is not None:
+                    if profile is not None:
                         if self.pacbio:
                             readName = readName + "_" + str(readEnd - readStart)
                         qname_sample_dict[readName] = sample
-                    result_novel, result_known, result_known_scores = result
-                    if result_novel is not None:
-                        Read_novelIsoform.append(result_novel)
-                    if result_known is not None:
-                        Read_knownIsoform.append(result_known)
-                        Read_knownIsoform_scores[result_known[0]] = result_known_scores
+                        profiles.append(profile)
+            results = assign_reads_to_gene(
+                profiles, models[0], self.lowest_match, self.lowest_match1
+            )
+            for result_novel, result_known, result_known_scores in results:
+                if result_novel is not None:
+                    Read_novelIsoform.append(result_novel)
+                if result_known is not None:
+                    Read_knownIsoform.append(result_known)
+                    Read_knownIsoform_scores[result_known[0]] = result_known_scores
             # expand uncategorized novel reads into Read_knownIsoform
             if len(Read_novelIsoform) > 0:
                 # novel_isoformInfo_polished: novel isoform annotation: {'novelIsoform_7':[0,1,2]}
@@ -503,6 +1127,8 @@ class ReadMapper:
                     exonInfo,
                     self.small_exon_threshold,
                     self.small_exon_threshold1,
+                    novel_backend=self.novel_backend,
+                    seed=gene_seed(self.seed, geneInfo["geneID"]),
                 )
             else:
                 (
@@ -564,6 +1190,8 @@ class ReadMapper:
                         self.metageneStructureInformationwNovel[meta_gene][0][2],
                         sample_target,
                         self.parse,
+                        store=self.compatible_store(sample_target),
+                        sparse=self.compatible_format == "npz",
                     )
                 else:
                     self.loggger.info("SAMPLE LIST - NOT SAVING")
@@ -588,16 +1216,15 @@ class ReadMapper:
             qname_sample_dict = {}
             results = []
             # self.logger.info(self.qname_dict_list)
-            for i, bamFilePysam in enumerate(bamFilePysams):
-                reads = bamFilePysam.fetch(
-                    geneChr, start, end
-                )  # fetch reads within meta gene region
+            for i, reads in enumerate(reads_by_sample):
                 # process reads metagene
                 self.logger.info(i)
-                if i not in self.qname_dict_list:
+                if i >= len(self.qname_dict_list):
                     # Toniher: Skip if not key
                     self.logger.info("MISSING KEY " + str(i))
                     continue
+                reads = list(reads)
+                locate_reads(self.qname_dict_list[i], reads, self.pacbio)
                 for read in reads:
                     readName, readStart, readEnd = (
                         read.qname,
@@ -615,6 +1242,7 @@ class ReadMapper:
                         self.truncation_match,
                         self.parse,
                         self.pacbio,
+                        models,
                     )
                     if out is not None:  # may not within this meta gene region
                         results.append(out)
@@ -654,6 +1282,8 @@ class ReadMapper:
                         isoformInfo=None,
                         output_folder=sample_target,
                         parse=self.parse,
+                        store=self.compatible_store(sample_target),
+                        sparse=self.compatible_format == "npz",
                     )
             # save compatible matrix by genes
             return_list = []
@@ -688,6 +1318,8 @@ class ReadMapper:
                         Info_multigenes[index][1],
                         self.small_exon_threshold,
                         self.small_exon_threshold1,
+                        novel_backend=self.novel_backend,
+                        seed=gene_seed(self.seed, Info_multigenes[index][0]["geneID"]),
                     )
                 else:
                     (
@@ -753,6 +1385,8 @@ class ReadMapper:
                             ],
                             sample_target,
                             self.parse,
+                            store=self.compatible_store(sample_target),
+                            sparse=self.compatible_format == "npz",
                         )
                     else:
                         return_list.append(
@@ -770,38 +1404,54 @@ class ReadMapper:
             if save == False:
                 return return_list
 
-    def map_reads_parse(self, meta_gene, save=True):
+    def map_reads_parse(self, meta_gene, save=True, reads=None):
+        # reads: reads of the metagene, fetched from the bam file if None
         Info_multigenes = copy.deepcopy(self.metageneStructureInformation[meta_gene])
         Info_multigenes = sort_multigeneInfo(Info_multigenes)
-        bamFilePysam = self.read_bam()
+        # isoform matrices of each gene, compiled once for all reads of the metagene
+        models = [
+            GeneModel(
+                Info_singlegene, self.small_exon_threshold, self.small_exon_threshold1
+            )
+            for Info_singlegene in Info_multigenes
+        ]
+        if reads is None:
+            # a bam folder is read from the file of the metagene chromosome, as in map_reads
+            geneChr, start, end = summarise_metagene(Info_multigenes)
+            bamFilePysam = self.read_bam(chrom=geneChr)
+            reads = bamFilePysam.fetch(geneChr, start, end)
+        reads = list(reads)
+        locate_reads(self.qname_dict, reads, self.pacbio)
         if len(Info_multigenes) == 1:
             Info_singlegene = Info_multigenes[0]
             geneInfo, exonInfo, isoformInfo = Info_singlegene
             n_isoforms = len(isoformInfo)
-            reads = bamFilePysam.fetch(
-                geneInfo["geneChr"], geneInfo["geneStart"], geneInfo["geneEnd"]
-            )
             Read_novelIsoform = []  # [('read name',[read-exon percentage],[read-exon mapping])]
             Read_knownIsoform = []  # [('read name',[read-isoform mapping])]
             Read_knownIsoform_scores = {}
             novel_isoformInfo = {}  # {'novelIsoform_1234':[2,3,4]}
             samples_list = []
+            # collect read-exon mappings of all reads first, then assign them to isoforms in one batch
+            profiles = []
             for read in reads:
-                poly, _ = detect_poly_parse(read, window=20, n=15)
-                result = process_read(
+                profile = process_read_profile(
                     read,
                     self.qname_dict,
                     self.lowest_match,
                     self.lowest_match1,
-                    self.small_exon_threshold,
-                    self.small_exon_threshold1,
                     self.truncation_match,
                     Info_singlegene,
+                    models[0],
                     self.parse,
                     self.pacbio,
                 )
-                result_novel, result_known, result_known_scores = result
                 samples_list.append(self.qname_sample_dict[read.qname])
+                if profile is not None:
+                    profiles.append(profile)
+            results = assign_reads_to_gene(
+                profiles, models[0], self.lowest_match, self.lowest_match1
+            )
+            for result_novel, result_known, result_known_scores in results:
                 if result_novel is not None:
                     Read_novelIsoform.append(result_novel)
                 if result_known is not None:
@@ -822,6 +1472,8 @@ class ReadMapper:
                     exonInfo,
                     self.small_exon_threshold,
                     self.small_exon_threshold1,
+                    novel_backend=self.novel_backend,
+                    seed=gene_seed(self.seed, geneInfo["geneID"]),
                 )
             else:
                 (
@@ -882,6 +1534,8 @@ class ReadMapper:
                         self.metageneStructureInformationwNovel[meta_gene][0][2],
                         sample_target,
                         self.parse,
+                        store=self.compatible_store(sample_target),
+                        sparse=self.compatible_format == "npz",
                     )
                 else:
                     return_sample = {
@@ -898,12 +1552,6 @@ class ReadMapper:
             if save == False:
                 return return_samples
         else:
-            geneChr, start, end = summarise_metagene(
-                Info_multigenes
-            )  # geneChr, start, end
-            reads = bamFilePysam.fetch(
-                geneChr, start, end
-            )  # fetch reads within meta gene region
             # process reads metagene
             results, samples, polies = [], [], []
             for read in reads:
@@ -919,6 +1567,7 @@ class ReadMapper:
                     self.truncation_match,
                     self.parse,
                     self.pacbio,
+                    models,
                 )
                 if out is not None:  # may not within this meta gene region
                     polies.append(poly)
@@ -961,6 +1610,8 @@ class ReadMapper:
                         isoformInfo=None,
                         output_folder=sample_target,
                         parse=self.parse,
+                        store=self.compatible_store(sample_target),
+                        sparse=self.compatible_format == "npz",
                     )
             return_samples = []
             for index in unique_ind:  # loop gene
@@ -994,6 +1645,8 @@ class ReadMapper:
                         Info_multigenes[index][1],
                         self.small_exon_threshold,
                         self.small_exon_threshold1,
+                        novel_backend=self.novel_backend,
+                        seed=gene_seed(self.seed, Info_multigenes[index][0]["geneID"]),
                     )
                 else:
                     (
@@ -1062,6 +1715,8 @@ class ReadMapper:
                             ],
                             sample_target,
                             self.parse,
+                            store=self.compatible_store(sample_target),
+                            sparse=self.compatible_format == "npz",
                         )
                 else:
                     for sample in unique_samples:
@@ -1093,8 +1748,127 @@ class ReadMapper:
             if save == False:
                 return return_samples
 
+    def metagene_regions(self):
+        # {metagene: (chrom, start, end)} of all metagenes and their rank in genomic order
+        if self.metagene_region_dict is None:
+            self.metagene_region_dict = {
+                meta_gene: summarise_metagene(Info_multigenes)
+                for meta_gene, Info_multigenes in self.metageneStructureInformation.items()
+            }
+            self.metagene_rank_dict = {
+                meta_gene: k
+                for k, meta_gene in enumerate(
+                    sorted(
+                        self.metagene_region_dict, key=self.metagene_region_dict.get
+                    )
+                )
+            }
+        return self.metagene_region_dict, self.metagene_rank_dict
+
+    def sweep_windows(self, meta_genes):
+        """
+        group metagenes into windows whose reads are streamed once
+        consecutive metagenes in genomic order join a window when no metagene of another job lies between them and the gap is at most self.sweep_gap
+        """
+        regions, rank = self.metagene_regions()
+        windows, window_end = [], None
+        for meta_gene in sorted(meta_genes, key=rank.get):
+            chrom, start, end = regions[meta_gene]
+            if (
+                len(windows) > 0
+                and regions[windows[-1][-1]][0] == chrom
+                and rank[meta_gene] == rank[windows[-1][-1]] + 1
+                and start - window_end <= self.sweep_gap
+            ):
+                windows[-1].append(meta_gene)
+                window_end = max(window_end, end)
+            else:
+                windows.append([meta_gene])
+                window_end = end
+        return windows
+
+    def sweep_reads(self, window):
+        """
+        stream the reads of a window of metagenes once in coordinate order, merged over samples
+        each read goes to every metagene it overlaps, as bamFilePysam.fetch of the metagene region would return it
+        yield: (metagene, reads of the metagene for each sample) as soon as no later read can overlap the metagene
+        """
+        regions, _ = self.metagene_regions()
+        chrom = regions[window[0]][0]
+        start = min(regions[meta_gene][1] for meta_gene in window)
+        end = max(regions[meta_gene][2] for meta_gene in window)
+        streams = []
+        for i in range(len(self.bam_path)):
+            bamFile = self.find_bam_file(i, chrom)
+            if bamFile is not None:
+                bamFilePysam = self.bam_handles.get((i, chrom), bamFile)
+                streams.append(
+                    sample_read_stream(bamFilePysam.fetch(chrom, start, end), i)
+                )
+        pending = sorted(window, key=lambda meta_gene: regions[meta_gene][1])
+        n_pending = 0
+        active = {}  # {metagene: [[reads of sample 0], [reads of sample 1], ...]}
+        for read_start, i, read in heapq.merge(*streams):
+            read_end = read.reference_end
+            if read_end is None:
+                read_end = read_start + 1
+            for meta_gene in [m for m in active if regions[m][2] <= read_start]:
+                yield meta_gene, active.pop(meta_gene)
+            while (
+                n_pending < len(pending) and regions[pending[n_pending]][1] < read_end
+            ):
+                active[pending[n_pending]] = [[] for _ in range(len(self.bam_path))]
+                n_pending += 1
+            for meta_gene, reads_by_sample in active.items():
+                if (
+                    regions[meta_gene][1] < read_end
+                    and regions[meta_gene][2] > read_start
+                ):
+                    reads_by_sample[i].append(read)
+        for meta_gene in list(active.keys()):
+            yield meta_gene, active.pop(meta_gene)
+        for meta_gene in pending[n_pending:]:
+            yield meta_gene, [[] for _ in range(len(self.bam_path))]
+
+    def map_reads_metagenes(self, meta_genes):
+        # map reads of a list of metagenes, return their annotations with novel isoforms
+        if self.sweep:
+            for window in self.sweep_windows(meta_genes):
+                for meta_gene, reads_by_sample in self.sweep_reads(window):
+                    print(meta_gene)
+                    if self.parse:
+                        self.map_reads_parse(
+                            meta_gene, save=True, reads=reads_by_sample[0]
+                        )
+                    else:
+                        self.map_reads(
+                            meta_gene, save=True, reads_by_sample=reads_by_sample
+                        )
+                    if self.resume:
+                        self.record_metagene(meta_gene)
+        else:
+            for meta_gene in meta_genes:
+                print(meta_gene)
+                if self.parse:
+                    self.map_reads_parse(meta_gene, save=True)
+                else:
+                    self.map_reads(meta_gene, save=True)
+                if self.resume:
+                    self.record_metagene(meta_gene)
+        self.bam_handles.close()
+        self.close_compatible_stores()
+        return {
+            meta_gene: self.metageneStructureInformationwNovel[meta_gene]
+            for meta_gene in meta_genes
+        }
+
     def map_reads_allgenes(
-        self, cover_existing=True, total_jobs=1, current_job_index=0, logger=None
+        self,
+        cover_existing=True,
+        total_jobs=1,
+        current_job_index=0,
+        schedule="contiguous",
+        logger=None,
     ):
         if self.parse == False:
             for (
@@ -1103,14 +1877,27 @@ class ReadMapper:
                 if not os.path.exists(compatible_matrix_folder_path):
                     os.makedirs(compatible_matrix_folder_path, exist_ok=True)
         MetaGenes = list(self.metageneStructureInformation.keys())  # all meta genes
-        if total_jobs > 1:
+        metagene_cost = None
+        if schedule == "balanced":
+            metagene_cost = self.estimate_metagene_cost()
+        if total_jobs > 1 and metagene_cost is not None:
+            MetaGenes_job = schedule_metagenes(MetaGenes, metagene_cost, total_jobs)[
+                current_job_index
+            ]
+        elif total_jobs > 1:
             step_size = math.ceil(len(MetaGenes) / total_jobs)
             s = int(list(range(0, len(MetaGenes), step_size))[current_job_index])
             e = int(s + step_size)
             MetaGenes_job = MetaGenes[s:e]
         else:  # total_jobs = 1
             MetaGenes_job = MetaGenes
-        if cover_existing:
+        if cover_existing and self.resume:
+            print(
+                "Metagenes recorded as completed in the manifest, with their files, are skipped; "
+                "existing compatible matrix files of other genes will be overwritten"
+            )
+            genes_existing = []
+        elif cover_existing:
             print(
                 "If there are existing compatible matrix files, SCOTCH will overwrite them"
             )
@@ -1130,25 +1917,33 @@ class ReadMapper:
                     file[:-4]
                     for folder_path in self.compatible_matrix_folder_paths
                     for file in os.listdir(folder_path)
-                    if file.endswith(".csv")
+                    if file.endswith((".csv", ".npz"))
                 ]
                 for folder_path in self.compatible_matrix_folder_paths:
                     log_file_path = os.path.join(folder_path, "log.txt")
                     if os.path.isfile(log_file_path):
                         gene_df = pd.read_csv(log_file_path, header=None)
                         genes_existing += gene_df.iloc[:, 0].tolist()
+                    if compatible_store_paths(folder_path):
+                        store = CompatibleStore(folder_path)
+                        genes_existing += store.genes() + store.logged
+                        store.close()
             else:
                 genes_existing = [
                     file[:-4]
                     for folder_path in self.compatible_matrix_folder_path_list
                     for file in os.listdir(folder_path)
-                    if file.endswith(".csv")
+                    if file.endswith((".csv", ".npz"))
                 ]
                 for folder_path in self.compatible_matrix_folder_path_list:
                     log_file_path = os.path.join(folder_path, "log.txt")
                     if os.path.isfile(log_file_path):
                         gene_df = pd.read_csv(log_file_path, header=None)
                         genes_existing += gene_df.iloc[:, 0].tolist()
+                    if compatible_store_paths(folder_path):
+                        store = CompatibleStore(folder_path)
+                        genes_existing += store.genes() + store.logged
+                        store.close()
             print("there exist " + str(len(set(genes_existing))) + " genes")
         MetaGene_Gene_dict = {}
         for metagene_name, genes_info in self.metageneStructureInformation.items():
@@ -1165,20 +1960,44 @@ class ReadMapper:
                 if len(genes_) > 0:
                     MetaGene_Gene_dict[metagene_name] = genes_
         MetaGenes_job = list(MetaGene_Gene_dict.keys())
+        MetaGenes_done = []
+        if self.resume:
+            self.manifest_job_index = current_job_index
+            MetaGenes_done, MetaGenes_todo = self.completed_metagenes(MetaGenes_job)
+            self.logger.info(
+                f"{str(len(MetaGenes_done))} metagenes for job {current_job_index} completed in a previous run"
+            )
+            MetaGenes_job = MetaGenes_todo
         self.logger.info(
             f"{str(len(MetaGenes_job))} metagenes for job {current_job_index}"
         )
         # print('processing ' + str(len(MetaGenes_job)) + ' metagenes for this job')
-        if self.parse:
-            for meta_gene in MetaGenes_job:
-                print(meta_gene)
-                self.map_reads_parse(meta_gene, save=True)
+        if self.workers > 1 and len(MetaGenes_job) > 1:
+            n_workers = min(self.workers, len(MetaGenes_job))
+            self.logger.info(
+                f"mapping reads of job {current_job_index} with {n_workers} workers"
+            )
+            if metagene_cost is None:
+                metagene_cost = {
+                    meta_gene: len(self.metageneStructureInformation[meta_gene])
+                    for meta_gene in MetaGenes_job
+                }
+            MetaGenes_workers = schedule_metagenes(
+                MetaGenes_job, metagene_cost, n_workers
+            )
+            self.use_read_index()
+            results = Parallel(n_jobs=n_workers)(
+                delayed(self.map_reads_metagenes)(meta_genes)
+                for meta_genes in MetaGenes_workers
+            )
+            # merge novel isoform annotations found by each worker
+            for result in results:
+                self.metageneStructureInformationwNovel.update(result)
         else:
-            for meta_gene in MetaGenes_job:
-                print(meta_gene)
-                self.map_reads(meta_gene, save=True)
+            self.map_reads_metagenes(MetaGenes_job)
+        MetaGenes_job_set = set(MetaGenes_job + MetaGenes_done)
         for key in MetaGenes:
-            if key not in MetaGenes_job:
+            if key not in MetaGenes_job_set:
                 del self.metageneStructureInformationwNovel[key]
         gene_ids = [
             g_name_id.split("_")[1]
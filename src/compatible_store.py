@@ -0,0 +1,393 @@
+import os
+import time
+
+import numpy as np
+import pandas as pd
+from scipy.sparse import coo_matrix, csr_matrix
+
+######################################################################
+#######################compatible matrix store########################
+######################################################################
+
+# every writing process appends the genes it maps to its own HDF5 file in compatible_matrix/,
+# so a sample holds one file per job and worker instead of one csv and one tsv per gene
+COMPATIBLE_STORE_PREFIX = "compatible_"
+COMPATIBLE_STORE_SUFFIX = ".h5"
+COMPATIBLE_STORE_CHUNK = 4096
+# gene offset index: position and length of every gene in the row, column, entry and mapping arrays
+GENE_INDEX_COLUMNS = [
+    "row_start",
+    "n_rows",
+    "col_start",
+    "n_cols",
+    "entry_start",
+    "n_entries",
+    "mapping_start",
+    "n_mapping",
+]
+MAPPING_COLUMNS = [
+    "Read",
+    "Isoform",
+    "Exon Index",
+    "Exon Coordinates",
+    "Cell",
+    "Umi",
+    "CBUMI",
+    "geneName",
+    "geneID",
+    "geneChr",
+]
+
+
+def save_compatible_npz(path, rowNames, colNames, mat):
+    # sparse read x isoform compatible matrix with its labels, in place of the dense csv file
+    mat = coo_matrix(np.asarray(mat).reshape(len(rowNames), len(colNames)))
+    np.savez_compressed(
+        path,
+        row=mat.row.astype(np.int32),
+        col=mat.col.astype(np.int32),
+        value=mat.data.astype(np.int8),
+        rowNames=np.asarray(rowNames, dtype=str),
+        colNames=np.asarray(colNames, dtype=str),
+    )
+
+
+def load_compatible_matrix(path):
+    """
+    read a compatible matrix file written as .npz by save_compatible_npz or as .csv
+    return: csr matrix of reads x isoforms, row names, column names
+    """
+    if path.endswith(".npz"):
+        with np.load(path) as file:
+            rowNames = file["rowNames"].tolist()
+            colNames = file["colNames"].tolist()
+            mat = csr_matrix(
+                (file["value"].astype(np.int64), (file["row"], file["col"])),
+                shape=(len(rowNames), len(colNames)),
+            )
+        return mat, rowNames, colNames
+    df = pd.read_csv(path, index_col=0)
+    return (
+        csr_matrix(df.to_numpy(dtype=np.int64)),
+        df.index.astype(str).tolist(),
+        df.columns.tolist(),
+    )
+
+
+def compatible_store_paths(folder):
+    # store files of a compatible_matrix folder, oldest first
+    if not os.path.isdir(folder):
+        return []
+    return [
+        os.path.join(folder, f)
+        for f in sorted(os.listdir(folder))
+        if f.startswith(COMPATIBLE_STORE_PREFIX) and f.endswith(COMPATIBLE_STORE_SUFFIX)
+    ]
+
+
+def compatible_store_readable(path):
+    import h5py
+
+    try:
+        with h5py.File(path, "r") as file:
+            file["gene/name"].shape
+    except (OSError, KeyError):
+        return False
+    return True
+
+
+def newest_compatible_sources(paths, store, suffix=None):
+    """
+    take every gene from one source only, the newest of its per-gene files and its store copy,
+    e.g. after the compatible format changed between runs
+    paths: per-gene files, the gene is the file name without suffix (default its extension)
+    store: CompatibleStore of the same folder, or None
+    return: the files to read, in their order, and the genes to read from the store
+    """
+    newest = {}  # gene -> (modification time, path or None for the store)
+    for path in paths:
+        name = os.path.basename(path)
+        gene = name[: -len(suffix)] if suffix else os.path.splitext(name)[0]
+        mtime = os.path.getmtime(path)
+        if gene not in newest or mtime > newest[gene][0]:
+            newest[gene] = (mtime, path)
+    for gene in [] if store is None else store.genes():
+        mtime = store.gene_mtime(gene)
+        if gene not in newest or mtime >= newest[gene][0]:
+            newest[gene] = (mtime, None)
+    selected = {path for _, path in newest.values()}
+    return (
+        [path for path in paths if path in selected],
+        [gene for gene, (_, path) in newest.items() if path is None],
+    )
+
+
+class CompatibleStoreWriter:
+    def __init__(self, folder):
+        """
+        append-only store of the compatible matrices and read-isoform mappings written by one process
+        folder: compatible_matrix folder of a sample; the file is created at the first append
+        """
+        self.folder = folder
+        self.path = None
+        self.file = None
+        # values appended since the last write, and the length of every dataset with and without them
+        self.buffer = {}
+        self.size = {}
+        self.written = {}
+
+    def __getstate__(self):
+        # a worker process opens its own file
+        return {"folder": self.folder}
+
+    def __setstate__(self, state):
+        self.__init__(state["folder"])
+
+    def _open(self):
+        import h5py
+
+        os.makedirs(self.folder, exist_ok=True)
+        # file names sort by creation time, so that readers take the latest copy of a gene
+        self.path = os.path.join(
+            self.folder,
+            f"{COMPATIBLE_STORE_PREFIX}{time.time_ns()}_{os.getpid()}{COMPATIBLE_STORE_SUFFIX}",
+        )
+        self.file = h5py.File(self.path, "w")
+        string = h5py.string_dtype()
+        datasets = [("gene/name", string), ("gene/chr", string)]
+        datasets += [("gene/" + column, np.int64) for column in GENE_INDEX_COLUMNS]
+        datasets += [("row/name", string), ("col/name", string)]
+        datasets += [("entry/row", np.int32), ("entry/col", np.int32)]
+        datasets += [("entry/value", np.int8)]
+        datasets += [("mapping/" + column, string) for column in MAPPING_COLUMNS]
+        datasets += [("mapping/MappingScore", np.float64), ("log/name", string)]
+        for name, dtype in datasets:
+            self.buffer[name] = []
+            self.size[name] = 0
+            self.written[name] = 0
+            self.file.create_dataset(
+                name,
+                shape=(0,),
+                maxshape=(None,),
+                dtype=dtype,
+                chunks=(COMPATIBLE_STORE_CHUNK,),
+                compression="gzip",
+            )
+
+    def _append(self, name, values):
+        # buffer values to append to a dataset, return the position of the first one
+        n = self.size[name]
+        if len(values) > 0:
+            self.buffer[name].append(values)
+            self.size[name] = n + len(values)
+        return n
+
+    def _write(self):
+        # append the buffered values, one resize per dataset; the gene index goes last, gene names at the very end,
+        # so that an interrupted write never lists a gene whose data is missing
+        names = sorted(
+            self.buffer,
+            key=lambda name: (name.startswith("gene/"), name == "gene/name"),
+        )
+        for name in names:
+            if len(self.buffer[name]) == 0:
+                continue
+            dataset = self.file[name]
+            dataset.resize((self.size[name],))
+            dataset[self.written[name] :] = np.concatenate(self.buffer[name])
+            self.buffer[name] = []
+            self.written[name] = self.size[name]
+
+    def append_gene(self, gene, geneChr, rowNames, colNames, mat, readmapping=None):
+        """
+        gene: gene key as the csv file name, geneName_geneID
+        rowNames, colNames, mat: the read x isoform compatible matrix; only nonzero entries are kept
+        readmapping: read-isoform mapping rows with MAPPING_COLUMNS and MappingScore
+        """
+        if self.file is None:
+            self._open()
+        mat = np.asarray(mat).reshape(len(rowNames), len(colNames))
+        rows, cols = np.nonzero(mat)
+        if readmapping is None:
+            readmapping = pd.DataFrame(columns=MAPPING_COLUMNS + ["MappingScore"])
+        index = {
+            "row_start": self._append("row/name", np.asarray(rowNames, dtype=object)),
+            "n_rows": len(rowNames),
+            "col_start": self._append("col/name", np.asarray(colNames, dtype=object)),
+            "n_cols": len(colNames),
+            "entry_start": self._append("entry/row", rows.astype(np.int32)),
+            "n_entries": len(rows),
+            "mapping_start": self.size["mapping/Read"],
+            "n_mapping": len(readmapping),
+        }
+        self._append("entry/col", cols.astype(np.int32))
+        self._append("entry/value", mat[rows, cols].astype(np.int8))
+        for column in MAPPING_COLUMNS:
+            self._append(
+                "mapping/" + column,
+                readmapping[column].astype(str).to_numpy(dtype=object),
+            )
+        self._append(
+            "mapping/MappingScore",
+            readmapping["MappingScore"].to_numpy(dtype=np.float64),
+        )
+        self._append("gene/name", np.array([gene], dtype=object))
+        self._append("gene/chr", np.array([geneChr], dtype=object))
+        for column in GENE_INDEX_COLUMNS:
+            self._append("gene/" + column, np.array([index[column]], dtype=np.int64))
+        self._write_full()
+
+    def append_log(self, gene):
+        # gene without mapped reads, as in compatible_matrix/log.txt
+        if self.file is None:
+            self._open()
+        self._append("log/name", np.array([gene], dtype=object))
+        self._write_full()
+
+    def _write_full(self):
+        # write once a dataset has a chunk of buffered values, instead of resizing every dataset for every gene
+        if any(
+            self.size[name] - self.written[name] >= COMPATIBLE_STORE_CHUNK
+            for name in self.buffer
+        ):
+            self._write()
+
+    def flush(self):
+        if self.file is not None:
+            self._write()
+            self.file.flush()
+
+    def close(self):
+        if self.file is not None:
+            self._write()
+            self.file.close()
+            self.file = None
+
+
+class CompatibleStore:
+    def __init__(self, folder):
+        """
+        read-only view of the stores in a compatible_matrix folder
+        a gene written more than once, e.g. by a rerun job, is read from the latest store
+        unreadable stores, left by killed jobs, are skipped
+        """
+        self.folder = folder
+        self._open()
+
+    def _open(self):
+        import h5py
+
+        self.paths = []
+        self.gene_dict = {}  # gene -> (store, position in the gene offset index)
+        self.logged = []
+        for path in compatible_store_paths(self.folder):
+            try:
+                with h5py.File(path, "r") as file:
+                    names = file["gene/name"].asstr()[:]
+                    logged = file["log/name"].asstr()[:]
+            except (OSError, KeyError):
+                continue
+            k = len(self.paths)
+            self.paths.append(path)
+            for i, name in enumerate(names):
+                self.gene_dict[name] = (k, i)
+            self.logged.extend(logged)
+        self.files = {}
+
+    def __getstate__(self):
+        # worker processes reopen the stores
+        return {"folder": self.folder}
+
+    def __setstate__(self, state):
+        self.folder = state["folder"]
+        self._open()
+
+    def __len__(self):
+        return len(self.gene_dict)
+
+    def __contains__(self, gene):
+        return gene in self.gene_dict
+
+    def genes(self):
+        return list(self.gene_dict.keys())
+
+    def gene_mtime(self, gene):
+        # modification time of the store a gene is read from
+        return os.path.getmtime(self.paths[self.gene_dict[gene][0]])
+
+    def _file(self, k):
+        import h5py
+
+        if k not in self.files:
+            self.files[k] = h5py.File(self.paths[k], "r")
+        return self.files[k]
+
+    def _index(self, gene):
+        k, i = self.gene_dict[gene]
+        file = self._file(k)
+        return file, {column: int(file["gene/" + column][i]) for column in GENE_INDEX_COLUMNS}
+
+    def sparse_matrix(self, gene):
+        # read x isoform compatible matrix of a gene as load_compatible_matrix returns it
+        file, index = self._index(gene)
+        rowNames = file["row/name"].asstr()[
+            index["row_start"] : index["row_start"] + index["n_rows"]
+        ]
+        colNames = file["col/name"].asstr()[
+            index["col_start"] : index["col_start"] + index["n_cols"]
+        ]
+        entries = slice(index["entry_start"], index["entry_start"] + index["n_entries"])
+        mat = csr_matrix(
+            (
+                file["entry/value"][entries].astype(np.int64),
+                (file["entry/row"][entries], file["entry/col"][entries]),
+            ),
+            shape=(index["n_rows"], index["n_cols"]),
+        )
+        return mat, list(rowNames), list(colNames)
+
+    def matrix(self, gene):
+        # read x isoform compatible matrix of a gene, as the csv file reads
+        mat, rowNames, colNames = self.sparse_matrix(gene)
+        return pd.DataFrame(mat.toarray(), index=rowNames, columns=colNames)
+
+    def mapping(self, genes=None):
+        # read-isoform mapping rows of genes (default all), as the concatenated tsv files read
+        genes = self.genes() if genes is None else genes
+        genes_store = {}
+        for gene in genes:
+            k, i = self.gene_dict[gene]
+            genes_store.setdefault(k, []).append(i)
+        mapping_list = []
+        for k in sorted(genes_store):
+            file = self._file(k)
+            starts = file["gene/mapping_start"][:][genes_store[k]]
+            counts = file["gene/n_mapping"][:][genes_store[k]]
+            # read only the rows of the genes, as few slices as possible: genes written one after the other are merged
+            slices = []
+            for start, n in zip(starts.tolist(), counts.tolist()):
+                if n == 0:
+                    continue
+                if len(slices) > 0 and slices[-1][1] == start:
+                    slices[-1][1] = start + n
+                else:
+                    slices.append([start, start + n])
+            mapping = {}
+            for column in MAPPING_COLUMNS:
+                dataset = file["mapping/" + column].asstr()
+                mapping[column] = np.concatenate(
+                    [dataset[a:b] for a, b in slices] + [np.zeros(0, dtype=object)]
+                )
+            dataset = file["mapping/MappingScore"]
+            mapping["MappingScore"] = np.concatenate(
+                [dataset[a:b] for a, b in slices] + [np.zeros(0, dtype=np.float64)]
+            )
+            mapping_list.append(pd.DataFrame(mapping))
+        if len(mapping_list) == 0:
+            return pd.DataFrame(columns=MAPPING_COLUMNS + ["MappingScore"])
+        return pd.concat(mapping_list, ignore_index=True)
+
+    def close(self):
+        for file in self.files.values():
+            file.close()
+        self.files = {}
@@ -7,11 +7,21 @@ import anndata as ad
 import numpy as np
 import pandas as pd
 import preprocessing as pp
+from compatible_store import (
+    CompatibleStore,
+    compatible_store_paths,
+    load_compatible_matrix,
+    newest_compatible_sources,
+)
 from joblib import Memory, Parallel, delayed
+from read_index import is_selected, load_read_selection
 from preprocessing import load_pickle
 from scipy.io import mmwrite
-from scipy.sparse import csr_matrix, load_npz
-from tqdm import tqdm
+from scipy.sparse import coo_matrix, csc_matrix, csr_matrix, hstack, load_npz, vstack
+
+
+# compatible matrix files are named geneName_geneID.csv or geneName_geneID.npz
+COMPATIBLE_FILE_PATTERN = r"_ENS.+\.(csv|npz)$"
 
 
 def generate_read_df(f, geneStructureInformation):
@@ -109,51 +119,216 @@ def flatten_list(nested_list):
     return flattened
 
 
-def deduplicate_col(df):
-    if df.shape[1] < 2:
-        return df
-    else:
-        arr = df.to_numpy()
-        r_ind = np.where(arr > 0)[0]
-        c_ind = np.where(arr > 0)[1]
-        ind_dict = {}
-        for i in range(arr.shape[1]):
-            r_ind_ = r_ind[np.where(c_ind == i)[0].tolist()].tolist()
-            ind_dict[i] = r_ind_
-        duplicated_cols = []
-        for i in range(arr.shape[1] - 1):
-            for j in range(i + 1, arr.shape[1]):
-                if len(ind_dict[i]) == len(ind_dict[j]):
-                    diff = np.array(ind_dict[i]) - np.array(ind_dict[j])
-                    if sum(diff != 0) == 0:
-                        duplicated_cols.append(j)
-        if len(duplicated_cols) > 0:
-            df = df.drop(df.columns[duplicated_cols], axis=1)
-        return df
-
-
-def generate_adata(triple_list):
-    cells_dict = {}
-    features_dict = {}
-    data = []
-    cells = []
-    features = []
-    for x, cell, feature in tqdm(triple_list):
-        if cell not in cells_dict:
-            cells_dict[cell] = len(cells_dict)
-            cells.append(cell)
-        if feature not in features_dict:
-            features_dict[feature] = len(features_dict)
-            features.append(feature)
-        data.append((x, cells_dict[cell], features_dict[feature]))
-    x, cells_ind, features_ind = zip(*data)
-    sparse_matrix = csr_matrix((x, (cells_ind, features_ind)))
+def deduplicate_col(mat):
+    # positions of the columns to keep: a column mapping the same reads as an earlier column is dropped
+    if mat.shape[1] < 2:
+        return list(range(mat.shape[1]))
+    mat = csc_matrix(mat > 0)
+    mat.sort_indices()
+    # the sorted row indices of a column are its signature; one pass keeps the first column of each
+    seen = set()
+    keep = []
+    for j in range(mat.shape[1]):
+        signature = mat.indices[mat.indptr[j] : mat.indptr[j + 1]].tobytes()
+        if signature not in seen:
+            seen.add(signature)
+            keep.append(j)
+    return keep
+
+
+def stack_rows(mat_list, colNames_list):
+    # stack sparse matrices by rows, aligning their columns by name in order of appearance
+    colNames = list(dict.fromkeys(pp.unpack_list(colNames_list)))
+    col_index = {name: j for j, name in enumerate(colNames)}
+    blocks = []
+    for mat, names in zip(mat_list, colNames_list):
+        mat = coo_matrix(mat)
+        cols = np.array([col_index[name] for name in names], dtype=np.int64)
+        blocks.append(
+            csr_matrix(
+                (mat.data, (mat.row, cols[mat.col])),
+                shape=(mat.shape[0], len(colNames)),
+            )
+        )
+    return vstack(blocks, format="csr"), colNames
+
+
+def combine_columns(mat, target, n):
+    # merge columns into n columns, column j goes to target[j], merged entries take the maximum
+    mat = coo_matrix(mat)
+    key = mat.row.astype(np.int64) * n + target[mat.col]
+    order = np.argsort(key, kind="stable")
+    key, data = key[order], mat.data[order]
+    if len(key) > 0:
+        start = np.flatnonzero(np.r_[True, key[1:] != key[:-1]])
+        key, data = key[start], np.maximum.reduceat(data, start)
+    return csr_matrix((data, (key // n, key % n)), shape=(mat.shape[0], n))
+
+
+def resolve_multiple(df_multiple, column_percentages, rng, quant="sample"):
+    """
+    assign reads compatible with more than one isoform, all reads at once
+    df_multiple: 0/1 array of reads x isoforms
+    column_percentages: isoform proportions used as weights, from uniquely mapped reads
+    quant: sample draws one isoform per read with probabilities of the weights of its compatible
+    isoforms (uniform if they are all 0); expected splits each read by these probabilities
+    """
+    compatible = df_multiple == 1
+    prob = np.where(compatible, column_percentages[None, :], 0.0)
+    no_weight = prob.sum(axis=1) == 0
+    prob[no_weight] = compatible[no_weight]
+    prob = prob / prob.sum(axis=1, keepdims=True)
+    if quant == "expected":
+        return prob
+    # inverse transform sampling: the first isoform whose cumulative probability exceeds u
+    cumulative = np.cumsum(prob, axis=1)
+    u = rng.random(len(prob))[:, None]
+    choice = (cumulative <= u).sum(axis=1)
+    # guard rounding of the last cumulative probability below 1
+    last = compatible.shape[1] - 1 - np.argmax(compatible[:, ::-1], axis=1)
+    choice = np.minimum(choice, last)
+    resolved = np.zeros(df_multiple.shape, dtype=df_multiple.dtype)
+    resolved[np.arange(len(choice)), choice] = 1
+    return resolved
+
+
+def em_fractional_counts(mat, cells, max_iter=1000, tol=1e-2):
+    """
+    fractional assignment of reads to isoforms by EM of the isoform proportions of each cell
+    reads are collapsed to equivalence classes, the distinct sets of compatible isoforms,
+    counted per cell, so the iterations run over (cell, class) pairs instead of reads
+    mat: sparse 0/1 matrix of reads x isoforms; reads compatible with no isoform get no counts
+    cells: cell of each read
+    tol: a cell has converged when no isoform changes by tol expected reads in an iteration
+    return: reads x isoforms array, each read split over its compatible isoforms
+    """
+    compatible = np.asarray(mat.toarray() > 0)
+    fractions = np.zeros(compatible.shape)
+    assigned = np.flatnonzero(compatible.any(axis=1))
+    if len(assigned) == 0:
+        return fractions
+    packed = np.packbits(compatible[assigned], axis=1)
+    class_code, _ = pd.factorize(packed.view(f"S{packed.shape[1]}").ravel())
+    cell_code, _ = pd.factorize(np.asarray(cells)[assigned])
+    n_classes, n_cells = class_code.max() + 1, cell_code.max() + 1
+    # pairs are numbered in order of cells, so that the pairs of a cell are contiguous
+    pair_code, pairs = pd.factorize(
+        cell_code.astype(np.int64) * n_classes + class_code, sort=True
+    )
+    pair_cell, pair_class = pairs // n_classes, pairs % n_classes
+    pair_count = np.bincount(pair_code).astype(float)
+    class_rows = np.empty(n_classes, dtype=np.int64)
+    class_rows[class_code[::-1]] = np.arange(len(class_code))[::-1]
+    pair_compatible = compatible[assigned][class_rows][pair_class].astype(float)
+    cell_reads = np.bincount(pair_cell, weights=pair_count, minlength=n_cells)
+    proportion = np.full((n_cells, compatible.shape[1]), 1 / compatible.shape[1])
+    # only cells with reads compatible with more than one isoform are iterated,
+    # and cells are dropped from the iterations once their proportions converge
+    active = np.zeros(n_cells, dtype=bool)
+    active[pair_cell[pair_compatible.sum(axis=1) > 1]] = True
+    active_pairs = np.flatnonzero(active[pair_cell])
+    for _ in range(max_iter):
+        if len(active_pairs) == 0:
+            break
+        cell = pair_cell[active_pairs]
+        end = np.flatnonzero(np.r_[cell[1:] != cell[:-1], True])
+        cell = cell[end]
+        # E step: split every pair over its compatible isoforms by the cell proportions
+        weight = proportion[pair_cell[active_pairs]] * pair_compatible[active_pairs]
+        weight *= (pair_count[active_pairs] / weight.sum(axis=1))[:, None]
+        # M step: proportions of the expected reads of every cell, summed over its pairs
+        cell_pairs = csr_matrix(
+            (np.ones(len(active_pairs)), np.arange(len(active_pairs)), np.r_[0, end + 1]),
+            shape=(len(cell), len(active_pairs)),
+        )
+        proportion_new = (cell_pairs @ weight) / cell_reads[cell][:, None]
+        change = np.abs(proportion_new - proportion[cell]).max(axis=1)
+        proportion[cell] = proportion_new
+        active[cell[change * cell_reads[cell] < tol]] = False
+        active_pairs = active_pairs[active[pair_cell[active_pairs]]]
+    weight = proportion[pair_cell] * pair_compatible
+    weight /= weight.sum(axis=1, keepdims=True)
+    fractions[assigned] = weight[pair_code]
+    return fractions
+
+
+def strip_last_field(names):
+    # names up to their last "_", as str.rsplit("_", n=1).str[0], on a bytes array
+    names = np.array(names, dtype="S")
+    if len(names) == 0 or names.itemsize == 0:
+        return names
+    chars = names.view(np.uint8).reshape(len(names), names.itemsize)
+    underscore = chars == ord("_")
+    last = names.itemsize - 1 - np.argmax(underscore[:, ::-1], axis=1)
+    strip = underscore.any(axis=1)[:, None] & (
+        np.arange(names.itemsize) >= last[:, None]
+    )
+    chars[strip] = 0
+    return names
+
+
+def aggregate_rows(mat, rowNames):
+    # sum rows with the same name, names are sorted as groupby does
+    names, inverse = np.unique(np.asarray(rowNames, dtype=object), return_inverse=True)
+    indicator = csr_matrix(
+        (np.ones(len(inverse), dtype=np.int64), (inverse, np.arange(len(inverse)))),
+        shape=(len(names), len(inverse)),
+    )
+    return names.tolist(), csr_matrix(indicator @ mat)
+
+
+def sparse_to_coo(mat):
+    # nonzero entries of a sparse matrix in row-major order: values, rows, columns
+    mat = csr_matrix(mat)
+    mat.eliminate_zeros()
+    mat.sort_indices()
+    mat = mat.tocoo()
+    return mat.data, mat.row.astype(np.int64), mat.col.astype(np.int64)
+
+
+def cell_index(selected):
+    # sorted cell barcodes of the selected CBUMIs of a sample, shared by all count workers
+    return np.unique(strip_last_field(selected)).astype(str)
+
+
+def concatenate_blocks(blocks):
+    # concatenate COO blocks of (values, cell codes, feature codes)
+    if len(blocks) == 0:
+        return np.zeros(0), np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    return tuple(np.concatenate(column) for column in zip(*blocks))
+
+
+def generate_adata(data, cells, features, cellNames, featureNames):
+    """
+    AnnData of COO blocks concatenated over genes
+    data, cells, features: values and integer codes of the nonzero entries
+    cellNames, featureNames: names of the codes; cells and features are ordered by first appearance
+    """
+    cells, cell_codes = pd.factorize(cells)
+    features, feature_codes = pd.factorize(features)
+    sparse_matrix = csr_matrix(
+        (data, (cells, features)), shape=(len(cell_codes), len(feature_codes))
+    )
     adata = ad.AnnData(sparse_matrix)
-    adata.obs_names = cells
-    adata.var_names = features
+    adata.obs_names = np.asarray(cellNames, dtype=object)[cell_codes]
+    adata.var_names = np.asarray(featureNames, dtype=object)[feature_codes]
     return adata
 
 
+def write_sparse_csv(adata, path, n_values=10**7):
+    # csv of adata.to_df() written by blocks of rows, about n_values dense values at a time
+    chunk_size = max(1, n_values // max(1, adata.n_vars))
+    X = csr_matrix(adata.X)
+    with open(path, "w") as f:
+        for start in range(0, max(1, adata.n_obs), chunk_size):
+            end = min(start + chunk_size, adata.n_obs)
+            pd.DataFrame(
+                X[start:end].toarray(),
+                index=adata.obs_names[start:end],
+                columns=adata.var_names,
+            ).to_csv(f, header=start == 0)
+
+
 def split_list(lst, n):
     chunk_size = len(lst) // n
     remainder = len(lst) % n
@@ -177,6 +352,10 @@ class CountMatrix:
         workers: int = 1,
         csv=True,
         mtx=True,
+        h5ad=False,
+        zarr=False,
+        seed=None,
+        quant="sample",
         logger=None,
     ):
         self.logger = logger
@@ -189,6 +368,12 @@ class CountMatrix:
         self.group_novel = group_novel
         self.csv = csv
         self.mtx = mtx
+        self.h5ad = h5ad
+        self.zarr = zarr
+        # global seed, each gene draws from its own stream derived from its name
+        self.seed = seed
+        # resolution of reads compatible with multiple isoforms, see resolve_multiple
+        self.quant = quant
         self.annotation_path_meta_gene_novel = os.path.join(
             target[0], "reference/metageneStructureInformationwNovel.pkl"
         )
@@ -228,51 +413,55 @@ class CountMatrix:
                 for target_ in target
             ]
 
-    def generate_count_matrix_by_gene(self, gene, read_selection_pkl):
+    def generate_count_matrix_by_gene(self, gene, read_selection):
         # CompatibleMatrixPaths = '/scr1/users/xu3/singlecell/project_singlecell/sample7_8_ont/sample7/compatible_matrix'
         # read_selection_pkl_paths = '/scr1/users/xu3/singlecell/project_singlecell/sample7_8_ont/sample7/auxillary/read_selection.pkl'
-        # read_selection_pkl: keys must add sample index
+        # read_selection: sorted array of selected CBUMIs of each sample, from read_filter
         for folder in self.count_matrix_folder_path_list:
             os.makedirs(folder, exist_ok=True)
-        pattern = re.compile(r"_ENS.+\.csv")
         files_with_indicators = [
-            (
-                os.path.join(CompatibleMatrixPath, i),
-                idx,
-            )  # Tuple with file path and index
-            for idx, CompatibleMatrixPath in enumerate(
-                self.compatible_matrix_folder_path_list
-            )
-            for i in os.listdir(CompatibleMatrixPath)
-            if ".csv" in i and pattern.sub("", i) == gene
+            (f, idx)  # Tuple with file path and index
+            for idx, compatible_file_dict in enumerate(self.compatible_file_dict)
+            for f in compatible_file_dict.get(gene, [])
         ]
-        df_list = []
-        for f, idx in files_with_indicators:
-            df = pd.read_csv(f)
-            df.columns = ["Cell"] + df.columns.tolist()[1:]
+        # compatible matrices are kept sparse: reads x isoforms, with row and column names
+        compatible_matrices = [
+            load_compatible_matrix(f) + (idx,) for f, idx in files_with_indicators
+        ]
+        # genes saved in compatible matrix stores
+        for idx, store in enumerate(self.compatible_stores):
+            for name in self.store_gene_dict[idx].get(gene, []):
+                compatible_matrices.append(store.sparse_matrix(name) + (idx,))
+        mat_list, colNames_list, cells_list, samples_list = [], [], [], []
+        for mat, rowNames, colNames, idx in compatible_matrices:
+            cbumi = np.array(rowNames, dtype="S")
             if self.parse:
-                df.Cell = df["Cell"].str.rsplit("_", n=1).str[0].tolist()
-            df["Cell"] = df["Cell"] + f":sample{idx}"
-            df = df[
-                df["Cell"].isin(
-                    [cell for cell in df["Cell"] if read_selection_pkl.get(cell) == 1]
-                )
-            ]  # filtering df
-            if df.shape[0] > 0:
-                df["Cell"] = df["Cell"].str.rsplit("_", n=1).str[0].tolist()
-                df["Cell"] = df["Cell"] + f":sample{idx}"
-                df = df.set_index("Cell")
-                df_list.append(df)
-        if len(df_list) == 0:
+                cbumi = strip_last_field(cbumi)
+            keep = is_selected(read_selection[idx], cbumi)  # filtering reads
+            if keep.sum() > 0:
+                mat_list.append(mat[keep])
+                colNames_list.append(colNames)
+                cells_list.append(strip_last_field(cbumi[keep]).astype(str))
+                samples_list.append(np.full(keep.sum(), idx))
+        if len(mat_list) == 0:
             return {gene: []}
-        result_df = pd.concat(df_list, axis=0)
-        df = result_df.fillna(0).astype(int)
+        mat, colNames = stack_rows(mat_list, colNames_list)
+        cells = np.concatenate(cells_list)
+        samples = np.concatenate(samples_list)
         if self.group_novel:
-            df, novel_isoform_name_mapping = pp.group_novel_isoform(
-                df,
+            # group novel isoform columns by their names, the reads are not needed
+            df_grouped, novel_isoform_name_mapping = pp.group_novel_isoform(
+                pd.DataFrame(np.zeros((0, len(colNames)), dtype=int), columns=colNames),
                 geneStrand=self.annotation_pkl[gene][0]["geneStrand"],
                 parse=self.parse,
             )
+            colNames_grouped = df_grouped.columns.tolist()
+            target = [
+                colNames_grouped.index(novel_isoform_name_mapping.get(name, name))
+                for name in colNames
+            ]
+            mat = combine_columns(mat, np.array(target), len(colNames_grouped))
+            colNames = colNames_grouped
         else:
             novel_isoform_name_mapping = None
         if novel_isoform_name_mapping is not None:
@@ -281,151 +470,154 @@ class CountMatrix:
             ]
         else:
             novel_isoform_del = []
-        # split df into samples
-        df["sample_id"] = df.index.str.split(":").str[1]
-        df.index = df.index.str.split(":").str[0]
-        df_list = [
-            group.drop(columns="sample_id") for _, group in df.groupby("sample_id")
-        ]
+        rng = pp.gene_rng(self.seed, gene)
         # deal each sample separately
-        for i, df in enumerate(df_list):
+        for i in np.unique(samples):
+            sample_rows = np.flatnonzero(samples == i)
+            df, cell, isoformNames = mat[sample_rows], cells[sample_rows], colNames
             # --------delete isoforms without reads
-            df_isoform = df.sum(axis=0) > 0  # cols have read
-            isoformNames = df_isoform[df_isoform].index.tolist()
-            df = df.loc[:, isoformNames]
+            df_isoform = np.flatnonzero(np.asarray(df.sum(axis=0)).ravel() > 0)
+            df = df[:, df_isoform]
+            isoformNames = [isoformNames[j] for j in df_isoform]
             # filter uncategorized reads
-            df_uncategorized = pd.DataFrame()
-            if df.shape[1] > 0:
-                df_uncategorized = df.filter(["uncategorized"])
-                if df_uncategorized.shape[1] > 0:
-                    df = df.drop(columns=df_uncategorized.columns.tolist())
+            uncategorized = [
+                j for j, name in enumerate(isoformNames) if name == "uncategorized"
+            ]
+            categorized = [
+                j for j, name in enumerate(isoformNames) if name != "uncategorized"
+            ]
+            df_uncategorized = df[:, uncategorized]
+            df = df[:, categorized]
+            isoformNames_uncategorized = [isoformNames[j] for j in uncategorized]
+            isoformNames = [isoformNames[j] for j in categorized]
             if df.shape[1] > 0:
                 # --------deal with multiple mappings
-                df = deduplicate_col(df)  # delete same mapping isoforms
+                keep = deduplicate_col(df)  # delete same mapping isoforms
+                df = df[:, keep]
+                isoformNames = [isoformNames[j] for j in keep]
                 # use unique mappings to decide multiple mappings
-                multiple_bool = df.sum(axis=1) > 1
-                multiple_index = [i for i, k in enumerate(multiple_bool.tolist()) if k]
-                unique_index = [
-                    i for i, k in enumerate(multiple_bool.tolist()) if k == False
-                ]
-                df_multiple = df.iloc[multiple_index, :]
-                df_unique = df.iloc[unique_index, :]
-                if df_multiple.shape[0] > 0:
+                multiple_bool = np.asarray(df.sum(axis=1)).ravel() > 1
+                multiple_index = np.flatnonzero(multiple_bool)
+                unique_index = np.flatnonzero(~multiple_bool)
+                df_multiple = df[multiple_index].toarray()
+                df_unique = df[unique_index]
+                if df_multiple.shape[0] > 0 and self.quant == "em":
+                    # proportions are estimated from all reads of each cell
+                    df_multiple = em_fractional_counts(df, cell)[multiple_index]
+                    df = vstack([csr_matrix(df_multiple), df_unique], format="csr")
+                elif df_multiple.shape[0] > 0:
                     if df_unique.shape[0] > 0:
-                        column_percentages = df_unique.sum(axis=0).div(
-                            df_unique.sum(axis=0).sum(axis=0)
-                        )
+                        column_sums = np.asarray(df_unique.sum(axis=0)).ravel()
                     else:
-                        column_percentages = df_multiple.sum(axis=0).div(
-                            df_multiple.sum(axis=0).sum(axis=0)
-                        )
-                    for ii in range(df_multiple.shape[0]):
-                        isoforms_mapping = df_multiple.columns[
-                            (df_multiple.iloc[ii, :] == 1).values
-                        ]
-                        if column_percentages[isoforms_mapping].sum() == 0:
-                            isoforms_mapping_max = (
-                                column_percentages[isoforms_mapping]
-                                .index[
-                                    np.random.multinomial(
-                                        1,
-                                        [1 / len(isoforms_mapping)]
-                                        * len(isoforms_mapping),
-                                    )
-                                    == 1
-                                ]
-                                .tolist()
-                            )
-                        else:
-                            isoforms_mapping_prob = (
-                                column_percentages[isoforms_mapping]
-                                / column_percentages[isoforms_mapping].sum()
-                            )
-                            isoforms_mapping_max = isoforms_mapping_prob.index[
-                                np.random.multinomial(1, isoforms_mapping_prob) == 1
-                            ].tolist()
-                        for iso in list(isoforms_mapping):
-                            if iso not in isoforms_mapping_max:
-                                df_multiple.iloc[ii, :][iso] = 0
-                    df = pd.concat([df_multiple, df_unique])
-                if df_uncategorized.shape[1] > 0:
-                    df_uncategorized = df_uncategorized.iloc[
-                        multiple_index + unique_index, :
-                    ]
-                    df = pd.concat([df, df_uncategorized], axis=1)
+                        column_sums = df_multiple.sum(axis=0)
+                    column_percentages = (
+                        column_sums / column_sums.sum()
+                        if column_sums.sum() > 0
+                        else np.zeros(len(column_sums))
+                    )
+                    df_multiple = resolve_multiple(
+                        df_multiple, column_percentages, rng, quant=self.quant
+                    )
+                    df = vstack([csr_matrix(df_multiple), df_unique], format="csr")
+                order = np.concatenate([multiple_index, unique_index])
+                cell = cell[order]
+                df = hstack([df, df_uncategorized[order]], format="csr")
+                isoformNames = isoformNames + isoformNames_uncategorized
             else:
-                df = df_uncategorized
+                df, isoformNames = df_uncategorized, isoformNames_uncategorized
             # filter novel isoform by supporting reads
             if df.shape[1] > 0:
-                df_novel = df.filter(like="novel")
-                if df_novel.shape[1] > 0:
-                    novel_isoform_drop = df_novel.sum(axis=0) < self.novel_read_n
-                    novel_isoform_drop = novel_isoform_drop[
-                        novel_isoform_drop
-                    ].index.tolist()
-                    df_drop = df.loc[:, novel_isoform_drop].sum(axis=1).tolist()
-                    df = df.drop(columns=novel_isoform_drop)
+                df_novel = [j for j, name in enumerate(isoformNames) if "novel" in name]
+                if len(df_novel) > 0:
+                    novel_isoform_sums = np.asarray(df[:, df_novel].sum(axis=0)).ravel()
+                    drop = [
+                        j
+                        for j, n in zip(df_novel, novel_isoform_sums)
+                        if n < self.novel_read_n
+                    ]
+                    novel_isoform_drop = [isoformNames[j] for j in drop]
+                    df_drop = df[:, drop].sum(axis=1)
+                    if len(drop) == 0:
+                        # counts turn float as in the dense sum over no columns
+                        df_drop = df_drop.astype(float)
+                    keep = [j for j in range(df.shape[1]) if j not in drop]
+                    df = hstack([df[:, keep], csr_matrix(df_drop)], format="csr")
+                    isoformNames = [isoformNames[j] for j in keep] + [
+                        "uncategorized_novel"
+                    ]  # novel  isoforms but less than supporting reads
                     novel_isoform_del = novel_isoform_del + novel_isoform_drop
-                    df["uncategorized_novel"] = (
-                        df_drop  # novel  isoforms but less than supporting reads
-                    )
             if df.shape[1] == 0:
-                return {gene: novel_isoform_del}
-            df_all, df_filtered = df.copy(), df.copy()
-            df_all.columns = [gene + "_" + iso for iso in df_all.columns.tolist()]
-            df_filtered = df_filtered[
-                df_filtered.columns[~df_filtered.columns.str.contains("uncategorized")]
-            ]
-            df_filtered.columns = [
-                gene + "_" + iso for iso in df_filtered.columns.tolist()
-            ]
-            # confirm again------nonfiltered
-            if df_all.shape[1] > 0:
-                # aggregate by cells
-                df_all = df_all.groupby(df_all.index).sum()
-                df_gene = pd.DataFrame(
-                    {"Cell": df_all.index.tolist(), gene: df_all.sum(axis=1).tolist()}
-                ).set_index("Cell")
-                triple_transcript = df_to_triple(df_all)
-                triple_gene = df_to_triple(df_gene)
-                with open(
-                    os.path.join(
-                        self.count_matrix_folder_path_list[i],
-                        str(gene) + "_unfiltered_count.pickle",
-                    ),
-                    "wb",
-                ) as f:
-                    pickle.dump((triple_gene, triple_transcript), f)
+                continue
+            # aggregate by cells
+            cellNames, df_all = aggregate_rows(df, cell)
+            isoformNames = [gene + "_" + iso for iso in isoformNames]
+            df_gene = csr_matrix(df_all.sum(axis=1))
+            # COO blocks with cell codes of the shared cell index and local feature codes
+            cell_code = np.searchsorted(self.cell_index_list[i], cellNames)
+            transcript_data, transcript_cell, transcript_feature = sparse_to_coo(df_all)
+            gene_data, gene_cell, _ = sparse_to_coo(df_gene)
+            np.savez(
+                os.path.join(
+                    self.count_matrix_folder_path_list[i],
+                    str(gene) + "_unfiltered_count.npz",
+                ),
+                gene_data=gene_data,
+                gene_cell=cell_code[gene_cell],
+                transcript_data=transcript_data,
+                transcript_cell=cell_code[transcript_cell],
+                transcript_feature=transcript_feature,
+                transcriptNames=np.asarray(isoformNames, dtype=str),
+            )
         return {gene: novel_isoform_del}
 
-    def generate_count_matrix_by_gene_list(self, gene_list, read_selection_pkl):
+    def generate_count_matrix_by_gene_list(self, gene_list, read_selection):
         novel_isoform_del_dict = {}
         for gene in gene_list:
             novel_isoform_del_dict_gene = self.generate_count_matrix_by_gene(
-                gene, read_selection_pkl
+                gene, read_selection
             )
             novel_isoform_del_dict.update(novel_isoform_del_dict_gene)
         return novel_isoform_del_dict
 
     def read_filter(self):
-        read_selection_pkl = {}
-        for i, path in enumerate(self.read_selection_pkl_path_list):
-            read_selection_pkl_ = pp.load_pickle(path)
-            read_selection_pkl_updated = {
-                key + f":sample{i}": value for key, value in read_selection_pkl_.items()
-            }
-            read_selection_pkl.update(read_selection_pkl_updated)
-        return read_selection_pkl
+        # memory-mapped arrays are passed to workers by reference
+        return [load_read_selection(path) for path in self.read_selection_pkl_path_list]
 
     def generate_multiple_samples(self):
-        pattern = re.compile(r"_ENS.+\.csv")
+        pattern = re.compile(COMPATIBLE_FILE_PATTERN)
         Genes = []
+        # gene -> compatible matrix files and store genes of each sample, listed once for all genes;
+        # a gene saved both as a file and in a store is read from the newest of them
+        self.compatible_file_dict = []
+        self.compatible_stores, self.store_gene_dict = [], []
         for p in self.compatible_matrix_folder_path_list:
-            Genes_ = [g for g in os.listdir(p) if "csv" in g]
-            Genes_ = [pattern.sub("", g) for g in Genes_]
-            Genes.append(Genes_)
+            store = CompatibleStore(p) if compatible_store_paths(p) else None
+            paths, store_genes = newest_compatible_sources(
+                [
+                    os.path.join(p, f)
+                    for f in sorted(os.listdir(p))
+                    if f.endswith((".csv", ".npz"))
+                ],
+                store,
+            )
+            compatible_file_dict = {}
+            for path in paths:
+                compatible_file_dict.setdefault(
+                    pattern.sub("", os.path.basename(path)), []
+                ).append(path)
+            # genes of compatible matrix stores, keyed by gene name as the csv files
+            store_gene_dict = {}
+            for name in sorted(store_genes):
+                store_gene_dict.setdefault(pattern.sub("", name + ".csv"), []).append(
+                    name
+                )
+            self.compatible_file_dict.append(compatible_file_dict)
+            self.compatible_stores.append(store)
+            self.store_gene_dict.append(store_gene_dict)
+            Genes.append(list(compatible_file_dict.keys()))
+            Genes.append(list(store_gene_dict.keys()))
         Genes = flatten_list(Genes)
-        Genes = list(set(Genes))
+        Genes = sorted(set(Genes))
         for count_path in self.count_matrix_folder_path_list:
             os.makedirs(count_path, exist_ok=True)
         adata_gene_unfiltered_list, adata_transcript_unfiltered_list = [], []
@@ -443,20 +635,24 @@ class CountMatrix:
                     annotation_pkl[genename] = gene_info
         self.annotation_pkl = annotation_pkl
         self.logger.info(f"generating read filter")
-        read_selection_pkl = self.read_filter()
+        read_selection = self.read_filter()
+        self.cell_index_list = [cell_index(selected) for selected in read_selection]
         self.logger.info(
             f"generating count matrix pickles at: {self.count_matrix_folder_path_list}"
         )
         Genes_list = split_list(Genes, self.workers)
         novel_isoform_del_dict = Parallel(n_jobs=self.workers)(
             delayed(self.generate_count_matrix_by_gene_list)(
-                gene_list, read_selection_pkl
+                gene_list, read_selection
             )
             for gene_list in Genes_list
         )
         novel_isoform_del = {}
         for d in novel_isoform_del_dict:
             novel_isoform_del.update(d)
+        for store in self.compatible_stores:
+            if store is not None:
+                store.close()
         self.logger.info("count matrix generated")
         # save novel_isoform_del
         self.novel_isoform_del_dict = novel_isoform_del
@@ -472,20 +668,45 @@ class CountMatrix:
         for i, count_path in enumerate(self.count_matrix_folder_path_list):
             out_paths_unfiltered = [
                 os.path.join(count_path, f)
-                for f in os.listdir(count_path)
-                if f.endswith("_unfiltered_count.pickle")
+                for f in sorted(os.listdir(count_path))
+                if f.endswith("_unfiltered_count.npz")
             ]
-            self.logger.info(f"reading {len(out_paths_unfiltered)} count pickles")
-            Out_unfiltered = []
-            for op in out_paths_unfiltered:
-                Out_unfiltered.append(pp.load_pickle(op))
+            self.logger.info(f"reading {len(out_paths_unfiltered)} count files")
+            gene_blocks, transcript_blocks = [], []
+            geneNames, transcriptNames = [], []
+            for gene_code, op in enumerate(out_paths_unfiltered):
+                with np.load(op) as blocks:
+                    gene_blocks.append(
+                        (
+                            blocks["gene_data"],
+                            blocks["gene_cell"],
+                            np.full(len(blocks["gene_data"]), gene_code),
+                        )
+                    )
+                    # feature codes are offset by the features of the previous genes
+                    transcript_blocks.append(
+                        (
+                            blocks["transcript_data"],
+                            blocks["transcript_cell"],
+                            blocks["transcript_feature"] + len(transcriptNames),
+                        )
+                    )
+                    transcriptNames.extend(blocks["transcriptNames"].tolist())
+                geneNames.append(
+                    os.path.basename(op)[: -len("_unfiltered_count.npz")]
+                )
             self.logger.info("generating count matrix")
-            triple_gene_list, triple_transcript_list = list(zip(*Out_unfiltered))
-            triple_gene_list = pp.unpack_list(list(triple_gene_list))
-            triple_transcript_list = pp.unpack_list(list(triple_transcript_list))
-            adata_gene_unfiltered = generate_adata(triple_gene_list)
-            adata_transcript_unfiltered = generate_adata(triple_transcript_list)
-            self.logger.info("removing pickles")
+            adata_gene_unfiltered = generate_adata(
+                *concatenate_blocks(gene_blocks),
+                self.cell_index_list[i],
+                geneNames,
+            )
+            adata_transcript_unfiltered = generate_adata(
+                *concatenate_blocks(transcript_blocks),
+                self.cell_index_list[i],
+                transcriptNames,
+            )
+            self.logger.info("removing count files")
             for op in out_paths_unfiltered:
                 os.remove(op)
             adata_gene_unfiltered_list.append(adata_gene_unfiltered)
@@ -552,16 +773,53 @@ class CountMatrix:
                     self.count_matrix_folder_path_list[i],
                     "adata_transcript_unfiltered" + str(self.novel_read_n) + ".csv",
                 )
-                # save gene
+                # save gene, block by block so that the matrix is never dense as a whole
                 print("saving count matrix on gene level ")
-                adata_gene_unfiltered_df = self.adata_gene_unfiltered_list[i].to_df()
-                adata_gene_unfiltered_df.to_csv(output_gene_unfiltered)
+                write_sparse_csv(
+                    self.adata_gene_unfiltered_list[i], output_gene_unfiltered
+                )
                 # save transcript
                 print("saving count matrix on transcript level ")
-                adata_transcript_unfiltered_df = self.adata_transcript_unfiltered_list[
-                    i
-                ].to_df()
-                adata_transcript_unfiltered_df.to_csv(output_transcript_unfiltered)
+                write_sparse_csv(
+                    self.adata_transcript_unfiltered_list[i],
+                    output_transcript_unfiltered,
+                )
+        if self.h5ad:
+            self.logger.info("saving count matrix in h5ad format")
+            for i in range(self.n_samples):
+                for level, adata in [
+                    ("gene", self.adata_gene_unfiltered_list[i]),
+                    ("transcript", self.adata_transcript_unfiltered_list[i]),
+                ]:
+                    adata.write_h5ad(
+                        os.path.join(
+                            self.count_matrix_folder_path_list[i],
+                            f"adata_{level}_unfiltered{self.novel_read_n}.h5ad",
+                        ),
+                        compression="gzip",
+                    )
+        if self.zarr:
+            try:
+                import zarr  # noqa: F401, used by AnnData.write_zarr
+            except ImportError:
+                self.logger.error(
+                    "--save_zarr requires the zarr package, install it with "
+                    "`conda install zarr` or `pip install zarr`; zarr output skipped"
+                )
+                return
+            self.logger.info("saving count matrix in zarr format")
+            for i in range(self.n_samples):
+                for level, adata in [
+                    ("gene", self.adata_gene_unfiltered_list[i]),
+                    ("transcript", self.adata_transcript_unfiltered_list[i]),
+                ]:
+                    # sparse matrices are stored as compressed, chunked data/indices/indptr arrays
+                    adata.write_zarr(
+                        os.path.join(
+                            self.count_matrix_folder_path_list[i],
+                            f"adata_{level}_unfiltered{self.novel_read_n}.zarr",
+                        )
+                    )
 
     def _extract_attribute(self, attributes, attribute_name):
         try:
@@ -94,6 +94,24 @@ parser.add_argument(
 )
 parser.add_argument("--barcode_cell", type=str, help="cell barcode tag in bam file")
 parser.add_argument("--barcode_umi", type=str, help="umi barcode tag in bam file")
+parser.add_argument(
+    "--bam_info_format",
+    type=str,
+    default="csv",
+    choices=["csv", "parquet"],
+    help="format of extracted bam information; parquet streams read tags to disk in chunks with bounded memory and reads them back column-wise into a read index instead of per-read dictionaries",
+)
+parser.add_argument(
+    "--bam_info_chunk_size",
+    type=int,
+    default=1000000,
+    help="number of reads per chunk when extracting bam information in parquet format",
+)
+parser.add_argument(
+    "--read_index",
+    action="store_true",
+    help="save read identities as a memory-mapped index shared by all compatible matrix jobs instead of bam.Info pickles",
+)
 parser.add_argument(
     "--no_bam_annotation",
     action="store_true",
@@ -103,6 +121,39 @@ parser.add_argument(
 # task is compatible matrix
 parser.add_argument("--job_index", type=int, default=0, help="work array index")
 parser.add_argument("--total_jobs", type=int, default=1, help="number of subwork")
+parser.add_argument(
+    "--schedule",
+    type=str,
+    default="contiguous",
+    choices=["contiguous", "balanced"],
+    help="split metagenes into jobs as contiguous slices, or balanced by the number of reads in their regions",
+)
+parser.add_argument(
+    "--sweep",
+    action="store_true",
+    help="stream reads of neighbouring metagenes in one pass over the bam files instead of fetching each metagene",
+)
+parser.add_argument("--sweep_off", action="store_false", dest="sweep")
+parser.add_argument(
+    "--novel_backend",
+    type=str,
+    default="louvain",
+    choices=["louvain", "leiden"],
+    help="community detection used to group novel reads into novel isoforms",
+)
+parser.add_argument(
+    "--resume",
+    action="store_true",
+    help="skip metagenes recorded as completed in reference/compatible_manifest with the same inputs and parameters and whose compatible matrix files or stores still exist; other genes are mapped again and their existing files are overwritten",
+)
+parser.add_argument("--resume_off", action="store_false", dest="resume")
+parser.add_argument(
+    "--compatible_format",
+    type=str,
+    default="csv",
+    choices=["csv", "npz", "h5"],
+    help="save compatible matrices and read-isoform mappings as csv/tsv files per gene, sparse npz/tsv files per gene, or in one HDF5 store per sample and process",
+)
 parser.add_argument("--cover_existing", action="store_true")
 parser.add_argument(
     "--cover_existing_false", action="store_false", dest="cover_existing"
@@ -163,9 +214,38 @@ parser.add_argument(
     help="whether to save count matrix output as mtx format",
 )
 parser.add_argument("--save_mtx_false", action="store_false", dest="save_mtx")
+parser.add_argument(
+    "--save_h5ad",
+    action="store_true",
+    help="whether to save count matrix output as gzip compressed sparse h5ad format",
+)
+parser.add_argument(
+    "--save_zarr",
+    action="store_true",
+    help="whether to save count matrix output as compressed sparse zarr format, requires zarr",
+)
+parser.add_argument(
+    "--quant",
+    type=str,
+    default="sample",
+    choices=["sample", "expected", "em"],
+    help="resolve reads compatible with multiple isoforms by drawing one isoform, by splitting them into expected fractional counts, or by splitting them by isoform proportions of each cell estimated with EM",
+)
 
 # general
 parser.add_argument("--workers", type=int, default=8, help="number of workers per work")
+parser.add_argument(
+    "--job_workers",
+    type=int,
+    default=1,
+    help="number of processes used within one compatible matrix job to map reads of different metagenes, default is 1",
+)
+parser.add_argument(
+    "--seed",
+    type=int,
+    default=None,
+    help="random seed; each gene uses its own stream derived from its ID, so reruns of any subset of genes give identical outputs",
+)
 parser.add_argument(
     "--single_cell",
     action="store_true",
@@ -256,6 +336,8 @@ def main():
         )
         logger.info(f"Z-score threshold: {args.z_score_threshold}")
         logger.info(f"Minimum gene size: {args.min_gene_size}")
+        logger.info(f"BAM information format: {args.bam_info_format}")
+        logger.info(f"Read index: {args.read_index}")
         annotator = annot.Annotator(
             target=args.target,
             reference_gtf_path=args.reference,
@@ -270,6 +352,9 @@ def main():
             min_gene_size=args.min_gene_size,
             build=args.build,
             platform=args.platform,
+            bam_info_format=args.bam_info_format,
+            chunk_size=args.bam_info_chunk_size,
+            read_index=args.read_index,
             logger=logger,
         )
         # generate gene annotation
@@ -305,6 +390,15 @@ def main():
         logger.info(f"Platform: {args.platform}. Job: {args.job_index}")
         logger.info(f"Reference GTF Path: {args.reference}. Job: {args.job_index}")
         logger.info(f"Update GTF option: {args.update_gtf}. Job: {args.job_index}")
+        logger.info(f"Job workers: {args.job_workers}. Job: {args.job_index}")
+        logger.info(f"Schedule: {args.schedule}. Job: {args.job_index}")
+        logger.info(f"Sweep: {args.sweep}. Job: {args.job_index}")
+        logger.info(f"Novel backend: {args.novel_backend}. Job: {args.job_index}")
+        logger.info(f"Seed: {args.seed}. Job: {args.job_index}")
+        logger.info(f"Resume: {args.resume}. Job: {args.job_index}")
+        logger.info(
+            f"Compatible format: {args.compatible_format}. Job: {args.job_index}"
+        )
         readmapper = cp.ReadMapper(
             target=args.target,
             bam_path=args.bam,
@@ -315,12 +409,19 @@ def main():
             truncation_match=args.truncation_match,
             platform=args.platform,
             reference_gtf_path=args.reference,
+            workers=args.job_workers,
+            sweep=args.sweep,
+            novel_backend=args.novel_backend,
+            seed=args.seed,
+            resume=args.resume,
+            compatible_format=args.compatible_format,
             logger=logger,
         )
         readmapper.map_reads_allgenes(
             cover_existing=True,
             total_jobs=args.total_jobs,
             current_job_index=args.job_index,
+            schedule=args.schedule,
             logger=logger,
         )
         logger.info(
@@ -345,6 +446,10 @@ def main():
         logger.info(f"Workers: {args.workers}")
         logger.info(f"saving count matrix csv: {args.save_csv}")
         logger.info(f"saving count matrix mtx: {args.save_mtx}")
+        logger.info(f"saving count matrix h5ad: {args.save_h5ad}")
+        logger.info(f"saving count matrix zarr: {args.save_zarr}")
+        logger.info(f"Seed: {args.seed}")
+        logger.info(f"Quantification: {args.quant}")
         countmatrix = cm.CountMatrix(
             target=args.target,
             novel_read_n=args.novel_read_n,
@@ -354,6 +459,10 @@ def main():
             logger=logger,
             csv=args.save_csv,
             mtx=args.save_mtx,
+            h5ad=args.save_h5ad,
+            zarr=args.save_zarr,
+            seed=args.seed,
+            quant=args.quant,
         )
         if args.platform == "parse":
             assert len(args.target) == 1, (
@@ -378,7 +487,7 @@ def main():
             logger.info(
                 f"Start summarizing read mapping information for target: {args.target[i]}"
             )
-            cp.summarise_auxillary(args.target[i], logger)
+            cp.summarise_auxillary(args.target[i], logger, seed=args.seed)
         logger.info(
             "Completed summarizing annotations and auxiliary information for all targets."
         )
@@ -1,5 +1,6 @@
 import pandas as pd
 import pickle
+import hashlib
 from itertools import chain
 import numpy as np
 import os
@@ -7,6 +8,7 @@ from Bio.Seq import Seq
 import networkx as nx
 import community.community_louvain as community_louvain
 from collections import defaultdict
+from compatible_store import save_compatible_npz
 
 #bam="/scr1/users/xu3/singlecell/project_singlecell/sample8_R10/bam/sample8_R10.filtered.bam"
 #gene_pkl="/scr1/users/xu3/singlecell/project_singlecell/M4/reference/geneStructureInformation.pkl"
@@ -23,6 +25,16 @@ def find_subfolder(root, subfolder):
             subfolder_paths.append(os.path.join(root, subfolder))
     return subfolder_paths
 
+def gene_seed(seed, key):
+    #random seed of one gene (or read) derived from the global seed and its identifier, the same in every run and job; None if seed is None
+    if seed is None:
+        return None
+    key = int.from_bytes(hashlib.sha256(str(key).encode()).digest()[:8], 'little')
+    return int(np.random.SeedSequence([seed, key]).generate_state(1)[0])
+
+def gene_rng(seed, key):
+    return np.random.default_rng(gene_seed(seed, key))
+
 def sort_multigeneInfo(Info_multigenes):
     Info_multigenes_sort = []
     for info_singlegene in Info_multigenes:
@@ -96,22 +108,146 @@ def isoformInfo_to_onehot(isoformInfo, geneInfo = None, nExon=None):
     return assignment_vectors
 
 
+class GeneModel:
+    def __init__(self, Info_singlegene, small_exon_threshold=0, small_exon_threshold1=80):
+        """
+        per-gene isoform matrices compiled once and shared by all reads of the gene in map_read_to_gene(_parse)
+        Info_singlegene: [geneInfo, exonInfo, isoformInfo]; geneInfo['isoformNames'] is set to the long to short isoform order
+        small_exon_threshold, small_exon_threshold1: must be the values used to map reads with this model
+        """
+        geneInfo, exonInfo, isoformInfo = Info_singlegene
+        self.exonInfo = exonInfo
+        self.exonLength = [b - a for a, b in exonInfo]
+        self.isoformInfo = dict(sorted(isoformInfo.items(), key=lambda item: len(item[1]), reverse=True))  # long to short
+        self.isoformNames = list(self.isoformInfo.keys())
+        geneInfo['isoformNames'] = self.isoformNames
+        self.hitIntervals = exon_hit_intervals(exonInfo)
+        # isoform - exon one hot encoding with 1/-1, as isoformInfo_to_onehot
+        onehot = np.array(isoformInfo_to_onehot(self.isoformInfo, geneInfo), dtype=np.int8)
+        onehot = onehot.reshape(len(self.isoformNames), geneInfo['numofExons'])
+        self.isoform_ones = (onehot == 1).astype(int)
+        self.isoform_minus_ones = (onehot == -1).astype(int)
+        # exon length sum of each isoform for mapping scores
+        self.isoformLength = [sum(length for k, length in enumerate(self.exonLength) if k in exons) for exons in self.isoformInfo.values()]
+        # exons considered for inclusion and exclusion, and the ladder of lifted small exon thresholds
+        exonLength = np.array(self.exonLength, dtype=np.int64)
+        self.small_exon_threshold = small_exon_threshold
+        self.qualifyExon = exonLength >= small_exon_threshold
+        threshold = max(small_exon_threshold, min(small_exon_threshold1, np.mean(self.exonLength)))
+        self.threshold_ladder = [(new_threshold, exonLength >= new_threshold)
+                                 for new_threshold in range(small_exon_threshold+10, int(threshold)+1, 10)]
+
+    def exon_hit_bases(self, read):
+        return exon_hit_bases(read.get_blocks(), self.exonInfo, self.hitIntervals)
+
+    def compatible_matrix(self, read_exon_maps, exon_map_pcts, threshold_high, threshold_low, qualify, chunk_size=2**20):
+        """
+        read - isoform compatible matrix of a batch of reads: isoforms without conflicting exons, the closest one when several
+        read_exon_maps: reads x exons int8 matrix of 1/0/-1; exons outside qualify are set to 0
+        exon_map_pcts: reads x exons read-exon mapping percentages
+        """
+        read_exon_maps = np.where(qualify, read_exon_maps, 0)
+        conflict_matrix = (read_exon_maps == -1).astype(int) @ self.isoform_ones.T + \
+                          (read_exon_maps == 1).astype(int) @ self.isoform_minus_ones.T
+        compatible_matrix = (conflict_matrix == 0).astype(int)
+        # assign the cloest isoform to reads compatible with multiple isoforms
+        multiple = np.flatnonzero(compatible_matrix.sum(axis=1) > 1)
+        step = max(1, chunk_size // max(1, self.isoform_ones.size))
+        for k in range(0, len(multiple), step):
+            rows = multiple[k:k + step]
+            read_pct = exon_map_pcts[rows]
+            transformed_read_pct = np.where(read_pct > threshold_high, 1, np.where(read_pct < threshold_low, 0,
+                                                  (read_pct - threshold_low) / (threshold_high-threshold_low)))
+            distances = abs(self.isoform_ones[np.newaxis, :, :] - transformed_read_pct[:, np.newaxis, :]).sum(axis=2)
+            distances[compatible_matrix[rows] == 0] = np.inf
+            min_index = np.argmin(distances, axis=1)
+            compatible_matrix[rows] = 0
+            compatible_matrix[rows, min_index] = 1
+        return compatible_matrix
+
+    def assign_isoforms(self, read_exon_maps, exon_map_pcts, threshold_high, threshold_low):
+        """
+        read - isoform compatible matrix of a batch of reads, lifting the small exon threshold for reads with no or multiple compatible isoforms
+        """
+        compatible_matrix = self.compatible_matrix(read_exon_maps, exon_map_pcts, threshold_high, threshold_low, self.qualifyExon)
+        small_exon_threshold = np.full(len(compatible_matrix), self.small_exon_threshold)
+        # when accounting for small exons lead to no mappings -- try out lifting thresholds for small exons
+        rows = np.flatnonzero(compatible_matrix.sum(axis=1) == 0)
+        for new_threshold, qualifyExon_new in self.threshold_ladder:
+            if len(rows) == 0:
+                break
+            compatible_matrix_secondary = self.compatible_matrix(read_exon_maps[rows], exon_map_pcts[rows],
+                                                                 threshold_high, threshold_low, qualifyExon_new)
+            hit = compatible_matrix_secondary.sum(axis=1) > 0
+            compatible_matrix[rows[hit]] = compatible_matrix_secondary[hit]
+            small_exon_threshold[rows[hit]] = new_threshold
+            rows = rows[~hit]
+        # when accounting for small exons lead to multiple mappings -- try out lifting thresholds for small exons
+        rows = np.flatnonzero(compatible_matrix.sum(axis=1) > 1)
+        for new_threshold, qualifyExon_new in self.threshold_ladder:
+            if len(rows) == 0:
+                break
+            lifted = rows[new_threshold >= small_exon_threshold[rows] + 10]
+            if len(lifted) == 0:
+                continue
+            compatible_matrix_secondary = self.compatible_matrix(read_exon_maps[lifted], exon_map_pcts[lifted],
+                                                                 threshold_high, threshold_low, qualifyExon_new)
+            hit = compatible_matrix_secondary.sum(axis=1) == 1
+            compatible_matrix[lifted[hit]] = compatible_matrix_secondary[hit]
+            rows = np.setdiff1d(rows, lifted[hit])
+        return compatible_matrix
 
+    def mapping_scores(self, compatible_matrix, n_mapExons):
+        # reads x isoforms mapping scores: aligned bases over isoform length if compatible, otherwise -1
+        scores = n_mapExons[:, np.newaxis] / np.array(self.isoformLength, dtype=np.int64)[np.newaxis, :]
+        return np.where(compatible_matrix == 0, -1, scores)
 
 
-#---------------some functions for novel reads----------------------#
-def read_similarity(df_assign):
-    data = df_assign.to_numpy()
-    ones = (data == 1).astype(int)
-    minus_ones = (data == -1).astype(int)
-    conflict_matrix = np.tensordot(ones, minus_ones, axes=([1], [1]))
-    similarity_matrix = (conflict_matrix == 0).astype(int)
-    consistent_matrix = np.tensordot(ones, ones, axes=([1], [1]))+np.tensordot(minus_ones, minus_ones, axes=([1], [1]))
-    similarity_matrix = similarity_matrix*consistent_matrix
-    np.fill_diagonal(similarity_matrix, 0)
-    return similarity_matrix
 
 
+#---------------some functions for novel reads----------------------#
+# number of set bits of every byte, used when numpy has no bitwise_count
+POPCOUNT_TABLE = np.array([bin(k).count('1') for k in range(256)], dtype=np.uint8)
+
+def pack_exon_assignments(data):
+    """
+    bit-packed exon assignments: rows of 1/0/-1 to uint64 bitmasks of included (1) and excluded (-1) exons, 64 exons per word
+    data: rows x exons matrix, e.g. df_assign.to_numpy()
+    return: included, excluded; rows x words uint64 arrays
+    """
+    data = np.asarray(data)
+    n, nExon = data.shape
+    n_words = max(1, -(-nExon // 64))
+    def pack(mask):
+        padded = np.zeros((n, n_words * 64), dtype=bool)
+        padded[:, :nExon] = mask
+        return np.packbits(padded, axis=1).view(np.uint64)
+    return pack(data == 1), pack(data == -1)
+
+def popcount(words):
+    # number of set bits summed over the last axis
+    if hasattr(np, 'bitwise_count'):
+        return np.bitwise_count(words).sum(axis=-1, dtype=np.int64)
+    words = np.ascontiguousarray(words)
+    return POPCOUNT_TABLE[words.view(np.uint8)].sum(axis=-1, dtype=np.int64)
+
+def exon_conflicts(packed, packed_other, both_ways=True, chunk_size=2**22):
+    """
+    rows x other rows boolean matrix, True if an exon included in the row is excluded in the other row
+    (or, with both_ways, an exon excluded in the row is included in the other row)
+    packed, packed_other: (included, excluded) as given by pack_exon_assignments
+    """
+    included, excluded = packed
+    included_other, excluded_other = packed_other
+    conflicts = np.empty((len(included), len(included_other)), dtype=bool)
+    step = max(1, chunk_size // max(1, included_other.size))
+    for k in range(0, len(included), step):
+        hit = included[k:k + step, np.newaxis, :] & excluded_other[np.newaxis, :, :]
+        if both_ways:
+            hit |= excluded[k:k + step, np.newaxis, :] & included_other[np.newaxis, :, :]
+        conflicts[k:k + step] = hit.any(axis=2)
+    return conflicts
+
 def novelid_to_exonid(novelid):
     exonid = []
     position = 0
@@ -122,29 +258,87 @@ def novelid_to_exonid(novelid):
         position += 1
     return exonid
 
-def find_novel(df_assign):
+def collapse_exon_assignments(data):
+    """
+    identical rows of 1/0/-1 collapsed into unique assignment patterns
+    return: patterns in order of first appearance, pattern index of every row, number of rows of every pattern
+    """
+    data = np.asarray(data)
+    # group rows by their bit-packed words, numbering groups by first appearance
+    words = pd.DataFrame(np.hstack(pack_exon_assignments(data)))
+    inverse = words.groupby(list(words.columns), sort=False).ngroup().to_numpy()
+    _, first, counts = np.unique(inverse, return_index=True, return_counts=True)
+    return data[first], inverse, counts
+
+def pattern_similarity_edges(patterns, counts, chunk_size=2**22):
+    """
+    sparse weighted edges between compatible assignment patterns, each pattern standing for counts reads
+    a pair of reads is similar if neither includes an exon the other excludes, weighted by the number of exons both include or both exclude;
+    the weight of an edge sums all read pairs of the two patterns, a self-loop all read pairs within the pattern
+    return: sources, targets (sources <= targets), weights
+    """
+    included, excluded = pack_exon_assignments(patterns)
+    counts = np.asarray(counts, dtype=np.int64)
+    sources, targets, weights = [], [], []
+    step = max(1, chunk_size // max(1, included.size))
+    for k in range(0, len(included), step):
+        rows = slice(k, k + step)
+        consistent_matrix = popcount(included[rows, np.newaxis, :] & included[np.newaxis, :, :]) + \
+                            popcount(excluded[rows, np.newaxis, :] & excluded[np.newaxis, :, :])
+        consistent_matrix[exon_conflicts((included[rows], excluded[rows]), (included, excluded))] = 0
+        i, j = np.nonzero(consistent_matrix)
+        similarity = consistent_matrix[i, j]
+        i = i + k
+        keep = j >= i
+        i, j, similarity = i[keep], j[keep], similarity[keep]
+        pairs = np.where(i == j, counts[i] * (counts[i] - 1) // 2, counts[i] * counts[j])
+        keep = pairs > 0
+        sources.append(i[keep])
+        targets.append(j[keep])
+        weights.append(similarity[keep] * pairs[keep])
+    return np.concatenate(sources), np.concatenate(targets), np.concatenate(weights)
+
+def partition_patterns(n, sources, targets, weights, backend='louvain', seed=None):
+    #community of every pattern; louvain by python-louvain, leiden (modularity) by igraph; seed fixes the partition
+    if backend == 'leiden':
+        import random
+        import igraph as ig
+        graph = ig.Graph(n=n, edges=list(zip(sources.tolist(), targets.tolist())))
+        graph.es['weight'] = weights.tolist()
+        ig.set_random_number_generator(random.Random(seed))
+        try:
+            membership = graph.community_leiden(objective_function='modularity', weights='weight', n_iterations=-1).membership
+        finally:
+            ig.set_random_number_generator(random)
+        return np.asarray(membership, dtype=np.int64)
+    if backend != 'louvain':
+        raise ValueError('unknown community detection backend: ' + str(backend))
+    G = nx.Graph()
+    G.add_nodes_from(range(n))
+    G.add_weighted_edges_from(zip(sources.tolist(), targets.tolist(), weights.tolist()))
+    partition = community_louvain.best_partition(G, random_state=seed)
+    return np.array([partition[p] for p in range(n)], dtype=np.int64)
+
+def find_novel(df_assign, backend='louvain', seed=None, counts=None):
+    #df_assign: row: read (or assignment pattern standing for counts reads); col: exon; -1/0/1
     if len(df_assign)==0:
         return None, None
-    similarity_matrix_assign = read_similarity(df_assign)
-    G = nx.Graph()
-    for i in range(len(df_assign)):
-        G.add_node(i)
-    for i in range(len(similarity_matrix_assign)):
-        for j in range(i + 1, len(similarity_matrix_assign)):
-            if similarity_matrix_assign[i][j] > 0:
-                G.add_edge(i, j, weight=similarity_matrix_assign[i][j])
-    partition = community_louvain.best_partition(G)
-    read_groups = defaultdict(list)
-    for read, group in partition.items():
-        read_groups[group].append(read)
+    patterns, inverse, multiplicity = collapse_exon_assignments(df_assign.to_numpy())
+    if counts is not None:
+        multiplicity = np.bincount(inverse, weights=counts, minlength=len(patterns)).astype(np.int64)
+    sources, targets, weights = pattern_similarity_edges(patterns, multiplicity)
+    membership = partition_patterns(len(patterns), sources, targets, weights, backend, seed)
+    # reads of patterns without any edge are left alone, as single read groups
+    connected = np.zeros(len(patterns), dtype=bool)
+    connected[sources] = True
+    connected[targets] = True
     novelisoform_dict, assigns = {}, []  ##this is what i want
-    for k in range(len(read_groups)):
-        if len(read_groups[k]) > 1:
-            #assign = df_assign.iloc[read_groups[k]].mode().iloc[0].tolist()
-            df = df_assign.iloc[read_groups[k]]
-            count_1 = (df == 1).sum()
-            count_neg1 = (df == -1).sum()
-            assign = [(1 if count_1[col] > count_neg1[col] else -1) for col in df.columns]
+    for group in dict.fromkeys(membership[connected].tolist()):
+        members = np.flatnonzero((membership == group) & connected)
+        if multiplicity[members].sum() > 1:
+            count_1 = (patterns[members] == 1).T.astype(np.int64) @ multiplicity[members]
+            count_neg1 = (patterns[members] == -1).T.astype(np.int64) @ multiplicity[members]
+            assign = np.where(count_1 > count_neg1, 1, -1).tolist()
             isoform_index = [i for i, a in enumerate(assign) if a==1]
             if len(isoform_index)==0:
                 continue
@@ -158,7 +352,8 @@ def find_novel(df_assign):
 
 
 
-def polish_compatible_vectors(Read_novelIsoform, Read_Isoform_compatibleVector, n_isoforms, exonInfo, small_exon_threshold,small_exon_threshold1):
+def polish_compatible_vectors(Read_novelIsoform, Read_Isoform_compatibleVector, n_isoforms, exonInfo, small_exon_threshold,small_exon_threshold1,
+                              novel_backend='louvain', seed=None):
     ####generate novel isoform annotation
     if len(Read_novelIsoform)==1:
         Read_Isoform_compatibleVector.append((Read_novelIsoform[0][0], [0] * n_isoforms))
@@ -170,7 +365,8 @@ def polish_compatible_vectors(Read_novelIsoform, Read_Isoform_compatibleVector,
         #df_pct = pd.DataFrame.from_dict(novel_dict_pct, orient='index')
         df_assign = pd.DataFrame.from_dict(novel_dict_assign, orient='index')
         #novel_df_empty： sample names of novel_uncategorized
-        novelisoform_dict, novel_df, novel_df_empty = find_novel_by_chunk(df_assign, exonInfo, small_exon_threshold,small_exon_threshold1,chunk_size=1500)
+        novelisoform_dict, novel_df, novel_df_empty = find_novel_by_chunk(df_assign, exonInfo, small_exon_threshold,small_exon_threshold1,chunk_size=1500,
+                                                                          backend=novel_backend, seed=seed)
         if len(novelisoform_dict) > 0:
             read_novelisoform_tuples = [(row, col) for (row, col), value in novel_df.stack().items() if value == 1]
             for rd in novel_df_empty:
@@ -184,32 +380,42 @@ def polish_compatible_vectors(Read_novelIsoform, Read_Isoform_compatibleVector,
     return read_novelisoform_tuples, novelisoform_dict, Read_Isoform_compatibleVector
 
 
-def find_novel_by_chunk(df_assign, exonInfo, small_exon_threshold,small_exon_threshold1, chunk_size=1500):
-    df_assign_archive = df_assign.copy()
-    row_count = df_assign.shape[0]
-    num_chunks = max(1, np.ceil(row_count / chunk_size).astype(int))
-    #df_pct_list = np.array_split(df_pct, num_chunks)
-    df_assign_list = np.array_split(df_assign, num_chunks)
+def split_patterns(df_pattern, pattern_counts, chunk_size):
+    #split patterns into chunks of about chunk_size reads each
+    counts = pattern_counts.loc[df_pattern.index].to_numpy()
+    total = counts.sum()
+    num_chunks = max(1, np.ceil(total / chunk_size).astype(int))
+    chunk_index = (np.cumsum(counts) - counts) * num_chunks // max(1, total)
+    return [df_pattern[chunk_index == k] for k in np.unique(chunk_index)]
+
+def find_novel_by_chunk(df_assign, exonInfo, small_exon_threshold,small_exon_threshold1, chunk_size=1500, backend='louvain', seed=None):
+    # reads sharing an assignment vector are handled once, as a pattern weighted by its number of reads;
+    # patterns are visited from the most to the least supported, in chunks of about chunk_size reads,
+    # and mappings of patterns are expanded back to reads at the end
+    patterns, inverse, counts = collapse_exon_assignments(df_assign.to_numpy())
+    read_pattern = pd.Series(inverse, index=df_assign.index)
+    pattern_counts = pd.Series(counts)
+    df_pattern = pd.DataFrame(patterns, columns=df_assign.columns)
+    df_pattern_archive = df_pattern
+    df_pattern = df_pattern.iloc[np.argsort(-counts, kind='stable')]
+    df_pattern_list = split_patterns(df_pattern, pattern_counts, chunk_size)
     novelisoform_dict_list, novel_df_list, novel_df_empty = [], [], []
     i = 0
-    print(str(len(df_assign_list)) + ' chunks in total')
-    while i < len(df_assign_list):
-        print('chunk ' + str(i) + ' out of ' + str(len(df_assign_list)))
+    print(str(len(df_pattern_list)) + ' chunks in total')
+    while i < len(df_pattern_list):
+        print('chunk ' + str(i) + ' out of ' + str(len(df_pattern_list)))
         # find novel isoform annotation from the chunk
-        novelisoform_dict, assigns = find_novel(df_assign_list[i])
-        novelisoform_dict, novel_df, novel_df_empty = map_read_to_novelisoform(novelisoform_dict, assigns, df_assign,
+        novelisoform_dict, assigns = find_novel(df_pattern_list[i], backend, seed,
+                                                counts=pattern_counts.loc[df_pattern_list[i].index].to_numpy())
+        novelisoform_dict, novel_df, novel_df_empty = map_read_to_novelisoform(novelisoform_dict, assigns, df_pattern,
                                                                                exonInfo, small_exon_threshold, small_exon_threshold1)
         if novel_df is not None:
-            if novel_df.shape[0] >= 10:
+            if pattern_counts.loc[novel_df.index].sum() >= 10:
                 novelisoform_dict_list.append(novelisoform_dict)
                 novel_df_list.append(novel_df)
                 # update split
-                df_assign = df_assign.loc[novel_df_empty]
-                #df_pct = df_pct.loc[novel_df_empty]
-                row_count = df_assign.shape[0]
-                num_chunks = max(1, np.ceil(row_count / chunk_size).astype(int))
-                #df_pct_list = np.array_split(df_pct, num_chunks)
-                df_assign_list = np.array_split(df_assign, num_chunks)
+                df_pattern = df_pattern.loc[novel_df_empty]
+                df_pattern_list = split_patterns(df_pattern, pattern_counts, chunk_size)
             else:
                 i += 1
         else:
@@ -220,10 +426,15 @@ def find_novel_by_chunk(df_assign, exonInfo, small_exon_threshold,small_exon_thr
     assigns = isoformInfo_to_onehot(novelisoform_dict, geneInfo=None, nExon=len(exonInfo))
     # can allow many multiple mapping to reduce novel isoform number
     novelisoform_dict, novel_df, novel_df_empty = map_read_to_novelisoform_loss(novelisoform_dict, assigns,
-                                                                           df_assign_archive, exonInfo,
+                                                                           df_pattern_archive, exonInfo,
                                                                            small_exon_threshold,small_exon_threshold1)
     if novelisoform_dict is None:
-        novelisoform_dict = {}
+        return {}, None, None
+    # expand pattern mappings to reads, in read order
+    mapped = read_pattern.isin(novel_df.index)
+    novel_df = novel_df.loc[read_pattern[mapped].to_numpy()]
+    novel_df.index = read_pattern.index[mapped]
+    novel_df_empty = read_pattern.index[~mapped].tolist()
     return novelisoform_dict, novel_df, novel_df_empty
 
 
@@ -367,27 +578,49 @@ def merge_exons(exons):
     return merged_exons
 
 
-def read_exon_match(read, Info_singlegene):
+def read_exon_match(read, Info_singlegene, model=None):
     readName, readStart, readEnd = read.qname, read.reference_start, read.reference_end
-    referencePositions = read.get_reference_positions(full_length=False)
     geneInfo, exonInfo, isoformInfo = Info_singlegene
     gene_name =geneInfo['geneName']
     gene_length = geneInfo['geneEnd'] - geneInfo['geneStart']
     overlap_length = max(0, max(readEnd, geneInfo['geneEnd']) - min(readStart, geneInfo['geneStart']))
-    mapExons = exon_hit(referencePositions, exonInfo)
-    n_mapExons=len(mapExons)
+    exon_map_base = exon_hit_bases(read.get_blocks(), exonInfo) if model is None else model.exon_hit_bases(read)
+    n_mapExons = int(exon_map_base.sum())
     return gene_name, overlap_length, gene_length, n_mapExons
 
 
-def exon_hit(mapPositions, exonInfo):
-    mapExons = []
-    exon_index = 0
-    for i in mapPositions:
-        while i >= exonInfo[exon_index][1] and exon_index < len(exonInfo) - 1:
-            exon_index += 1
-        if int(i) >= int(exonInfo[exon_index][0]) and int(i) < int(exonInfo[exon_index][1]):
-            mapExons.append(exon_index)
-    return mapExons
+def exon_hit_intervals(exonInfo):
+    # an aligned position p counts for the first exon ending after p, if it starts at or before p, so exon j counts the bases in [max(start_j, end of exons before j), end_j)
+    exons = np.asarray(exonInfo, dtype=np.int64).reshape(-1, 2)
+    exonEnds = exons[:, 1]
+    if len(exons) == 0:
+        return exonEnds, exonEnds
+    previousEnds = np.maximum.accumulate(exonEnds)
+    hitStarts = np.maximum(exons[:, 0], np.concatenate(([np.iinfo(np.int64).min], previousEnds[:-1])))
+    return hitStarts, exonEnds
+
+
+def exon_hit_bases(blocks, exonInfo, hitIntervals=None):
+    """
+    number of aligned bases of a read counted for each exon
+    blocks: read.get_blocks(), sorted and non-overlapping aligned reference intervals
+    hitIntervals: exon_hit_intervals(exonInfo), computed here if None
+    """
+    hitStarts, exonEnds = exon_hit_intervals(exonInfo) if hitIntervals is None else hitIntervals
+    exon_map_base = np.zeros(len(exonEnds), dtype=np.int64)
+    if len(blocks) == 0 or len(exonEnds) == 0:
+        return exon_map_base
+    blocks = np.asarray(blocks, dtype=np.int64).reshape(-1, 2)
+    blockStarts, blockEnds = blocks[:, 0], blocks[:, 1]
+    blockCumLength = np.concatenate(([0], np.cumsum(blockEnds - blockStarts)))
+    def aligned_before(x):
+        # number of aligned bases before reference position x
+        k = np.searchsorted(blockEnds, x, side='right')
+        partial = np.maximum(x - blockStarts[np.minimum(k, len(blockStarts) - 1)], 0)
+        return blockCumLength[k] + np.where(k < len(blockStarts), partial, 0)
+    valid = hitStarts < exonEnds
+    exon_map_base[valid] = aligned_before(exonEnds[valid]) - aligned_before(hitStarts[valid])
+    return exon_map_base
 
 #---------------some functions for read-isoform operations-----------------#
 
@@ -446,10 +679,13 @@ def detect_poly_parse(read, window = 20, n = 15):
         poly = None
     return poly_bool, poly
 
-def choose_gene_from_meta(read, Info_multigenes, lowest_match=0.2,lowest_match1=0.8,  small_exon_threshold = 20, small_exon_threshold1=100, truncation_match=0.5, pacbio = False):
+def choose_gene_from_meta(read, Info_multigenes, lowest_match=0.2,lowest_match1=0.8,  small_exon_threshold = 20, small_exon_threshold1=100, truncation_match=0.5, pacbio = False, models = None):
+    # models: GeneModel of each gene in Info_multigenes, compiled here if None
+    if models is None:
+        models = [GeneModel(info_singlegene, small_exon_threshold, small_exon_threshold1) for info_singlegene in Info_multigenes]
     results = []
     for i, info_singlegene in enumerate(Info_multigenes):
-        gene_name, read_coverage, gene_length, n_mapExons = read_exon_match(read, info_singlegene)
+        gene_name, read_coverage, gene_length, n_mapExons = read_exon_match(read, info_singlegene, models[i])
         results.append({
             'geneName': gene_name,
             'readCoverage': read_coverage,
@@ -465,7 +701,7 @@ def choose_gene_from_meta(read, Info_multigenes, lowest_match=0.2,lowest_match1=
         ind = df_intron['index'][0]
         read_novelisoform_tuple, read_isoform_compatibleVector_tuple, mapping_scores = map_read_to_gene(read,
                                                                                         Info_multigenes[ind],
-                                                                                        lowest_match,  lowest_match1, small_exon_threshold, small_exon_threshold1, truncation_match, pacbio = pacbio)
+                                                                                        lowest_match,  lowest_match1, small_exon_threshold, small_exon_threshold1, truncation_match, pacbio = pacbio, model = models[ind])
     elif (df_exon.shape[0] > 0):  # the read locates within at least one gene region
         df_exon = df_exon.sort_values(by=['nMapExons', 'readCoverage', 'geneLength'], ascending=[False, False, False])
         if sum(df_exon.nMapExons) >= 2:
@@ -477,7 +713,7 @@ def choose_gene_from_meta(read, Info_multigenes, lowest_match=0.2,lowest_match1=
                 read_novelisoform_tuple_, read_isoform_compatibleVector_tuple_, mapping_scores_ = map_read_to_gene(read,
                                                                                                   Info_multigenes[ind],
                                                                                                   lowest_match,lowest_match1, small_exon_threshold,small_exon_threshold1,
-                                                                                                  truncation_match, pacbio = pacbio)
+                                                                                                  truncation_match, pacbio = pacbio, model = models[ind])
                 read_novelisoform_tuple_dict[ind] = read_novelisoform_tuple_
                 read_isoform_compatibleVector_tuple_dict[ind] = read_isoform_compatibleVector_tuple_
                 read_mapping_scores_dict[ind] = mapping_scores_
@@ -498,15 +734,18 @@ def choose_gene_from_meta(read, Info_multigenes, lowest_match=0.2,lowest_match1=
             read_novelisoform_tuple, read_isoform_compatibleVector_tuple, mapping_scores = map_read_to_gene(read,
                                                                                             Info_multigenes[ind],
                                                                                             lowest_match,lowest_match1, small_exon_threshold,small_exon_threshold1,
-                                                                                            truncation_match, pacbio=pacbio)
+                                                                                            truncation_match, pacbio=pacbio, model=models[ind])
     else:
         read_novelisoform_tuple, read_isoform_compatibleVector_tuple, mapping_scores, ind = None, None, None, -1
     return ind, read_novelisoform_tuple, read_isoform_compatibleVector_tuple, mapping_scores
 
-def choose_gene_from_meta_parse(read, Info_multigenes, lowest_match=0.2, lowest_match1=0.8, small_exon_threshold = 20, small_exon_threshold1=100, truncation_match =0.5, poly=False):
+def choose_gene_from_meta_parse(read, Info_multigenes, lowest_match=0.2, lowest_match1=0.8, small_exon_threshold = 20, small_exon_threshold1=100, truncation_match =0.5, poly=False, models = None):
+    # models: GeneModel of each gene in Info_multigenes, compiled here if None
+    if models is None:
+        models = [GeneModel(info_singlegene, small_exon_threshold, small_exon_threshold1) for info_singlegene in Info_multigenes]
     results = []
     for i, info_singlegene in enumerate(Info_multigenes):
-        gene_name, read_coverage, gene_length, n_mapExons = read_exon_match(read, info_singlegene)
+        gene_name, read_coverage, gene_length, n_mapExons = read_exon_match(read, info_singlegene, models[i])
         results.append({
             'geneName': gene_name,
             'readCoverage': read_coverage,
@@ -524,7 +763,7 @@ def choose_gene_from_meta_parse(read, Info_multigenes, lowest_match=0.2, lowest_
                                                                                         Info_multigenes[ind],
                                                                                         lowest_match, lowest_match1, small_exon_threshold,
                                                                                               small_exon_threshold1,
-                                                                                              truncation_match, poly=poly)
+                                                                                              truncation_match, poly=poly, model=models[ind])
     elif (df_exon.shape[0] > 0):  # the read locates within at least one gene region
         df_exon = df_exon.sort_values(by=['nMapExons', 'readCoverage', 'geneLength'], ascending=[False, False, False])
         if sum(df_exon.nMapExons) >= 2:
@@ -534,7 +773,7 @@ def choose_gene_from_meta_parse(read, Info_multigenes, lowest_match=0.2, lowest_
             read_novelisoform_tuple_dict, read_isoform_compatibleVector_tuple_dict, readType, read_mapping_scores_dict = {}, {}, [], {}
             for ind in inds:
                 read_novelisoform_tuple_, read_isoform_compatibleVector_tuple_, mapping_scores_ = map_read_to_gene_parse(read,Info_multigenes[ind],
-                                                                                                  lowest_match, lowest_match1, small_exon_threshold, small_exon_threshold1,truncation_match, poly=poly)
+                                                                                                  lowest_match, lowest_match1, small_exon_threshold, small_exon_threshold1,truncation_match, poly=poly, model=models[ind])
                 read_novelisoform_tuple_dict[ind] = read_novelisoform_tuple_
                 read_isoform_compatibleVector_tuple_dict[ind] = read_isoform_compatibleVector_tuple_
                 read_mapping_scores_dict[ind] = mapping_scores_
@@ -554,13 +793,13 @@ def choose_gene_from_meta_parse(read, Info_multigenes, lowest_match=0.2, lowest_
             ind = df_exon['index'].tolist()[0]
             read_novelisoform_tuple, read_isoform_compatibleVector_tuple, mapping_scores = map_read_to_gene_parse(read,
                                                                                             Info_multigenes[ind],
-                                                                                            lowest_match, lowest_match1, small_exon_threshold, small_exon_threshold1, truncation_match, poly=poly)
+                                                                                            lowest_match, lowest_match1, small_exon_threshold, small_exon_threshold1, truncation_match, poly=poly, model=models[ind])
     else:
         read_novelisoform_tuple, read_isoform_compatibleVector_tuple,mapping_scores, ind = None, None,None, -1
     return ind, read_novelisoform_tuple, read_isoform_compatibleVector_tuple, mapping_scores
 
-def map_read_to_gene_parse(read, Info_singlegene, lowest_match=0.2, lowest_match1 = 0.8, small_exon_threshold = 20, small_exon_threshold1 = 100,
-                           truncation_match = 0.5, poly = False):
+def read_gene_profile_parse(read, Info_singlegene, model, lowest_match=0.2, lowest_match1 = 0.8, truncation_match = 0.5, poly = False):
+    # read - exon mapping of one read to one gene before isoform assignment, see assign_reads_to_gene
     def generate_read_exon_map_vector(exon_map_pct):
         # read-exon mapping vector
         exon_map_vector_mapped = [1 if pct >= upper_match else 0 for pct in exon_map_pct]
@@ -590,20 +829,17 @@ def map_read_to_gene_parse(read, Info_singlegene, lowest_match=0.2, lowest_match
         return exon_map_vector_trunct
     #optional: geneInfo,exonInfo, isoformInfo, qualifyExon, exonMatch
     readName, readStart, readEnd = read.qname, read.reference_start, read.reference_end
-    referencePositions = read.get_reference_positions(full_length=False)
     geneInfo, exonInfo, isoformInfo = Info_singlegene
-    exonLength = [b - a for a, b in exonInfo]
-    isoformInfo = dict(sorted(isoformInfo.items(), key=lambda item: len(item[1]), reverse=True))  # long to short
-    geneInfo['isoformNames'] = list(isoformInfo.keys())
-    qualifyExon = [i for i, (a, b) in enumerate(exonInfo) if b - a >= small_exon_threshold]
+    exonLength = model.exonLength
+    isoformInfo = model.isoformInfo  # long to short
+    geneInfo['isoformNames'] = model.isoformNames
     lower_match , upper_match= lowest_match, lowest_match1
     #read_isoform_compatibleVector = [1] * len(geneInfo['isoformNames'])#initialize read isoform compativle vector
     #read-exon mapping percentage
-    mapExons = exon_hit(referencePositions, exonInfo)
+    exon_map_base = model.exon_hit_bases(read)
+    n_mapExons = int(exon_map_base.sum())
     exon_map_pct, exon_map_pct0, exon_map_vector_trunct = [], [], []
-    if len(mapExons) > 0:
-        exonhitbases = dict(pd.Series(mapExons).value_counts())
-        exon_map_base = [exonhitbases.get(i, 0) for i in range(len(exonInfo))]
+    if n_mapExons > 0:
         exon_map_pct = [round(base / (exonInfo[i][1] - exonInfo[i][0]), 2) if base else 0 for i, base in enumerate(exon_map_base)]
         exon_map_pct0 = exon_map_pct.copy()
         #------------------adjusted pct based on truncation----------------#
@@ -653,69 +889,17 @@ def map_read_to_gene_parse(read, Info_singlegene, lowest_match=0.2, lowest_match
         if all(x == 0 for x in exon_map_vector_trunct):
             exon_map_pct[exon_map_pct.index(max(exon_map_pct))]=1
             exon_map_vector_trunct = generate_read_exon_map_vector(exon_map_pct)
-        #do not consider non-qualified exons
-        isoform_exon_map_list = isoformInfo_to_onehot(isoformInfo, geneInfo)
-        exon_map_vector_trunct_conservative = [vec if i in qualifyExon else 0 for i,vec in enumerate(exon_map_vector_trunct)]
-        read_exon_map_list = exon_map_vector_trunct_conservative
-        read_isoform_compatibleVector = map_read_to_isoform_known(isoform_exon_map_list, read_exon_map_list, exon_map_pct,
-                                  lowest_match1, lowest_match, geneInfo['geneStrand'], qualifyExon, poly)
-        # when accounting for small exons lead to no mappings -- try out lifting threshold of small exons
-        if sum(read_isoform_compatibleVector) == 0:
-            threshold = max(small_exon_threshold, min(small_exon_threshold1, np.mean(exonLength)))
-            for new_threshold in range(small_exon_threshold+10, int(threshold)+1, 10):
-            #read_exon_map_list = exon_map_vector_trunct
-                qualifyExon_new = [i for i, (a, b) in enumerate(exonInfo) if b - a >= new_threshold]
-                read_exon_map_list = [vec if i in qualifyExon_new else 0 for i, vec in enumerate(exon_map_vector_trunct)]
-                read_isoform_compatibleVector_secondary = map_read_to_isoform_known(isoform_exon_map_list,
-                                                                                read_exon_map_list,
-                                                                                exon_map_pct,lowest_match1,lowest_match,
-                                                                                geneInfo['geneStrand'], qualifyExon)
-                if sum(read_isoform_compatibleVector_secondary) > 0:
-                    read_isoform_compatibleVector = read_isoform_compatibleVector_secondary
-                    small_exon_threshold = new_threshold
-                    break
-        # when accounting for small exons lead to multiple mappings -- try out lifting threshold of small exons
-        if sum(read_isoform_compatibleVector) > 1:
-            threshold = max(small_exon_threshold, min(small_exon_threshold1, np.mean(exonLength)))
-            for new_threshold in range(small_exon_threshold+10, int(threshold)+1, 10):
-                qualifyExon_new = [i for i, (a, b) in enumerate(exonInfo) if b - a >= new_threshold]
-                read_exon_map_list = [vec if i in qualifyExon_new else 0 for i, vec in
-                                      enumerate(exon_map_vector_trunct)]
-                #read_exon_map_list = exon_map_vector_trunct
-                read_isoform_compatibleVector_secondary = map_read_to_isoform_known(isoform_exon_map_list,
-                                                                                read_exon_map_list,
-                                                                                exon_map_pct,
-                                                                                lowest_match1,lowest_match,
-                                                                                geneInfo['geneStrand'], qualifyExon)
-                if sum(read_isoform_compatibleVector_secondary) == 1:
-                    read_isoform_compatibleVector = read_isoform_compatibleVector_secondary
-                    break
-    else:
-        # uncharacterized type3: not map to any exons---intron
-        read_isoform_compatibleVector = [0] * len(geneInfo['isoformNames'])
-    # ---calculate mapping scores: [-1,-1,0.5,-1]
-    isoform_names = list(isoformInfo.keys())
-    mapping_scores = []
-    for i, isoform_name in enumerate(isoform_names):
-        if read_isoform_compatibleVector[i] == 0:
-            mapping_score = -1
-        else:  # compatible_vector[i]==1
-            exon_index_list = isoformInfo[isoform_name]
-            exon_lengths = [(b - a) for k, (a, b) in enumerate(exonInfo) if k in exon_index_list]
-            mapping_score = len(mapExons) / sum(exon_lengths)
-        mapping_scores.append(mapping_score)
-    #---novel/uncharacterized+existing compatible vector
-    read_novelisoform_tuple, read_isoform_compatibleVector_tuple = None, None
-    # novel isoform
-    if sum(read_isoform_compatibleVector) == 0 and len(mapExons) > 0:
-        read_novelisoform_tuple = (readName, exon_map_pct0, exon_map_vector_trunct)
-    else:  # existing isoform/uncategorized
-        read_isoform_compatibleVector_tuple = (readName, read_isoform_compatibleVector)
-    return read_novelisoform_tuple, read_isoform_compatibleVector_tuple, mapping_scores
-
+    return readName, n_mapExons, exon_map_pct, exon_map_pct0, exon_map_vector_trunct
 
-def map_read_to_gene(read, Info_singlegene, lowest_match=0.2, lowest_match1 = 0.6, small_exon_threshold = 0, small_exon_threshold1=80,
-                     truncation_match = 0.4, pacbio = False):
+def map_read_to_gene_parse(read, Info_singlegene, lowest_match=0.2, lowest_match1 = 0.8, small_exon_threshold = 20, small_exon_threshold1 = 100,
+                           truncation_match = 0.5, poly = False, model = None):
+    if model is None:
+        model = GeneModel(Info_singlegene, small_exon_threshold, small_exon_threshold1)
+    profile = read_gene_profile_parse(read, Info_singlegene, model, lowest_match, lowest_match1, truncation_match, poly)
+    return assign_reads_to_gene([profile], model, lowest_match, lowest_match1)[0]
+
+def read_gene_profile(read, Info_singlegene, model, lowest_match=0.2, lowest_match1 = 0.6, truncation_match = 0.4, pacbio = False):
+    # read - exon mapping of one read to one gene before isoform assignment, see assign_reads_to_gene
     def generate_read_exon_map_vector(exon_map_pct):
         # read-exon mapping vector
         exon_map_vector_mapped = [1 if pct >= upper_match else 0 for pct in exon_map_pct]
@@ -737,20 +921,17 @@ def map_read_to_gene(read, Info_singlegene, lowest_match=0.2, lowest_match1 = 0.
     readName, readStart, readEnd = read.qname, read.reference_start, read.reference_end
     if pacbio:
         readName = readName + '_' + str(readEnd - readStart)
-    referencePositions = read.get_reference_positions(full_length=False)
     geneInfo, exonInfo, isoformInfo = Info_singlegene
-    exonLength = [b-a for a,b in exonInfo]
-    isoformInfo = dict(sorted(isoformInfo.items(), key=lambda item: len(item[1]), reverse=True))  # long to short
-    geneInfo['isoformNames'] = list(isoformInfo.keys())
-    qualifyExon = [i for i, (a, b) in enumerate(exonInfo) if b - a >= small_exon_threshold]
+    exonLength = model.exonLength
+    isoformInfo = model.isoformInfo  # long to short
+    geneInfo['isoformNames'] = model.isoformNames
     lower_match, upper_match = lowest_match,lowest_match1
     #read_isoform_compatibleVector = [1] * len(geneInfo['isoformNames'])#initialize read isoform compativle vector
     #read-exon mapping percentage
-    mapExons = exon_hit(referencePositions, exonInfo)
+    exon_map_base = model.exon_hit_bases(read)
+    n_mapExons = int(exon_map_base.sum())
     exon_map_pct, exon_map_pct0, exon_map_vector_trunct = [], [], []
-    if len(mapExons) > 0:
-        exonhitbases = dict(pd.Series(mapExons).value_counts())
-        exon_map_base = [exonhitbases.get(i, 0) for i in range(len(exonInfo))]
+    if n_mapExons > 0:
         exon_map_pct = [round(base / (exonInfo[i][1] - exonInfo[i][0]), 2) if base else 0 for i, base in enumerate(exon_map_base)]
         exon_map_pct0 = exon_map_pct.copy()  # report original pct for novel isoform
         #adjust for truncation pct
@@ -774,184 +955,48 @@ def map_read_to_gene(read, Info_singlegene, lowest_match=0.2, lowest_match1 = 0.
         if sum(exon_map_vector_trunct) == 0:
             exon_map_pct[exon_map_pct.index(max(exon_map_pct))] = 1
             exon_map_vector_trunct = generate_read_exon_map_vector(exon_map_pct)
-        #do not consider non-qualified exons
-        isoform_exon_map_list = isoformInfo_to_onehot(isoformInfo, geneInfo)
-        exon_map_vector_trunct_conserve = [vec if i in qualifyExon else 0 for i, vec in enumerate(exon_map_vector_trunct)]
-        read_exon_map_list = exon_map_vector_trunct_conserve
-        read_isoform_compatibleVector = map_read_to_isoform_known(isoform_exon_map_list, read_exon_map_list, exon_map_pct,
-                                  lowest_match1,lowest_match, geneInfo['geneStrand'], qualifyExon)
-        # when accounting for small exons lead to no mappings -- try out lifting thresholds for small exons
-        if sum(read_isoform_compatibleVector) == 0:
-            threshold = max(small_exon_threshold, min(small_exon_threshold1, np.mean(exonLength)))
-            for new_threshold in range(small_exon_threshold+10, int(threshold)+1, 10):
-                # read_exon_map_list = exon_map_vector_trunct
-                qualifyExon_new = [i for i, (a, b) in enumerate(exonInfo) if b - a >= new_threshold]
-                read_exon_map_list = [vec if i in qualifyExon_new else 0 for i, vec in enumerate(exon_map_vector_trunct)]
-                read_isoform_compatibleVector_secondary = map_read_to_isoform_known(isoform_exon_map_list,
-                                                                                    read_exon_map_list,
-                                                                                    exon_map_pct,
-                                                                                    lowest_match1,lowest_match,
-                                                                                    geneInfo['geneStrand'], qualifyExon)
-                if sum(read_isoform_compatibleVector_secondary) > 0:
-                    read_isoform_compatibleVector = read_isoform_compatibleVector_secondary
-                    small_exon_threshold = new_threshold
-                    break
-        # when accounting for small exons lead to multiple mappings -- try out lifting thresholds for small exons
-        if sum(read_isoform_compatibleVector) > 1:
-            threshold = max(small_exon_threshold, min(small_exon_threshold1, np.mean(exonLength)))
-            for new_threshold in range(small_exon_threshold+10, int(threshold)+1, 10):
-                qualifyExon_new = [i for i, (a, b) in enumerate(exonInfo) if b - a >= new_threshold]
-                read_exon_map_list = [vec if i in qualifyExon_new else 0 for i, vec in
-                                      enumerate(exon_map_vector_trunct)]
-                # read_exon_map_list = exon_map_vector_trunct
-                read_isoform_compatibleVector_secondary = map_read_to_isoform_known(isoform_exon_map_list,
-                                                                                    read_exon_map_list,
-                                                                                    exon_map_pct,
-                                                                                    lowest_match1,lowest_match,
-                                                                                    geneInfo['geneStrand'], qualifyExon)
-                if sum(read_isoform_compatibleVector_secondary) == 1:
-                    read_isoform_compatibleVector = read_isoform_compatibleVector_secondary
-                    break
-    else:
-        # uncharacterized type3: not map to any exons---intron
-        read_isoform_compatibleVector = [0] * len(geneInfo['isoformNames'])
-    #---calculate mapping scores: [-1,-1,0.5,-1]
-    isoform_names = list(isoformInfo.keys())
-    mapping_scores = []
-    for i, isoform_name in enumerate(isoform_names):
-        if read_isoform_compatibleVector[i] == 0:
-            mapping_score = -1
-        else:  # compatible_vector[i]==1
-            exon_index_list = isoformInfo[isoform_name]
-            exon_lengths = [(b - a) for k, (a, b) in enumerate(exonInfo) if k in exon_index_list]
-            mapping_score = len(mapExons) / sum(exon_lengths)
-        mapping_scores.append(mapping_score)
-    #---novel/uncharacterized+existing compatible vector
-    read_novelisoform_tuple, read_isoform_compatibleVector_tuple = None, None
-    # novel isoform
-    if sum(read_isoform_compatibleVector) == 0 and len(mapExons) > 0:
-        read_novelisoform_tuple = (readName, exon_map_pct0, exon_map_vector_trunct)
-    else:  # existing isoform/uncategorized
-        read_isoform_compatibleVector_tuple = (readName, read_isoform_compatibleVector)
-    return read_novelisoform_tuple, read_isoform_compatibleVector_tuple, mapping_scores
-
-
-
-def map_read_to_isoform_known(isoform_exon_onehot_list, read_exon_map_list, exon_map_pct, threshold_high, threshold_low,
-                              geneStrand, qualifyExon, poly = True):
-    # isoform_exon_onehot_list: isoform - exon, one hot encoding [[-1,1,1],[1,1,1]]
-    #read_exon_map_list: [0,0,1]
-    #read_assignment_df: row: read - col: exon, values: 0,1,-1
-    #output: reduced isoformInfo_dict annotation; read - isoform compatible matrix, unmapped reads
-    def map_read_to_isoform_known_(isoform_exon_onehot_list, read_exon_map_list):
-        read_exon_df = pd.DataFrame([read_exon_map_list])
-        read_exon_array = read_exon_df.to_numpy()
-        isoform_exon_array = np.array(isoform_exon_onehot_list)
-        if isoform_exon_array.ndim == 1 or read_exon_array.ndim == 1:
-            return None
-        isoform_ones = (isoform_exon_array == 1).astype(int)
-        isoform_minus_ones = (isoform_exon_array == -1).astype(int)
-        reads_ones = (read_exon_array == 1).astype(int)
-        reads_minus_ones = (read_exon_array == -1).astype(int)
-        conflict_matrix = np.tensordot(isoform_ones, reads_minus_ones, axes=([1], [1])) + \
-                          np.tensordot(isoform_minus_ones, reads_ones, axes=([1], [1]))
-        compatible_matrix = (conflict_matrix == 0).astype(int).transpose()
-        return compatible_matrix, isoform_ones
-    compatible_matrix, isoform_ones = map_read_to_isoform_known_(isoform_exon_onehot_list, read_exon_map_list)
-    #multiple mapping
-    ####method1: treat the 5` truncation exon as mapped
-    #if compatible_matrix.sum()>1:
-        #exon_map_pct_update = exon_map_pct
-        #if poly: ######nanopore and parse poly true
-        #    if geneStrand=="+":
-        #        #change the first non-zero element pct = 1
-        #        for i, pct in enumerate(exon_map_pct_update):
-        #            if pct>0:
-        #                exon_map_pct_update[i] = 1
-        #                break
-        #        exon_map_vector_mapped = [1 if exon_map_p >= threshold_high else 0 for exon_map_p in exon_map_pct_update]
-        #        exon_map_vector_skipped = [-1 if exon_map_p <= threshold_low else 0 for exon_map_p in exon_map_pct_update]
-        #        exon_map_vector_notrunct = [mapped + skipped for mapped, skipped in list(zip(exon_map_vector_mapped, exon_map_vector_skipped))]
-        #        index_of_one = exon_map_vector_notrunct.index(1) if 1 in exon_map_vector_notrunct else len(exon_map_vector_notrunct)
-        #        exon_map_vector_trunct = [0 if i < index_of_one else exon_map_vector_notrunct[i] for i in range(len(exon_map_vector_notrunct))]
-        #        exon_map_vector_trunct = [vec if i in qualifyExon else 0 for i, vec in enumerate(exon_map_vector_trunct)]
-        #    else: # geneStrand=="-":
-        #        # change the last non-zero element pct = 1
-        #        for i in range(len(exon_map_pct_update) - 1, -1, -1):
-        #            if exon_map_pct_update[i] > 0:
-        #                exon_map_pct_update[i] = 1
-        #                break
-        #        exon_map_vector_mapped = [1 if exon_map_p >= threshold_high else 0 for exon_map_p in exon_map_pct_update]
-        #        exon_map_vector_skipped = [-1 if exon_map_p <= threshold_low else 0 for exon_map_p in exon_map_pct_update]
-        #        exon_map_vector_notrunct = [mapped + skipped for mapped, skipped in
-        #                                    list(zip(exon_map_vector_mapped, exon_map_vector_skipped))]
-        #        last_index_of_one = len(exon_map_vector_notrunct) - 1 - exon_map_vector_notrunct[::-1].index(
-        #            1) if 1 in exon_map_vector_notrunct else -1
-        #        exon_map_vector_trunct = [exon_map_vector_notrunct[i] if i <= last_index_of_one else 0 for i in
-        #                                  range(len(exon_map_vector_notrunct))]
-        #        exon_map_vector_trunct = [vec if i in qualifyExon else 0 for i, vec in enumerate(exon_map_vector_trunct)]
-        #    #use exon_map_vector_trunct to map again
-        #    compatible_matrix_new, _ = map_read_to_isoform_known_(isoform_exon_onehot_list, exon_map_vector_trunct)
-        #    if compatible_matrix_new.sum() > 0 and compatible_matrix_new.sum()<compatible_matrix.sum():
-        #        compatible_matrix = compatible_matrix_new
-        #        exon_map_pct = exon_map_pct_update
-        #else: #####parse poly false, any end can truncate
-        #    #5` truncation
-        #    exon_map_pct_update1 = exon_map_pct_update.copy()#read_exon_map_list
-        #    for i, pct in enumerate(exon_map_pct_update1):
-        #        if pct > 0:
-        #            exon_map_pct_update1[i] = 1
-        #            break
-        #    exon_map_vector_mapped = [1 if exon_map_p >= threshold_high else 0 for exon_map_p in exon_map_pct_update1]
-        #    exon_map_vector_skipped = [-1 if exon_map_p <= threshold_low else 0 for exon_map_p in exon_map_pct_update1]
-        #    exon_map_vector_notrunct = [mapped + skipped for mapped, skipped in
-        #                                list(zip(exon_map_vector_mapped, exon_map_vector_skipped))]
-        #    index_of_one = exon_map_vector_notrunct.index(1) if 1 in exon_map_vector_notrunct else len(
-        #        exon_map_vector_notrunct)
-        #    last_index_of_one = len(exon_map_vector_notrunct) - 1 - exon_map_vector_notrunct[::-1].index(
-        #        1) if 1 in exon_map_vector_notrunct else -1
-        #    exon_map_vector_trunct = [0 if i < index_of_one or i > last_index_of_one else exon_map_vector_notrunct[i] for i in
-        #                              range(len(exon_map_vector_notrunct))]
-        #    exon_map_vector_trunct = [vec if i in qualifyExon else 0 for i, vec in enumerate(exon_map_vector_trunct)]
-        #    compatible_matrix_new1, _ = map_read_to_isoform_known_(isoform_exon_onehot_list, exon_map_vector_trunct)
-        #    # 3` truncation
-        #    exon_map_pct_update2 = exon_map_pct_update.copy()  # read_exon_map_list
-        #    for i in range(len(exon_map_pct_update2) - 1, -1, -1):
-        #        if exon_map_pct_update2[i] > 0:
-        #            exon_map_pct_update2[i] = 1
-        #            break
-        #    exon_map_vector_mapped = [1 if exon_map_p >= threshold_high else 0 for exon_map_p in exon_map_pct_update2]
-        #    exon_map_vector_skipped = [-1 if exon_map_p <= threshold_low else 0 for exon_map_p in exon_map_pct_update2]
-        #    exon_map_vector_notrunct = [mapped + skipped for mapped, skipped in
-        #                                list(zip(exon_map_vector_mapped, exon_map_vector_skipped))]
-        #    index_of_one = exon_map_vector_notrunct.index(1) if 1 in exon_map_vector_notrunct else len(
-        #        exon_map_vector_notrunct)
-        #    last_index_of_one = len(exon_map_vector_notrunct) - 1 - exon_map_vector_notrunct[::-1].index(
-        #        1) if 1 in exon_map_vector_notrunct else -1
-        #    exon_map_vector_trunct = [0 if i < index_of_one or i > last_index_of_one else exon_map_vector_notrunct[i]
-        #                              for i in
-        #                              range(len(exon_map_vector_notrunct))]
-        #    exon_map_vector_trunct = [vec if i in qualifyExon else 0 for i, vec in enumerate(exon_map_vector_trunct)]
-        #    compatible_matrix_new2, _ = map_read_to_isoform_known_(isoform_exon_onehot_list, exon_map_vector_trunct)
-        #    compatible_matrix_new = np.minimum(compatible_matrix_new1, compatible_matrix_new2)
-        #    if compatible_matrix_new.sum() > 0 and compatible_matrix_new.sum() < compatible_matrix.sum():
-        #        compatible_matrix = compatible_matrix_new
-        #        exon_map_pct = exon_map_pct_update
-    ####method2: assign the cloest isoform to read
-    if compatible_matrix.sum() > 1:
-        np.array(isoform_exon_onehot_list)+np.array(read_exon_map_list)
-        read_pct = np.array(exon_map_pct)
-        transformed_read_pct = np.where(read_pct > threshold_high, 1, np.where(read_pct < threshold_low, 0,
-                                              (read_pct - threshold_low) / (threshold_high-threshold_low)))
-        distances = abs(isoform_ones-transformed_read_pct).sum(axis = 1)
-        compatible_ones = np.where(compatible_matrix == 1)[1]
-        min_index = compatible_ones[np.argmin(distances[compatible_ones])]
-        compatible_matrix[compatible_matrix==1] = 0
-        compatible_matrix[0,min_index] = 1
-    compatible_vector = compatible_matrix.tolist()[0]
-    return compatible_vector
-
+    return readName, n_mapExons, exon_map_pct, exon_map_pct0, exon_map_vector_trunct
 
+def map_read_to_gene(read, Info_singlegene, lowest_match=0.2, lowest_match1 = 0.6, small_exon_threshold = 0, small_exon_threshold1=80,
+                     truncation_match = 0.4, pacbio = False, model = None):
+    if model is None:
+        model = GeneModel(Info_singlegene, small_exon_threshold, small_exon_threshold1)
+    profile = read_gene_profile(read, Info_singlegene, model, lowest_match, lowest_match1, truncation_match, pacbio)
+    return assign_reads_to_gene([profile], model, lowest_match, lowest_match1)[0]
+
+
+def assign_reads_to_gene(profiles, model, lowest_match=0.2, lowest_match1=0.6):
+    """
+    assign reads of one gene to its known isoforms in one batch
+    profiles: outputs of read_gene_profile(_parse) for each read
+    return: (read_novelisoform_tuple, read_isoform_compatibleVector_tuple, mapping_scores) for each read, as map_read_to_gene
+    """
+    mapped = [k for k, profile in enumerate(profiles) if profile[1] > 0]
+    n_exons, n_isoforms = model.isoform_ones.shape[1], len(model.isoformNames)
+    read_exon_maps = np.array([profiles[k][4] for k in mapped], dtype=np.int8).reshape(len(mapped), n_exons)
+    exon_map_pcts = np.array([profiles[k][2] for k in mapped], dtype=float).reshape(len(mapped), n_exons)
+    compatible_matrix = model.assign_isoforms(read_exon_maps, exon_map_pcts, lowest_match1, lowest_match)
+    n_mapExons = np.array([profiles[k][1] for k in mapped], dtype=np.int64)
+    mapping_score_matrix = model.mapping_scores(compatible_matrix, n_mapExons)
+    compatible_rows = dict(zip(mapped, zip(compatible_matrix.tolist(), mapping_score_matrix.tolist())))
+    results = []
+    for k, (readName, n_mapExons, exon_map_pct, exon_map_pct0, exon_map_vector_trunct) in enumerate(profiles):
+        if n_mapExons > 0:
+            read_isoform_compatibleVector, scores = compatible_rows[k]
+        else:
+            # uncharacterized type3: not map to any exons---intron
+            read_isoform_compatibleVector, scores = [0] * n_isoforms, [-1] * n_isoforms
+        #---calculate mapping scores: [-1,-1,0.5,-1]
+        mapping_scores = [-1 if compatible == 0 else score for compatible, score in zip(read_isoform_compatibleVector, scores)]
+        #---novel/uncharacterized+existing compatible vector
+        read_novelisoform_tuple, read_isoform_compatibleVector_tuple = None, None
+        # novel isoform
+        if sum(read_isoform_compatibleVector) == 0 and n_mapExons > 0:
+            read_novelisoform_tuple = (readName, exon_map_pct0, exon_map_vector_trunct)
+        else:  # existing isoform/uncategorized
+            read_isoform_compatibleVector_tuple = (readName, read_isoform_compatibleVector)
+        results.append((read_novelisoform_tuple, read_isoform_compatibleVector_tuple, mapping_scores))
+    return results
 
 
 def compile_compatible_vectors(Read_novelIsoform_polished, Read_knownIsoform_polished, geneInfo):
@@ -991,7 +1036,9 @@ def compile_compatible_vectors(Read_novelIsoform_polished, Read_knownIsoform_pol
 
 ##TODO: change functions used this function: exonInfo,isoformInfo
 def save_compatibleVector_by_gene(geneName, geneID, geneChr, colNames, Read_Isoform_compatibleVector,Read_knownIsoform_scores,
-                                  qname_cbumi_dict,exonInfo,isoformInfo,output_folder=None, parse = False):
+                                  qname_cbumi_dict,exonInfo,isoformInfo,output_folder=None, parse = False, store = None, sparse = False):
+    #store: CompatibleStoreWriter of the sample; if given, the gene is appended to it instead of csv/tsv files
+    #sparse: save the compatible matrix as a sparse .npz file instead of a dense .csv file
     #save compatible vector
     geneSymbol = geneName
     geneName = geneName.replace('/', '.')
@@ -1028,13 +1075,9 @@ def save_compatibleVector_by_gene(geneName, geneID, geneChr, colNames, Read_Isof
         rowNames=[]
         output = None
     if (output_folder is not None and len(rowNames)>0):
-        data_df = pd.DataFrame(output['compatibleMatrix'], index=output['rowNames'],columns=output['colNames_isoforms'])
-        #data_df, novel_isoform_name_mapping = group_novel_isoform(data_df, geneStrand, parse)
         # Save read-isoform mappings to a TSV file
+        readmapping = None
         if len(readmapping_data)>0:
-            output_folder0 = os.path.join(output_folder, 'auxillary')
-            if not os.path.exists(output_folder0):
-                os.makedirs(output_folder0)
             readmapping = pd.DataFrame(readmapping_data,
                                        columns=['Read', 'Isoform', 'Exon Index', 'Exon Coordinates', 'Cell', 'Umi', 'CBUMI', 'geneName', 'geneID', 'geneChr'])
 
@@ -1043,16 +1086,33 @@ def save_compatibleVector_by_gene(geneName, geneID, geneChr, colNames, Read_Isof
                                                           value_name='MappingScore')
             scores_long_df.rename(columns={'index': 'Read'}, inplace=True)
             readmapping = pd.merge(readmapping, scores_long_df, on=['Read', 'Isoform'], how='left')
+        if store is not None:
+            store.append_gene(geneName, geneChr, output['rowNames'], output['colNames_isoforms'], output['compatibleMatrix'], readmapping)
+            print('gene ' + str(geneName) + ' saved')
+            return
+        if readmapping is not None:
+            output_folder0 = os.path.join(output_folder, 'auxillary')
+            if not os.path.exists(output_folder0):
+                os.makedirs(output_folder0)
             readmapping_filename = os.path.join(output_folder0, geneName + '_read_isoform_exon_mapping.tsv')
             readmapping.to_csv(readmapping_filename, sep='\t', index=False)
         #save compatible matrix
         output_folder = os.path.join(output_folder,'compatible_matrix')
         if not os.path.exists(output_folder):
             os.makedirs(output_folder)
-        file_name = os.path.join(output_folder, str(geneName) + '.csv')
-        data_df.to_csv(file_name)
+        if sparse:
+            save_compatible_npz(os.path.join(output_folder, str(geneName) + '.npz'), output['rowNames'], output['colNames_isoforms'], output['compatibleMatrix'])
+        else:
+            data_df = pd.DataFrame(output['compatibleMatrix'], index=output['rowNames'],columns=output['colNames_isoforms'])
+            #data_df, novel_isoform_name_mapping = group_novel_isoform(data_df, geneStrand, parse)
+            file_name = os.path.join(output_folder, str(geneName) + '.csv')
+            data_df.to_csv(file_name)
         print('gene ' + str(geneName) + ' saved')
     elif (output_folder is not None and len(rowNames)==0): #log the gene because no reads mapped
+        if store is not None:
+            store.append_log(geneName)
+            print('gene ' + str(geneName) + ' logged')
+            return
         output_folder = os.path.join(output_folder, 'compatible_matrix')
         if not os.path.exists(output_folder):
             os.makedirs(output_folder)
@@ -1068,14 +1128,12 @@ def save_compatibleVector_by_gene(geneName, geneID, geneChr, colNames, Read_Isof
         return output
 
 
-def process_read(read, qname_dict, lowest_match, lowest_match1,small_exon_threshold,small_exon_threshold1, truncation_match, Info_Singlegenes,
-                 parse=False, pacbio = False):
+def process_read_profile(read, qname_dict, lowest_match, lowest_match1, truncation_match, Info_Singlegenes, model,
+                         parse=False, pacbio = False):
+    # read - exon mapping of a read that passes the filters of process_read, None otherwise
     readName, readStart, readEnd = read.qname, read.reference_start, read.reference_end
-    mapping_scores = None
     if pacbio:
         readName = readName + '_' + str(readEnd - readStart)
-    novelIsoformResults = None
-    isoformCompatibleVectorResults = None
     if qname_dict is None: #for bulk
         qname_dict = {}
         qname_dict[readName] = readName
@@ -1083,31 +1141,27 @@ def process_read(read, qname_dict, lowest_match, lowest_match1,small_exon_thresh
         poly_bool, poly = detect_poly_parse(read, window=20, n=15)
         #if (readStart >= geneInfo['geneStart'] and readEnd < geneInfo['geneEnd'] and readName == qname_dict[readName]):
         if (readName == qname_dict[readName]):
-            read_novelisoform_tuple, read_isoform_compatibleVector_tuple, mapping_scores = map_read_to_gene_parse(read, Info_Singlegenes, lowest_match, lowest_match1, small_exon_threshold, small_exon_threshold1, truncation_match, poly_bool)
-            if read_novelisoform_tuple is not None:
-                novelIsoformResults = read_novelisoform_tuple
-            if read_isoform_compatibleVector_tuple is not None:
-                isoformCompatibleVectorResults = read_isoform_compatibleVector_tuple
+            return read_gene_profile_parse(read, Info_Singlegenes, model, lowest_match, lowest_match1, truncation_match, poly_bool)
     elif pacbio:
         #if (readStart >= geneInfo['geneStart'] and readEnd < geneInfo['geneEnd'] and readName == qname_dict[readName]):
         if (readName ==qname_dict[readName]):
-            read_novelisoform_tuple, read_isoform_compatibleVector_tuple, mapping_scores = map_read_to_gene(read, Info_Singlegenes,
-                                                                                            lowest_match, lowest_match1, small_exon_threshold, small_exon_threshold1, truncation_match ,True)
-            if read_novelisoform_tuple is not None:
-                novelIsoformResults = read_novelisoform_tuple
-            if read_isoform_compatibleVector_tuple is not None:
-                isoformCompatibleVectorResults = read_isoform_compatibleVector_tuple
+            return read_gene_profile(read, Info_Singlegenes, model, lowest_match, lowest_match1, truncation_match, True)
     else: #10x
         poly_bool, poly = detect_poly(read, window=20, n=15)
         #if (readStart >= geneInfo['geneStart'] and readEnd < geneInfo['geneEnd'] and poly_bool and readName == qname_dict[readName]):
         if (poly_bool and readName == qname_dict[readName]):
-            read_novelisoform_tuple, read_isoform_compatibleVector_tuple, mapping_scores = map_read_to_gene(read, Info_Singlegenes, lowest_match, lowest_match1, small_exon_threshold, small_exon_threshold1,truncation_match, False)
-            if read_novelisoform_tuple is not None:
-                novelIsoformResults = read_novelisoform_tuple
-            if read_isoform_compatibleVector_tuple is not None:
-                isoformCompatibleVectorResults = read_isoform_compatibleVector_tuple
-    return novelIsoformResults, isoformCompatibleVectorResults, mapping_scores
-def process_read_metagene(read, qname_dict, Info_multigenes, lowest_match,lowest_match1, small_exon_threshold,small_exon_threshold1,truncation_match, parse=False, pacbio = False):
+            return read_gene_profile(read, Info_Singlegenes, model, lowest_match, lowest_match1, truncation_match, False)
+    return None
+
+def process_read(read, qname_dict, lowest_match, lowest_match1,small_exon_threshold,small_exon_threshold1, truncation_match, Info_Singlegenes,
+                 parse=False, pacbio = False, model = None):
+    if model is None:
+        model = GeneModel(Info_Singlegenes, small_exon_threshold, small_exon_threshold1)
+    profile = process_read_profile(read, qname_dict, lowest_match, lowest_match1, truncation_match, Info_Singlegenes, model, parse, pacbio)
+    if profile is None:
+        return None, None, None
+    return assign_reads_to_gene([profile], model, lowest_match, lowest_match1)[0]
+def process_read_metagene(read, qname_dict, Info_multigenes, lowest_match,lowest_match1, small_exon_threshold,small_exon_threshold1,truncation_match, parse=False, pacbio = False, models = None):
     readName, readStart, readEnd = read.qname, read.reference_start, read.reference_end
     if qname_dict is None: #for bulk
         qname_dict = {}
@@ -1119,7 +1173,7 @@ def process_read_metagene(read, qname_dict, Info_multigenes, lowest_match,lowest
         if readName == qname_dict[readName]:
         #if (readStart >= start and readEnd < end and readName == qname_dict[readName]):
             ind, read_novelisoform_tuple, read_isoform_compatibleVector_tuple, mapping_scores = choose_gene_from_meta_parse(read,Info_multigenes,lowest_match,lowest_match1, small_exon_threshold,
-                                                                                                            small_exon_threshold1,truncation_match,poly_bool)
+                                                                                                            small_exon_threshold1,truncation_match,poly_bool,models)
             if ind >= 0:
                 return ind, read_novelisoform_tuple, read_isoform_compatibleVector_tuple, mapping_scores
     elif pacbio:
@@ -1128,7 +1182,7 @@ def process_read_metagene(read, qname_dict, Info_multigenes, lowest_match,lowest
             ind, read_novelisoform_tuple, read_isoform_compatibleVector_tuple, mapping_scores = choose_gene_from_meta(read,
                                                                                                       Info_multigenes,
                                                                                                       lowest_match, lowest_match1, small_exon_threshold,small_exon_threshold1,
-                                                                                                      truncation_match,pacbio=True)
+                                                                                                      truncation_match,pacbio=True,models=models)
             if ind >= 0:
                 return ind, read_novelisoform_tuple, read_isoform_compatibleVector_tuple, mapping_scores
     else:
@@ -1137,7 +1191,7 @@ def process_read_metagene(read, qname_dict, Info_multigenes, lowest_match,lowest
         #if (readStart >= start and readEnd < end and poly_bool and readName == qname_dict[readName]):
             ind, read_novelisoform_tuple, read_isoform_compatibleVector_tuple, mapping_scores = choose_gene_from_meta(read, Info_multigenes,
                                                                                                       lowest_match,lowest_match1, small_exon_threshold,small_exon_threshold1,
-                                                                                                      truncation_match,pacbio=False)
+                                                                                                      truncation_match,pacbio=False,models=models)
             if ind >= 0:
                 return ind, read_novelisoform_tuple, read_isoform_compatibleVector_tuple, mapping_scores
     return None
@@ -1148,13 +1202,8 @@ def map_read_to_novelisoform_loss(novelisoform_dict, assigns, df_assign_archive,
         data = df_assign_archive.to_numpy()  # change according to exon size
         if novel_isoform_assignment.ndim < 2 or data.ndim == 1:
             return None, df_assign_archive
-        novel_ones = (novel_isoform_assignment == 1).astype(int)
-        novel_minus_ones = (novel_isoform_assignment == -1).astype(int)
-        ones = (data == 1).astype(int)
-        minus_ones = (data == -1).astype(int)
-        conflict_matrix = np.tensordot(novel_ones, minus_ones, axes=([1], [1])) + np.tensordot(novel_minus_ones, ones,
-                                                                                               axes=([1], [1]))
-        compatible_matrix = (conflict_matrix == 0).astype(int).transpose()
+        conflict_matrix = exon_conflicts(pack_exon_assignments(data), pack_exon_assignments(novel_isoform_assignment))
+        compatible_matrix = (~conflict_matrix).astype(int)
         novel_df = pd.DataFrame(compatible_matrix)
         novel_df.index = df_assign_archive.index
         novel_df.columns = list(novelisoform_dict.keys())
@@ -1185,12 +1234,8 @@ def map_read_to_novelisoform(isoformInfo_dict, isoform_assignment_vector_list, r
         data = read_assignment_df.to_numpy() #change according to exon size
         if novel_isoform_assignment.ndim <2 or data.ndim == 1:
             return None, read_assignment_df
-        novel_ones = (novel_isoform_assignment == 1).astype(int)
-        novel_minus_ones = (novel_isoform_assignment == -1).astype(int)
-        ones = (data == 1).astype(int)
-        minus_ones = (data == -1).astype(int)
-        conflict_matrix = np.tensordot(novel_ones, minus_ones, axes=([1], [1])) + np.tensordot(novel_minus_ones, ones,axes=([1], [1]))
-        compatible_matrix = (conflict_matrix == 0).astype(int).transpose()
+        conflict_matrix = exon_conflicts(pack_exon_assignments(data), pack_exon_assignments(novel_isoform_assignment))
+        compatible_matrix = (~conflict_matrix).astype(int)
         novel_df = pd.DataFrame(compatible_matrix)
         novel_df.index = read_assignment_df.index
         novel_df.columns = list(isoformInfo_dict.keys())
@@ -0,0 +1,305 @@
+import json
+import os
+import pickle
+import shutil
+
+import numpy as np
+import pandas as pd
+
+######################################################################
+#######################memory-mapped read index#######################
+######################################################################
+
+# every column is a plain .npy file so that it can be opened with mmap_mode="r"
+# and shared through the page cache by all jobs running on the same node
+READ_INDEX_DONE = "done"
+# read names located by a ReadIndex are remembered, so that the representative, CBUMI and
+# sample lookups of the same read hash its name once
+READ_INDEX_CACHE_SIZE = 1 << 18
+
+
+def hash_qnames(qnames):
+    # deterministic 64 bit hash, identical across processes and python sessions
+    return pd.util.hash_array(np.asarray(qnames, dtype=object), categorize=False)
+
+
+def read_index_sources(path):
+    """
+    name, size and modification time of the bam information files the index at path is built from:
+    the bam.Info csv, parquet and pickle files next to it, a parquet folder lists its parts
+    """
+    folder = os.path.dirname(os.path.abspath(path))
+    sources = []
+    for name in sorted(os.listdir(folder)) if os.path.isdir(folder) else []:
+        if not name.startswith("bam.Info") or name.endswith(".tmp"):
+            continue
+        source = os.path.join(folder, name)
+        if os.path.isdir(source):
+            files = [os.path.join(name, f) for f in sorted(os.listdir(source))]
+        else:
+            files = [name]
+        for f in files:
+            stat = os.stat(os.path.join(folder, f))
+            sources.append([f, stat.st_size, stat.st_mtime_ns])
+    return sources
+
+
+def read_index_exists(path):
+    # a complete index that is not older than the bam information files next to it; sources that
+    # were deleted after the index was built do not invalidate it
+    try:
+        with open(os.path.join(path, READ_INDEX_DONE)) as file:
+            file.readline()
+            recorded = json.loads(file.readline() or "[]")
+    except (FileNotFoundError, ValueError):
+        return False
+    recorded = {tuple(source) for source in recorded}
+    return all(tuple(source) in recorded for source in read_index_sources(path))
+
+
+def build_read_index(arrays, output):
+    """
+    write a read-identity index sorted by the hash of read names
+    :param arrays: output of annotation.bam_info_to_arrays
+    :param output: folder of the index, e.g. target/bam/bam.Index
+    """
+    qnames = arrays["QNAME"]
+    # a read name seen more than once keeps its last row, as dict(zip(...)) does
+    qname_code, unique_qnames = pd.factorize(qnames, sort=False)
+    keep = ~pd.Series(qname_code).duplicated(keep="last").to_numpy()
+    rows = np.flatnonzero(keep)
+    hashes = hash_qnames(qnames[rows])
+    order = np.argsort(hashes, kind="stable")
+    rows = rows[order]
+    # position in the index of every read name
+    position = np.empty(len(unique_qnames), dtype=np.int64)
+    position[qname_code[rows]] = np.arange(len(rows))
+    representative = position[qname_code[arrays["REPRESENTATIVE"][rows]]]
+    columns = {
+        "hash": hashes[order],
+        "qname": qnames[rows].astype("S"),
+        "representative": representative,
+        "cbumi_code": arrays["CBUMI_CODE"][rows],
+        "cbumi": arrays["CBUMI"].astype("S"),
+    }
+    if "SAMPLE" in arrays:
+        columns["sample_code"] = arrays["SAMPLE_CODE"][rows]
+        columns["sample"] = arrays["SAMPLE"].astype("S")
+    # jobs building the same index write their own folder, the first complete one is kept
+    output_tmp = output + "." + str(os.getpid()) + ".tmp"
+    if os.path.exists(output_tmp):
+        shutil.rmtree(output_tmp)
+    os.makedirs(output_tmp)
+    for name, column in columns.items():
+        np.save(os.path.join(output_tmp, name + ".npy"), column)
+    with open(os.path.join(output_tmp, READ_INDEX_DONE), "w") as file:
+        file.write(str(len(rows)) + "\n")
+        file.write(json.dumps(read_index_sources(output)) + "\n")
+    # an incomplete or stale index is replaced
+    if os.path.exists(output) and not read_index_exists(output):
+        shutil.rmtree(output, ignore_errors=True)
+    try:
+        os.replace(output_tmp, output)
+    except OSError:
+        if not read_index_exists(output):
+            raise
+        shutil.rmtree(output_tmp)
+
+
+def read_index_arrays(qname_dict, qname_cbumi_dict, qname_sample_dict=None):
+    """
+    arrays of annotation.bam_info_to_arrays from the read-identity dictionaries of the bam.Info pickles
+    :return: input of build_read_index
+    """
+    qnames = np.array(list(qname_dict.keys()), dtype=object)
+    representative = pd.Index(qnames).get_indexer(
+        np.array(list(qname_dict.values()), dtype=object)
+    )
+    # a representative missing from the keys stands for itself
+    missing = representative < 0
+    representative[missing] = np.flatnonzero(missing)
+    cbumi_code, cbumi = pd.factorize(pd.Series(qname_cbumi_dict).reindex(qnames))
+    arrays = {
+        "QNAME": qnames,
+        "REPRESENTATIVE": representative,
+        "CBUMI_CODE": cbumi_code,
+        "CBUMI": np.asarray(cbumi),
+    }
+    if qname_sample_dict is not None:
+        sample_code, sample = pd.factorize(pd.Series(qname_sample_dict).reindex(qnames))
+        arrays["SAMPLE_CODE"] = sample_code
+        arrays["SAMPLE"] = np.asarray(sample)
+    return arrays
+
+
+class ReadIndex:
+    def __init__(self, path):
+        """
+        read-only view of an index written by build_read_index
+        path: folder of the index; columns are memory-mapped, so opening is nearly free
+        """
+        self.path = path
+        self._open()
+
+    def _open(self):
+        def load(name):
+            return np.load(os.path.join(self.path, name + ".npy"), mmap_mode="r")
+
+        self.hash = load("hash")
+        self.qname = load("qname")
+        self.representative = load("representative")
+        self.cbumi_code = load("cbumi_code")
+        self.cbumi = load("cbumi")
+        self.has_sample = os.path.isfile(os.path.join(self.path, "sample.npy"))
+        if self.has_sample:
+            self.sample_code = load("sample_code")
+            self.sample = load("sample")
+        self.position_cache = {}
+
+    def __getstate__(self):
+        # worker processes reopen the memory maps instead of copying them
+        return {"path": self.path}
+
+    def __setstate__(self, state):
+        self.path = state["path"]
+        self._open()
+
+    def __len__(self):
+        return len(self.hash)
+
+    def locate(self, qname):
+        # position of qname in the index, -1 if absent
+        position = self.position_cache.get(qname)
+        if position is not None:
+            return position
+        position = -1
+        h = hash_qnames([qname])[0]
+        i = int(np.searchsorted(self.hash, h, side="left"))
+        key = qname.encode()
+        while i < len(self.hash) and self.hash[i] == h:
+            if self.qname[i] == key:
+                position = i
+                break
+            i += 1
+        if len(self.position_cache) >= READ_INDEX_CACHE_SIZE:
+            self.position_cache.clear()
+        self.position_cache[qname] = position
+        return position
+
+    def locate_many(self, qnames):
+        """
+        positions of many read names in the index, -1 for those absent, hashed in one call
+        qnames: read names, e.g. all reads of a metagene; they are remembered, so that the
+        following lookups of the same reads through locate are cache hits
+        """
+        qnames = np.asarray(qnames, dtype=object)
+        positions = np.full(len(qnames), -1, dtype=np.int64)
+        if len(qnames) > 0 and len(self.hash) > 0:
+            h = hash_qnames(qnames)
+            left = np.searchsorted(self.hash, h, side="left")
+            right = np.searchsorted(self.hash, h, side="right")
+            keys = np.array([qname.encode() for qname in qnames], dtype="S")
+            # most hashes are unique in the index: compare all their names at once
+            single = np.flatnonzero(right - left == 1)
+            match = self.qname[left[single]] == keys[single]
+            positions[single[match]] = left[single[match]]
+            # names sharing a hash are compared one by one
+            for j in np.flatnonzero(right - left > 1):
+                for i in range(left[j], right[j]):
+                    if self.qname[i] == keys[j]:
+                        positions[j] = i
+                        break
+        if len(self.position_cache) + len(qnames) > READ_INDEX_CACHE_SIZE:
+            self.position_cache.clear()
+        self.position_cache.update(zip(qnames.tolist(), positions.tolist()))
+        return positions
+
+    def qname_dict(self):
+        return ReadIndexColumn(self, "representative")
+
+    def qname_cbumi_dict(self):
+        return ReadIndexColumn(self, "cbumi")
+
+    def qname_sample_dict(self):
+        return ReadIndexColumn(self, "sample") if self.has_sample else None
+
+    def value(self, column, i):
+        if column == "representative":
+            return self.qname[self.representative[i]].decode()
+        if column == "cbumi":
+            return self.cbumi[self.cbumi_code[i]].decode()
+        return self.sample[self.sample_code[i]].decode()
+
+
+class ReadIndexColumn:
+    def __init__(self, index, column):
+        """
+        dict-like lookup of one column of a ReadIndex by read name, used in place of
+        the qname_dict, qname_cbumi_dict and qname_sample_dict dictionaries
+        """
+        self.index = index
+        self.column = column
+
+    def __getitem__(self, qname):
+        i = self.index.locate(qname)
+        if i < 0:
+            raise KeyError(qname)
+        return self.index.value(self.column, i)
+
+    def get(self, qname, default=None):
+        i = self.index.locate(qname)
+        if i < 0:
+            return default
+        return self.index.value(self.column, i)
+
+    def __contains__(self, qname):
+        return self.index.locate(qname) >= 0
+
+    def __len__(self):
+        return len(self.index)
+
+
+######################################################################
+###########################read selection#############################
+######################################################################
+
+# reads kept by summarise_auxillary, as a sorted array of CBUMIs that is memory-mapped
+# by the count matrix step, in place of the read_selection.pkl dictionary
+READ_SELECTION_NPY = "read_selection.npy"
+
+
+def build_read_selection(cbumi, keep, output):
+    """
+    save the CBUMIs with Keep == 1 as a sorted bytes array
+    :param cbumi, keep: CBUMI and Keep columns of the read-isoform mapping file; a CBUMI listed
+    more than once takes its last Keep, as the read_selection.pkl dictionary does
+    :param output: path of the .npy file
+    """
+    df = pd.DataFrame({"cbumi": cbumi, "keep": keep})
+    df = df.drop_duplicates("cbumi", keep="last")
+    selected = np.sort(df.loc[df["keep"] == 1, "cbumi"].to_numpy().astype("S"))
+    np.save(output, selected)
+
+
+def load_read_selection(path):
+    """
+    sorted array of the selected CBUMIs of a sample
+    path: auxillary/read_selection.pkl; the .npy file next to it is memory-mapped when present
+    """
+    path_npy = os.path.join(os.path.dirname(path), READ_SELECTION_NPY)
+    if os.path.isfile(path_npy):
+        return np.load(path_npy, mmap_mode="r")
+    with open(path, "rb") as file:
+        cbumi_keep_dict = pickle.load(file)
+    cbumi = np.array(list(cbumi_keep_dict.keys()), dtype="S")
+    keep = np.fromiter(cbumi_keep_dict.values(), dtype=np.int64, count=len(cbumi))
+    return np.sort(cbumi[keep == 1])
+
+
+def is_selected(selected, cbumi):
+    # whether each CBUMI of a bytes array is in the sorted array of selected CBUMIs
+    if len(selected) == 0 or len(cbumi) == 0:
+        return np.zeros(len(cbumi), dtype=bool)
+    i = np.searchsorted(selected, cbumi)
+    i[i == len(selected)] = 0
+    return np.asarray(selected[i] == cbumi)
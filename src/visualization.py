@@ -6,6 +6,7 @@ import pysam
 import re
 import subprocess
 from scipy.io import mmread
+from compatible_store import CompatibleStore, compatible_store_paths, load_compatible_matrix, newest_compatible_sources
 
 #NFKBIA--535612368/535612383
 
@@ -62,12 +63,20 @@ def generate_subbam_subgtf_single_sample(gene, bamFile, target, novel_pct=0.1):
                                                                                  x) else None)
     filtered_gtf = pd.concat([filtered_gtf.iloc[[0]], filtered_gtf[transcript_ids.isin(selected_isoform)]], ignore_index=True)
     #locate reads belonging to known and novel
-    compatible_matrix_path = os.path.join(target,'compatible_matrix')
-    compatible_matrix_path = os.path.join(compatible_matrix_path,[cp for cp in os.listdir(compatible_matrix_path) if cp.startswith(str(gene)+'_')][0])
-    df=pd.read_csv(compatible_matrix_path)
-    new_columns = df.columns.tolist()
-    new_columns[0] = 'CBUMI'
-    df.columns = new_columns
+    compatible_matrix_folder = os.path.join(target,'compatible_matrix')
+    compatible_matrix_paths = [os.path.join(compatible_matrix_folder, cp) for cp in sorted(os.listdir(compatible_matrix_folder))
+                               if cp.startswith(str(gene)+'_') and cp.endswith(('.csv', '.npz'))]
+    store = CompatibleStore(compatible_matrix_folder) if compatible_store_paths(compatible_matrix_folder) else None
+    compatible_matrix_paths, store_genes = newest_compatible_sources(compatible_matrix_paths, store)
+    store_genes = [name for name in store_genes if name.startswith(str(gene)+'_')]
+    if len(compatible_matrix_paths) > 0:
+        mat, rowNames, colNames = load_compatible_matrix(compatible_matrix_paths[0])
+    else: # gene saved in a compatible matrix store (--compatible_format h5)
+        mat, rowNames, colNames = store.sparse_matrix(store_genes[0])
+    if store is not None:
+        store.close()
+    df = pd.DataFrame(mat.toarray(), columns=colNames)
+    df.insert(0, 'CBUMI', rowNames)
     mask_enst = df[known_isoform_names].gt(0).any(axis=1)
     cbumi_enst = df.loc[mask_enst, 'CBUMI'].tolist()
     ##TODO: add parse
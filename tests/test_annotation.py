@@ -0,0 +1,87 @@
+import numpy as np
+import pandas as pd
+
+from annotation import (
+    bam_arrays_to_dict,
+    bam_info_schema,
+    bam_info_to_arrays,
+    load_bam_info_arrays,
+    sort_bam_info,
+)
+
+
+def bam_info_to_dict_rows(bam_info, parse=False):
+    # reference: the row loop that bam_info_to_arrays and bam_arrays_to_dict replace
+    max_length_df = bam_info.drop_duplicates(subset="CBUMI", keep="first")
+    cbumi_to_max_qname = pd.Series(
+        max_length_df.QNAME.values, index=max_length_df.CBUMI
+    ).to_dict()
+    qname_dict = {
+        row["QNAME"]: cbumi_to_max_qname[row["CBUMI"]]
+        for index, row in bam_info.iterrows()
+    }
+    qname_cbumi_dict = dict(zip(bam_info["QNAME"], bam_info["CBUMI"]))
+    qname_sample_dict = None
+    if parse:
+        qname_sample_dict = dict(zip(bam_info["QNAME"], bam_info["SAMPLE"]))
+    return qname_dict, qname_cbumi_dict, qname_sample_dict
+
+
+def random_bam_info(rng, n):
+    return pd.DataFrame(
+        {
+            "QNAME": [f"read{i}" for i in rng.integers(0, n, n)],
+            "CB": rng.choice(["AAC", "GTT", "CCA"], n),
+            "UMI": [f"U{i}" for i in rng.integers(0, 20, n)],
+            "LENGTH": rng.integers(50, 500, n),
+            "SAMPLE": rng.choice(["sample1", "sample2"], n),
+            "SUBLIB": rng.choice(["1", "2"], n),
+        }
+    )
+
+
+def test_bam_arrays_to_dict_matches_row_loop():
+    rng = np.random.default_rng(3)
+    for parse in [False, True]:
+        for n in [0, 1, 50, 400]:
+            # read names repeat, the last row of a name wins in both versions
+            bam_info = sort_bam_info(random_bam_info(rng, n), parse=parse)
+            dicts = bam_arrays_to_dict(bam_info_to_arrays(bam_info, parse), parse)
+            assert dicts == bam_info_to_dict_rows(bam_info, parse)
+
+
+def test_load_bam_info_arrays_matches_sorted_dataframe(tmp_path):
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    rng = np.random.default_rng(1)
+    n = 3000
+    bam_info = random_bam_info(rng, n)
+    bam_info["QNAME"] = [f"read{i}" for i in range(n)]
+    # pacbio reads without barcode are dropped
+    bam_info.loc[rng.random(n) < 0.05, "CB"] = None
+    # the sample of a parse read follows from its cell barcode
+    bam_info["SAMPLE"] = np.where(bam_info["CB"] == "GTT", "sample2", "sample1")
+    path = str(tmp_path / "bam.Info.parquet")
+    pq.write_table(
+        pa.Table.from_pandas(
+            bam_info, schema=bam_info_schema(), preserve_index=False
+        ),
+        path,
+        row_group_size=700,
+    )
+    for parse, pacbio in [(False, False), (True, False), (False, True)]:
+        df = bam_info if pacbio else bam_info.fillna({"CB": "None"})
+        expected = bam_info_to_dict_rows(sort_bam_info(df, parse, pacbio), parse)
+        dicts = bam_arrays_to_dict(
+            load_bam_info_arrays(path, parse, pacbio, batch_size=333), parse
+        )
+        assert dicts[1:] == expected[1:]
+        # the representative is a longest read of the molecule, ties may be broken differently
+        length = dict(zip(bam_info["QNAME"], bam_info["LENGTH"]))
+        if pacbio:
+            length = {q + "_" + str(l): l for q, l in length.items()}
+        assert dicts[0].keys() == expected[0].keys()
+        assert all(
+            length[dicts[0][q]] == length[expected[0][q]] for q in expected[0]
+        )
@@ -0,0 +1,222 @@
+import copy
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import time
+
+import numpy as np
+import pysam
+
+from compatible import (
+    BamHandlePool,
+    ReadMapper,
+    lock_is_stale,
+    release_lock,
+    schedule_metagenes,
+    take_lock,
+)
+
+
+def write_bam(path, rng, n_reads):
+    # coordinate-sorted, indexed bam of spliced reads on chr1
+    header = {
+        "HD": {"VN": "1.6", "SO": "coordinate"},
+        "SQ": [{"SN": "chr1", "LN": 100000}],
+    }
+    starts = np.sort(rng.integers(0, 20000, n_reads))
+    with pysam.AlignmentFile(path, "wb", header=header) as bam:
+        for k, start in enumerate(starts):
+            read = pysam.AlignedSegment()
+            read.query_name = f"{os.path.basename(path)}_read{k}"
+            read.reference_id = 0
+            read.reference_start = int(start)
+            m1, n, m2 = (int(x) for x in rng.integers(1, 400, 3))
+            read.cigartuples = [(0, m1), (3, n), (0, m2)]
+            read.query_sequence = "A" * (m1 + m2)
+            read.mapping_quality = 60
+            bam.write(read)
+    pysam.index(path)
+
+
+def test_schedule_metagenes_is_deterministic_and_balanced():
+    rng = np.random.default_rng(6)
+    MetaGenes = [f"chr1_{k}" for k in range(300)]
+    # many ties, as with costs counted from short genes
+    costs = {meta_gene: int(rng.integers(1, 20)) ** 2 for meta_gene in MetaGenes}
+    jobs = schedule_metagenes(MetaGenes, costs, 7)
+    # every job computes the same split: insertion order and a JSON round trip of the cost cache do not matter
+    shuffled = list(costs.items())
+    random.Random(0).shuffle(shuffled)
+    assert schedule_metagenes(MetaGenes, dict(shuffled), 7) == jobs
+    assert schedule_metagenes(MetaGenes, json.loads(json.dumps(costs)), 7) == jobs
+    # each metagene goes to one job, in genomic order within the job
+    assert sorted(sum(jobs, [])) == sorted(MetaGenes)
+    for job in jobs:
+        assert job == sorted(job, key=MetaGenes.index)
+    loads = [sum(costs[meta_gene] for meta_gene in job) for job in jobs]
+    assert max(loads) <= sum(loads) / len(loads) + max(costs.values())
+    # more jobs than metagenes leaves some jobs empty
+    jobs = schedule_metagenes(MetaGenes[:2], costs, 4)
+    assert sorted(map(len, jobs)) == [0, 0, 1, 1]
+
+
+def test_metagene_cost_lock_goes_stale(tmp_path):
+    lock_path = str(tmp_path / "metagene_cost.json.lock")
+    assert take_lock(lock_path)
+    assert not take_lock(lock_path)
+    # held by this live process
+    assert not lock_is_stale(lock_path, max_wait=3600)
+    assert lock_is_stale(lock_path, max_wait=-1)
+    release_lock(lock_path)
+    release_lock(lock_path)
+    # left by a killed job on this host
+    process = subprocess.Popen([sys.executable, "-c", "pass"])
+    process.wait()
+    with open(lock_path, "w") as file:
+        json.dump(
+            {"host": socket.gethostname(), "pid": process.pid, "time": time.time()},
+            file,
+        )
+    assert lock_is_stale(lock_path, max_wait=3600)
+    # an empty lock is judged by its age
+    with open(lock_path, "w"):
+        pass
+    assert not lock_is_stale(lock_path, max_wait=3600)
+    old = time.time() - 7200
+    os.utime(lock_path, (old, old))
+    assert lock_is_stale(lock_path, max_wait=3600)
+
+
+def test_sweep_reads_match_fetch_of_each_metagene(tmp_path):
+    rng = np.random.default_rng(8)
+    bam_paths = [str(tmp_path / f"sample{i}.bam") for i in range(2)]
+    for bam_path in bam_paths:
+        write_bam(bam_path, rng, 1500)
+    # overlapping, nested and distant metagenes
+    metageneStructureInformation = {}
+    for k in range(40):
+        start = int(rng.integers(0, 21000))
+        geneInfo = {
+            "geneChr": "chr1",
+            "geneStart": start,
+            "geneEnd": start + int(rng.integers(1, 1500)),
+        }
+        metageneStructureInformation[f"chr1_{k}"] = [[geneInfo, [], {}]]
+    readmapper = ReadMapper.__new__(ReadMapper)
+    readmapper.bam_path = bam_paths
+    readmapper.bam_file_dict = {}
+    readmapper.bam_handles = BamHandlePool()
+    readmapper.metageneStructureInformation = metageneStructureInformation
+    readmapper.metagene_region_dict = None
+    readmapper.sweep_gap = 2000
+    regions, _ = readmapper.metagene_regions()
+    # every other metagene of a job, so that windows are cut by metagenes of other jobs
+    meta_genes = list(metageneStructureInformation)[::2]
+    windows = readmapper.sweep_windows(meta_genes)
+    assert sorted(sum(windows, [])) == sorted(meta_genes)
+    swept = {}
+    for window in windows:
+        for meta_gene, reads_by_sample in readmapper.sweep_reads(window):
+            swept[meta_gene] = [
+                [(read.query_name, read.reference_start) for read in reads]
+                for reads in reads_by_sample
+            ]
+    assert sorted(swept) == sorted(meta_genes)
+    for meta_gene in meta_genes:
+        chrom, start, end = regions[meta_gene]
+        fetched = []
+        for bam_path in bam_paths:
+            with pysam.AlignmentFile(bam_path, "rb") as bam:
+                fetched.append(
+                    [
+                        (read.query_name, read.reference_start)
+                        for read in bam.fetch(chrom, start, end)
+                    ]
+                )
+        assert swept[meta_gene] == fetched
+    readmapper.bam_handles.close()
+
+
+def resume_mapper(target, bam_path, metageneStructureInformation):
+    readmapper = ReadMapper.__new__(ReadMapper)
+    readmapper.target = [target]
+    readmapper.bam_path = [bam_path]
+    readmapper.parse = False
+    readmapper.lowest_match, readmapper.lowest_match1 = 0.2, 0.8
+    readmapper.small_exon_threshold, readmapper.small_exon_threshold1 = 20, 80
+    readmapper.truncation_match = 0.4
+    readmapper.platform = "10x-ont"
+    readmapper.novel_backend = "louvain"
+    readmapper.seed = 1
+    readmapper.compatible_format = "csv"
+    readmapper.compatible_stores = {}
+    readmapper.metageneStructureInformation = metageneStructureInformation
+    readmapper.metageneStructureInformationwNovel = copy.deepcopy(
+        metageneStructureInformation
+    )
+    readmapper.manifest_folder_path = os.path.join(
+        target, "reference", "compatible_manifest"
+    )
+    readmapper.manifest_path = None
+    readmapper.manifest_job_index = 0
+    return readmapper
+
+
+def test_manifest_resume_skips_only_completed_metagenes(tmp_path):
+    target = str(tmp_path / "sample1")
+    os.makedirs(os.path.join(target, "compatible_matrix"))
+    bam_path = str(tmp_path / "sample1.bam")
+    write_bam(bam_path, np.random.default_rng(0), 10)
+    metageneStructureInformation = {
+        f"chr1_{k}": [
+            [
+                {"geneName": f"G{k}", "geneID": f"ENSG{k}", "geneChr": "chr1"},
+                [(100 * k, 100 * k + 50)],
+                {f"ENST{k}": [0]},
+            ]
+        ]
+        for k in range(3)
+    }
+    MetaGenes = list(metageneStructureInformation)
+    readmapper = resume_mapper(target, bam_path, metageneStructureInformation)
+    readmapper.metagene_key_dict = readmapper.metagene_keys(MetaGenes)
+    for k in range(2):
+        csv_path = os.path.join(target, "compatible_matrix", f"G{k}_ENSG{k}.csv")
+        with open(csv_path, "w") as file:
+            file.write(",ENST0\n")
+        readmapper.metageneStructureInformationwNovel[f"chr1_{k}"][0][2][
+            "novelIsoform_1"
+        ] = [0]
+        readmapper.record_metagene(f"chr1_{k}")
+    # a line cut short by a preempted job is ignored
+    with open(readmapper.manifest_path, "a") as file:
+        file.write('{"metagene": "chr1_2", "ke')
+
+    def completed(**parameters):
+        readmapper = resume_mapper(target, bam_path, metageneStructureInformation)
+        readmapper.__dict__.update(parameters)
+        return readmapper, readmapper.completed_metagenes(MetaGenes)
+
+    readmapper, (done, todo) = completed()
+    assert done == ["chr1_0", "chr1_1"] and todo == ["chr1_2"]
+    # the annotation with novel isoforms is restored
+    assert readmapper.metageneStructureInformationwNovel["chr1_0"] == [
+        [
+            {"geneName": "G0", "geneID": "ENSG0", "geneChr": "chr1"},
+            [(0, 50)],
+            {"ENST0": [0], "novelIsoform_1": [0]},
+        ]
+    ]
+    # a deleted compatible matrix file is written again
+    os.remove(os.path.join(target, "compatible_matrix", "G1_ENSG1.csv"))
+    assert completed()[1] == (["chr1_0"], ["chr1_1", "chr1_2"])
+    # other parameters or bam files invalidate every record
+    assert completed(lowest_match=0.3)[1] == ([], MetaGenes)
+    assert completed(seed=2)[1] == ([], MetaGenes)
+    assert completed()[1] == (["chr1_0"], ["chr1_1", "chr1_2"])
+    with open(bam_path, "ab") as file:
+        file.write(b"\0")
+    assert completed()[1] == ([], MetaGenes)
@@ -0,0 +1,90 @@
+import os
+
+import numpy as np
+import pandas as pd
+
+from compatible_store import (
+    COMPATIBLE_STORE_CHUNK,
+    MAPPING_COLUMNS,
+    CompatibleStore,
+    CompatibleStoreWriter,
+    load_compatible_matrix,
+    save_compatible_npz,
+)
+
+
+def random_gene(rng, k):
+    n_rows, n_cols = int(rng.integers(0, 40)), int(rng.integers(1, 6))
+    rowNames = [f"read{k}_{i}" for i in range(n_rows)]
+    colNames = [f"ENST{k}_{j}" for j in range(n_cols)] + ["uncategorized"]
+    mat = (rng.random((n_rows, n_cols + 1)) < 0.3).astype(int)
+    readmapping = pd.DataFrame(
+        {
+            column: [f"{column}{k}_{i}" for i in range(n_rows)]
+            for column in MAPPING_COLUMNS
+        }
+    )
+    readmapping["MappingScore"] = rng.random(n_rows)
+    return rowNames, colNames, mat, readmapping
+
+
+def test_compatible_store_round_trip(tmp_path):
+    rng = np.random.default_rng(17)
+    folder = str(tmp_path / "compatible_matrix")
+    writer = CompatibleStoreWriter(folder)
+    # enough genes and reads to write the buffers several times
+    genes = {f"G{k}_ENSG{k}": random_gene(rng, k) for k in range(600)}
+    for k, (gene, (rowNames, colNames, mat, readmapping)) in enumerate(genes.items()):
+        writer.append_gene(gene, "chr1", rowNames, colNames, mat, readmapping)
+        if k == 300:
+            # flushed genes are readable while the writer is still open
+            writer.flush()
+            assert len(CompatibleStore(folder)) == 301
+    writer.append_log("G600_ENSG600")
+    writer.close()
+    assert sum(len(v[0]) for v in genes.values()) > COMPATIBLE_STORE_CHUNK
+    store = CompatibleStore(folder)
+    assert store.genes() == list(genes)
+    assert store.logged == ["G600_ENSG600"]
+    for gene, (rowNames, colNames, mat, readmapping) in genes.items():
+        df = store.matrix(gene)
+        assert df.index.tolist() == rowNames and df.columns.tolist() == colNames
+        np.testing.assert_array_equal(df.to_numpy(), mat)
+    # mapping rows of any subset of genes, in the order of the genes
+    subset = list(rng.choice(list(genes), 50, replace=False)) + ["G0_ENSG0", "G1_ENSG1"]
+    expected = pd.concat([genes[gene][3] for gene in subset], ignore_index=True)
+    pd.testing.assert_frame_equal(store.mapping(subset), expected)
+    assert len(store.mapping()) == sum(len(v[3]) for v in genes.values())
+    store.close()
+
+
+def test_compatible_store_reads_latest_copy_and_skips_broken_stores(tmp_path):
+    rng = np.random.default_rng(1)
+    folder = str(tmp_path / "compatible_matrix")
+    first, second = random_gene(rng, 0), random_gene(rng, 0)
+    for gene in [first, second]:
+        writer = CompatibleStoreWriter(folder)
+        writer.append_gene("G0_ENSG0", "chr1", *gene)
+        writer.close()
+    # left by a killed job
+    with open(os.path.join(folder, "compatible_9999999999999999999_1.h5"), "w") as file:
+        file.write("truncated")
+    store = CompatibleStore(folder)
+    assert len(store) == 1
+    np.testing.assert_array_equal(store.matrix("G0_ENSG0").to_numpy(), second[2])
+    store.close()
+
+
+def test_compatible_npz_round_trip(tmp_path):
+    rng = np.random.default_rng(2)
+    rowNames, colNames, mat, _ = random_gene(rng, 0)
+    path = str(tmp_path / "G0_ENSG0.npz")
+    save_compatible_npz(path, rowNames, colNames, mat)
+    mat_npz, rowNames_npz, colNames_npz = load_compatible_matrix(path)
+    path = str(tmp_path / "G0_ENSG0.csv")
+    pd.DataFrame(mat, index=rowNames, columns=colNames).to_csv(path)
+    mat_csv, rowNames_csv, colNames_csv = load_compatible_matrix(path)
+    assert rowNames_npz == rowNames_csv == rowNames
+    assert colNames_npz == colNames_csv == colNames
+    np.testing.assert_array_equal(mat_npz.toarray(), mat)
+    np.testing.assert_array_equal(mat_csv.toarray(), mat)
@@ -0,0 +1,102 @@
+import anndata as ad
+import numpy as np
+import pandas as pd
+from scipy.sparse import csc_matrix, csr_matrix
+
+from count_matrix import (
+    deduplicate_col,
+    em_fractional_counts,
+    resolve_multiple,
+    write_sparse_csv,
+)
+
+
+def deduplicate_col_pairwise(mat):
+    # reference: compare every pair of columns, as before the one-pass version
+    mat = csc_matrix(mat > 0)
+    mat.sort_indices()
+    rows = [
+        mat.indices[mat.indptr[j] : mat.indptr[j + 1]] for j in range(mat.shape[1])
+    ]
+    duplicated = {
+        j
+        for i in range(mat.shape[1])
+        for j in range(i + 1, mat.shape[1])
+        if np.array_equal(rows[i], rows[j])
+    }
+    return [j for j in range(mat.shape[1]) if j not in duplicated]
+
+
+def test_resolve_multiple_expected_splits_reads_over_compatible_isoforms():
+    df_multiple = np.array([[1, 1, 0, 0], [0, 1, 0, 1], [1, 0, 1, 1], [0, 0, 1, 1]])
+    weights = np.array([0.5, 0.3, 0.0, 0.2])
+    prob = resolve_multiple(
+        df_multiple, weights, np.random.default_rng(0), quant="expected"
+    )
+    np.testing.assert_allclose(prob.sum(axis=1), 1)
+    assert (prob[df_multiple == 0] == 0).all()
+    np.testing.assert_allclose(prob[0], [0.625, 0.375, 0, 0])
+    # compatible isoforms without weight share the read uniformly
+    prob = resolve_multiple(
+        np.array([[0, 1, 1, 0]]), np.zeros(4), None, quant="expected"
+    )
+    np.testing.assert_allclose(prob, [[0, 0.5, 0.5, 0]])
+
+
+def test_resolve_multiple_sample_follows_masked_weights():
+    n = 20000
+    df_multiple = np.tile([1, 0, 1, 1], (n, 1))
+    weights = np.array([0.2, 0.5, 0.2, 0.1])
+    resolved = resolve_multiple(df_multiple, weights, np.random.default_rng(1))
+    assert (resolved.sum(axis=1) == 1).all()
+    assert (resolved[:, 1] == 0).all()
+    np.testing.assert_allclose(resolved.mean(axis=0), [0.4, 0, 0.4, 0.2], atol=0.02)
+
+
+def test_em_fractional_counts_gives_mle_proportions():
+    # isoform A: 2 unique reads, isoform B: 1 unique read, 1 read compatible with both;
+    # the MLE is p_A = 2/3, so the ambiguous read is split 2/3 : 1/3
+    mat = csr_matrix(np.array([[1, 0], [1, 0], [0, 1], [1, 1]]))
+    fractions = em_fractional_counts(mat, np.array(["c1"] * 4), tol=1e-8)
+    np.testing.assert_allclose(fractions[:3], [[1, 0], [1, 0], [0, 1]])
+    np.testing.assert_allclose(fractions[3], [2 / 3, 1 / 3], atol=1e-6)
+
+
+def test_em_fractional_counts_estimates_each_cell_separately():
+    mat = csr_matrix(np.array([[1, 0], [1, 1], [0, 1], [1, 1], [0, 0]]))
+    cells = np.array(["c1", "c1", "c2", "c2", "c2"])
+    fractions = em_fractional_counts(mat, cells, tol=1e-8)
+    np.testing.assert_allclose(fractions[1], [1, 0], atol=1e-6)
+    np.testing.assert_allclose(fractions[3], [0, 1], atol=1e-6)
+    # a read compatible with no isoform gets no counts
+    assert (fractions[4] == 0).all()
+
+
+def test_deduplicate_col_matches_pairwise_comparison():
+    rng = np.random.default_rng(2)
+    for _ in range(200):
+        n, k = rng.integers(1, 30), rng.integers(0, 12)
+        mat = (rng.random((n, k)) < 0.3).astype(int)
+        if k > 3:
+            mat[:, 1] = mat[:, 0]
+            mat[:, k - 1] = mat[:, 2]
+        assert deduplicate_col(csr_matrix(mat)) == deduplicate_col_pairwise(mat)
+
+
+def test_write_sparse_csv_matches_dense_to_csv(tmp_path):
+    rng = np.random.default_rng(25)
+    for n_obs, n_vars in [(0, 3), (1, 1), (7, 4), (50, 13)]:
+        X = csr_matrix(
+            (rng.random((n_obs, n_vars)) < 0.3) * rng.integers(1, 9, (n_obs, n_vars))
+        )
+        for dtype in [np.float32, np.int64]:
+            adata = ad.AnnData(
+                X.astype(dtype),
+                obs=pd.DataFrame(index=[f"CB{i}" for i in range(n_obs)]),
+                var=pd.DataFrame(index=[f"ENSG{j}" for j in range(n_vars)]),
+            )
+            expected, path = tmp_path / "dense.csv", tmp_path / "sparse.csv"
+            adata.to_df().to_csv(expected)
+            # a few values at a time, so that rows are written in several blocks
+            write_sparse_csv(adata, path, n_values=10)
+            assert path.read_text() == expected.read_text()
@@ -0,0 +1,133 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from preprocessing import (
+    collapse_exon_assignments,
+    exon_hit_bases,
+    find_novel,
+    find_novel_by_chunk,
+    pattern_similarity_edges,
+)
+
+
+def exon_hit(mapPositions, exonInfo):
+    # reference: the per-position exon walk that exon_hit_bases replaces
+    mapExons = []
+    exon_index = 0
+    for i in mapPositions:
+        while i >= exonInfo[exon_index][1] and exon_index < len(exonInfo) - 1:
+            exon_index += 1
+        if int(i) >= int(exonInfo[exon_index][0]) and int(i) < int(
+            exonInfo[exon_index][1]
+        ):
+            mapExons.append(exon_index)
+    return mapExons
+
+
+def random_exons(rng):
+    # exons sorted by start, some of them overlapping or nested
+    exons, start = [], 0
+    for _ in range(rng.integers(1, 8)):
+        start += int(rng.integers(-20, 60))
+        exons.append((max(start, 0), max(start, 0) + int(rng.integers(1, 80))))
+    return sorted(exons)
+
+
+def random_blocks(rng):
+    # aligned reference intervals of a spliced read
+    blocks, position = [], int(rng.integers(0, 50))
+    for _ in range(rng.integers(0, 6)):
+        length = int(rng.integers(1, 60))
+        blocks.append((position, position + length))
+        position += length + int(rng.integers(1, 80))
+    return blocks
+
+
+def test_exon_hit_bases_matches_exon_hit():
+    rng = np.random.default_rng(9)
+    for _ in range(2000):
+        exonInfo, blocks = random_exons(rng), random_blocks(rng)
+        positions = [p for start, end in blocks for p in range(start, end)]
+        expected = np.bincount(
+            np.asarray(exon_hit(positions, exonInfo), dtype=np.int64),
+            minlength=len(exonInfo),
+        )
+        np.testing.assert_array_equal(exon_hit_bases(blocks, exonInfo), expected)
+
+
+def novel_reads(rng, n_reads, nExon=70):
+    # reads of a few unannotated isoforms: 1 included, -1 excluded, 0 not covered or ambiguous exons
+    isoforms = np.where(rng.random((4, nExon)) < 0.5, 1, -1)
+    reads = isoforms[rng.integers(0, len(isoforms), n_reads)]
+    reads = np.where(rng.random(reads.shape) < 0.9, reads, 0)
+    # a handful of patterns carry most reads, as in deep genes
+    reads[: n_reads // 2] = reads[0]
+    return pd.DataFrame(reads, index=[f"read{i}" for i in range(n_reads)])
+
+
+def test_pattern_similarity_edges_sum_read_pairs():
+    rng = np.random.default_rng(13)
+    reads = novel_reads(rng, 60).to_numpy()
+    patterns, inverse, counts = collapse_exon_assignments(reads)
+    assert (patterns[inverse] == reads).all()
+    sources, targets, weights = pattern_similarity_edges(patterns, counts)
+    edges = {}
+    for i, j, w in zip(sources.tolist(), targets.tolist(), weights.tolist()):
+        edges[(i, j)] = w
+    # reference: every pair of reads, similar when neither includes an exon the other excludes
+    expected = {}
+    for a in range(len(reads)):
+        for b in range(a + 1, len(reads)):
+            conflict = ((reads[a] == 1) & (reads[b] == -1)) | (
+                (reads[a] == -1) & (reads[b] == 1)
+            )
+            similarity = int(((reads[a] == reads[b]) & (reads[a] != 0)).sum())
+            if conflict.any() or similarity == 0:
+                continue
+            key = tuple(sorted((inverse[a], inverse[b])))
+            expected[key] = expected.get(key, 0) + similarity
+    assert edges == expected
+
+
+@pytest.mark.parametrize("backend", ["louvain", "leiden"])
+def test_find_novel_is_stable_for_a_seed(backend):
+    df_assign = novel_reads(np.random.default_rng(1), 300)
+    novelisoform_dict, assigns = find_novel(df_assign, backend, seed=5)
+    assert len(novelisoform_dict) > 0
+    for _ in range(3):
+        assert find_novel(df_assign, backend, seed=5) == (novelisoform_dict, assigns)
+
+
+def test_find_novel_on_patterns_weighted_by_counts_matches_reads():
+    df_assign = novel_reads(np.random.default_rng(2), 300)
+    patterns, inverse, counts = collapse_exon_assignments(df_assign.to_numpy())
+    df_pattern = pd.DataFrame(patterns, columns=df_assign.columns)
+    assert find_novel(df_pattern, seed=7, counts=counts) == find_novel(
+        df_assign, seed=7
+    )
+
+
+def test_find_novel_by_chunk_is_stable_for_a_seed():
+    df_assign = novel_reads(np.random.default_rng(3), 2000)
+    exonInfo = [(100 * k, 100 * k + 60) for k in range(df_assign.shape[1])]
+
+    def run():
+        return find_novel_by_chunk(
+            df_assign, exonInfo, 0, 80, chunk_size=500, seed=11
+        )
+
+    novelisoform_dict, novel_df, novel_df_empty = run()
+    assert len(novelisoform_dict) > 0
+    # every read is either mapped to novel isoforms or left uncategorized, in read order
+    mapped = df_assign.index.isin(novel_df.index)
+    assert novel_df.index.tolist() == df_assign.index[mapped].tolist()
+    assert novel_df_empty == df_assign.index[~mapped].tolist()
+    # reads with the same exon assignment get the same mapping
+    _, inverse, _ = collapse_exon_assignments(df_assign.loc[novel_df.index].to_numpy())
+    for pattern in np.unique(inverse):
+        rows = novel_df.to_numpy()[inverse == pattern]
+        assert (rows == rows[0]).all()
+    again = run()
+    assert again[0] == novelisoform_dict and again[2] == novel_df_empty
+    pd.testing.assert_frame_equal(again[1], novel_df)
@@ -0,0 +1,86 @@
+import os
+import time
+
+import numpy as np
+import pytest
+
+import read_index
+from read_index import (
+    ReadIndex,
+    build_read_index,
+    read_index_arrays,
+    read_index_exists,
+)
+
+
+def read_dicts(n, seed=0):
+    # representative, CBUMI and sample of every read; the first read of a molecule represents it
+    rng = np.random.default_rng(seed)
+    qnames = [f"m64_{i}/ccs" for i in range(n)]
+    qname_cbumi_dict = {
+        q: f"C{rng.integers(0, 40)}_U{rng.integers(0, 30)}" for q in qnames
+    }
+    first = {}
+    for q in qnames:
+        first.setdefault(qname_cbumi_dict[q], q)
+    qname_dict = {q: first[qname_cbumi_dict[q]] for q in qnames}
+    qname_sample_dict = {q: rng.choice(["sample1", "sample2"]) for q in qnames}
+    return qname_dict, qname_cbumi_dict, qname_sample_dict
+
+
+def check_index(path, dicts):
+    index = ReadIndex(path)
+    columns = [
+        index.qname_dict(),
+        index.qname_cbumi_dict(),
+        index.qname_sample_dict(),
+    ]
+    qnames = list(dicts[0])
+    for column, d in zip(columns, dicts):
+        assert all(column[q] == d[q] for q in qnames)
+        assert "absent" not in column and column.get("absent") is None
+        with pytest.raises(KeyError):
+            column["absent"]
+    # batched lookups give the same positions as lookups one by one
+    positions = ReadIndex(path).locate_many(qnames + ["absent"])
+    assert positions.tolist() == [index.locate(q) for q in qnames + ["absent"]]
+    assert positions[-1] == -1
+
+
+@pytest.mark.parametrize("coarse_hash", [False, True])
+def test_read_index_round_trip(tmp_path, monkeypatch, coarse_hash):
+    if coarse_hash:
+        # a few hash values only, so that most reads share a hash bucket
+        hash_qnames = read_index.hash_qnames
+        monkeypatch.setattr(
+            read_index,
+            "hash_qnames",
+            lambda qnames: hash_qnames(qnames) % np.uint64(7),
+        )
+    dicts = read_dicts(2000)
+    path = str(tmp_path / "bam.Index")
+    build_read_index(read_index_arrays(*dicts), path)
+    assert read_index_exists(path)
+    assert len(ReadIndex(path)) == 2000
+    check_index(path, dicts)
+    # a second job building the same index keeps a complete one
+    build_read_index(read_index_arrays(*dicts), path)
+    check_index(path, dicts)
+
+
+def test_read_index_is_stale_after_bam_information_changes(tmp_path):
+    dicts = read_dicts(100)
+    source = tmp_path / "bam.Info.pkl"
+    source.write_text("old")
+    path = str(tmp_path / "bam.Index")
+    build_read_index(read_index_arrays(*dicts), path)
+    assert read_index_exists(path)
+    time.sleep(0.01)
+    source.write_text("newer")
+    assert not read_index_exists(path)
+    build_read_index(read_index_arrays(*dicts), path)
+    assert read_index_exists(path)
+    # bam information deleted after the build does not invalidate the index
+    os.remove(source)
+    assert read_index_exists(path)
+    check_index(path, dicts)